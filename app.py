@@ -6,6 +6,7 @@ import requests
 import json
 import time
 import io
+import threading
     
 from datetime import datetime
 import pandas as pd
@@ -15,6 +16,26 @@ from db_helper import *
 
 
 from model_parameters import modelIds, modelTypes, styleUUID, presetStyle, sdxl_params
+from polling import policy_for_model, COMPLETE, FAILED, TIMEOUT
+from completion import wait_for_completion
+from latency import (latency_group, latency_size, estimate_latency, policy_with_latency, eta_text,
+                     completion_duration, MAX_SAMPLES)
+from batch import parse_batch_file, run_batch, DEFAULT_CONCURRENCY, QUEUED as BATCH_QUEUED, DONE as BATCH_DONE
+from batch import QuotaReservations
+from batch import build_fanout_variants, parse_strengths, run_image_to_image_fanout, MAX_FANOUT_VARIANTS
+import bulk_img2img
+import db_helper
+from leonardo_client import get_client, build_text_to_image_payload, payload_cache_key, build_image_to_image_payload
+from key_pool import get_key_pool, is_key_failure, is_key_error
+from init_images import preprocess_init_image, init_image_file_name, init_image_hash, INIT_IMAGE_EXTENSION, INIT_IMAGE_CONTENT_TYPE
+from image_fetch import get_image_fetcher
+from thumbnails import load_thumbnail
+from zip_export import export_to_temp_file, file_loader, remove_export
+from mirror import image_source, mirror_loader
+from renditions import submit_renditions, list_renditions, rendition_mime
+from contact_sheets import get_contact_sheets, SHEET_MAX_ITEMS
+from perceptual_hash import get_hash_index, find_similar
+import upscale
 
 # Load environment variables
 load_dotenv()
@@ -23,268 +44,265 @@ load_dotenv()
 LEONARDO_API_KEY = os.getenv("LEONARDO_API_KEY")
 
 
-def leonardo_text_to_image(prompt, parameters):
-    apiCreditCost = "0"
-    """Call Leonardo API for text-to-image generation"""
-    url = "https://cloud.leonardo.ai/api/rest/v1/generations"
-    
-    headers = {
-        "Authorization": f"Bearer {LEONARDO_API_KEY}",
-        "Content-Type": "application/json",
-        "accept": "application/json"
-    }
-    
-    # Start with base payload
-    payload = {
-        "prompt": prompt,
-        "num_images": parameters.get("num_images", 1),
-        "width": parameters.get("width", 512),
-        "height": parameters.get("height", 512),
-    }
-    
-    # Add model ID (required)
-    payload["modelId"] = parameters.get("modelId", "b2614463-296c-462a-9586-aafdb8f00e36")
+def wait_for_inflight_generation(flight_key, username):
+    """
+    Wait for the submitter of an identical request to record its generation ID
     
-           
-    # # Add negative prompt if provided
-    # if "negative_prompt" in parameters and parameters["negative_prompt"]:
-    #     payload["negativePrompt"] = parameters["negative_prompt"]
-        
-    # Add contrast if provided
-    if "contrast" in parameters:
-        payload["contrast"] = float(parameters["contrast"])
-    
-       
-    # Add model-specific parameters
-    # Phoenix and SDXL models
-    if "alchemy" in parameters:
-        payload["alchemy"] = parameters["alchemy"]
-    
-    # Phoenix models
-    if "ultra" in parameters:
-        payload["ultra"] = parameters["ultra"]
+    Returns (flight, None) to follow that generation, or (None, owner) once the
+    submitter released its claim or stopped heart-beating and this run claimed it
+    """
+    while True:
+        flight = get_inflight_generation(flight_key)
+        if flight is not None and flight["generation_id"]:
+            return flight, None
+        # Only an abandoned or released claim can be taken over - never a live one
+        owner = claim_inflight_generation(flight_key, username)
+        if owner:
+            return None, owner
+        time.sleep(0.5)
 
-
-    try:
-        if payload["ultra"] == True and payload["alchemy"] == True:
-            del payload["alchemy"]
-    except:
-        pass
+def start_inflight_heartbeat(flight_key, owner):
+    """Keep a single-flight claim alive from a background thread until the returned event is set"""
+    stop = threading.Event()
     
-    # SDXL and SD15 models
-    if "photoReal" in parameters:
-        payload["photoReal"] = parameters["photoReal"]
-        if parameters["photoReal"] and "photoRealVersion" in parameters:
-            payload["photoRealVersion"] = parameters["photoRealVersion"]
+    def beat():
+        while not stop.wait(SINGLE_FLIGHT_STALE_AFTER / 3):
+            heartbeat_inflight_generation(flight_key, owner)
     
-    # Style options
-    if "styleUUID" in parameters and parameters["styleUUID"]:
-        payload["styleUUID"] = parameters["styleUUID"]
+    threading.Thread(target=beat, name="inflight-heartbeat", daemon=True).start()
+    return stop
+
+def leonardo_text_to_image(prompt, parameters, use_cache=False, username=None):
+    apiCreditCost = "0"
+    """Call Leonardo API for text-to-image generation"""
+    payload = build_text_to_image_payload(prompt, parameters)
     
-    # Preset style for SDXL
-    if "presetStyle" in parameters and parameters["presetStyle"]:
-        payload["presetStyle"] = parameters["presetStyle"]
+    # Identical requests can reuse a stored result instead of calling the API
+    cache_key = payload_cache_key(payload)
+    if use_cache:
+        cached_images = get_cached_result(cache_key)
+        if cached_images:
+            st.info("Identical request found - reusing the stored result (no API credits used)")
+            return {"generations_by_pk": {"status": "COMPLETE", "generated_images": cached_images}}, apiCreditCost
     
-    # Add prompt enhancement if specified
-    if "enhancePrompt" in parameters:
-        payload["enhancePrompt"] = parameters["enhancePrompt"]
+    # Single-flight: a rerun, double click or second session submitting the same
+    # request attaches to the generation already in progress instead of paying twice
+    flight_key = f"{username}:{cache_key}"
+    owner = claim_inflight_generation(flight_key, username)
+    flight = None
+    if owner is None:
+        with st.spinner("An identical generation is already being submitted - waiting for it..."):
+            flight, owner = wait_for_inflight_generation(flight_key, username)
+    # Only the owner of the claim submits, charges and releases it
+    is_submitter = owner is not None
+    heartbeat = start_inflight_heartbeat(flight_key, owner) if is_submitter else None
     
+    # Key pool lease held by this run while its job is in flight
+    lease = None
+    lease_failed = False
     try:
-        st.write("Starting image generation...")
-        st.write("Request payload:", json.dumps(payload, indent=2))
-        
-        # First create the generation
-        response = requests.post(url, json=payload, headers=headers)
-        
-        # Log the response for debugging
-        # st.write("Initial API Response:", response.text)
-        
-        
-
-        if response.status_code != 200:
-            st.error(f"API Error: Status code {response.status_code}")
-            st.error(f"Response: {response.text}")
-            return None, apiCreditCost
+        if is_submitter:
+            # Route the job to the least-loaded healthy API key in the pool
+            lease = get_key_pool().acquire()
+            client = lease.client
+            key_id = lease.key_id
+            
+            st.write("Starting image generation...")
+            st.write("Request payload:", json.dumps(payload, indent=2))
+            
+            # First create the generation
+            submitted_at = time.monotonic()
+            response = client.create_generation(payload)
             
-        generation_data = response.json()
-        
-        # Get the generation ID from the nested structure
-        generation_id = generation_data.get("sdGenerationJob", {}).get("generationId")
-        apiCreditCost = generation_data.get("sdGenerationJob", {}).get("apiCreditCost", "0")
-        st.write(f"API Credits: {apiCreditCost}")
-        if not generation_id:
-            st.error("Failed to get generation ID from API")
-            st.error(f"Full response: {generation_data}")
-            return None, apiCreditCost
+            # Log the response for debugging
+            # st.write("Initial API Response:", response.text)
+            
+            if response.status_code != 200:
+                st.error(f"API Error: Status code {response.status_code}")
+                st.error(f"Response: {response.text}")
+                lease_failed = is_key_failure(response.status_code)
+                release_inflight_generation(flight_key, owner)
+                return None, apiCreditCost
+                
+            generation_data = response.json()
+            
+            # Get the generation ID from the nested structure
+            generation_id = generation_data.get("sdGenerationJob", {}).get("generationId")
+            apiCreditCost = generation_data.get("sdGenerationJob", {}).get("apiCreditCost", "0")
+            st.write(f"API Credits: {apiCreditCost}")
+            lease.charge(apiCreditCost)
+            if not generation_id:
+                st.error("Failed to get generation ID from API")
+                st.error(f"Full response: {generation_data}")
+                release_inflight_generation(flight_key, owner)
+                return None, apiCreditCost
+            
+            attach_inflight_generation(flight_key, owner, generation_id, apiCreditCost, key_id)
+        else:
+            st.info("An identical generation is already in progress - waiting for its result")
+            generation_id = flight["generation_id"]
+            # The submitter charges for this generation
+            apiCreditCost = "0"
+            # Follow the job through the key that submitted it
+            key_id = flight.get("api_key_id")
+            client = get_key_pool().client_for(key_id) or get_client(LEONARDO_API_KEY)
             
         # st.write(f"Generation ID received: {generation_id}")
             
-        # Poll for the generation result
-        status_url = f"https://cloud.leonardo.ai/api/rest/v1/generations/{generation_id}"
-        max_attempts = 30  # 30 seconds maximum wait time
-        attempt = 0
+        # Poll for the generation result - backoff with jitter, deadline per model type.
+        # Past timings of this configuration push the first check back to when the
+        # job can plausibly be done and drive the ETA
+        estimate = estimate_latency(get_generation_timings(latency_group(payload), MAX_SAMPLES), latency_size(payload))
+        policy = policy_with_latency(policy_for_model(payload["modelId"]), estimate)
         
         # Create a progress bar
         progress_bar = st.progress(0)
         status_text = st.empty()
+        if estimate:
+            status_text.text(f"Expected to take about {estimate.expected:.0f}s")
         
-        while attempt < max_attempts:
-            status_response = requests.get(status_url, headers=headers)
-            
+        def fetch_status():
+            status_response = client.get_generation(generation_id)
             if status_response.status_code != 200:
                 st.error(f"Status check failed: {status_response.status_code}")
                 st.error(f"Response: {status_response.text}")
-                return None, apiCreditCost
-                
-            status_data = status_response.json()
-            
-            # Update progress
-            progress = min(1.0, (attempt + 1) / max_attempts)
-            progress_bar.progress(progress)
-            status_text.text(f"Checking generation status... ({attempt + 1}/{max_attempts})")
-            
-            if status_data['generations_by_pk']['status'] == "COMPLETE":
-                status_text.text("Generation completed successfully!")
-                return status_data, apiCreditCost
-            elif status_data['generations_by_pk']['status'] == "FAILED":
-                status_text.text("Generation failed!")
-                st.error(f"Generation failed: {status_data.get('error')}")
-                return None, apiCreditCost
-                
-            time.sleep(1)  # Wait 1 second before next poll
-            attempt += 1
-            
-        status_text.text("Generation timed out!")
-        st.error("Generation timed out")
+                return None
+            return status_response.json()
+        
+        def show_progress(elapsed, attempt):
+            if estimate and estimate.expected > 0:
+                progress_bar.progress(min(0.95, elapsed / estimate.expected))
+                status_text.text(eta_text(elapsed, estimate))
+            else:
+                progress_bar.progress(min(1.0, elapsed / policy.deadline))
+                status_text.text(f"Checking generation status... ({elapsed:.0f}s, check {attempt})")
+        
+        status, status_data = wait_for_completion(generation_id, fetch_status, policy, on_progress=show_progress,
+                                                  api_key=client.api_key)
+        
+        if status == COMPLETE:
+            progress_bar.progress(1.0)
+            status_text.text("Generation completed successfully!")
+            duration = completion_duration(status_data, submitted_at) if is_submitter else None
+            if duration is not None:
+                record_generation_timing(latency_group(payload), latency_size(payload), duration)
+            store_cached_result(cache_key, payload, status_data['generations_by_pk'].get('generated_images', []), apiCreditCost)
+            status_data["api_key_id"] = key_id
+            if is_submitter:
+                complete_inflight_generation(flight_key, owner)
+            else:
+                # The submitting run charges and logs this generation
+                status_data["shared_result"] = True
+            return status_data, apiCreditCost
+        elif status == FAILED:
+            status_text.text("Generation failed!")
+            st.error(f"Generation failed: {status_data.get('error')}")
+        elif status == TIMEOUT:
+            status_text.text("Generation timed out!")
+            st.error(f"Generation did not finish within {policy.deadline:.0f}s")
+        if is_submitter:
+            release_inflight_generation(flight_key, owner)
         return None, apiCreditCost
         
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
+        lease_failed = is_key_error(e)
+        if is_submitter:
+            release_inflight_generation(flight_key, owner)
         return None, apiCreditCost
     except json.JSONDecodeError as e:
         st.error(f"Failed to parse API response: {str(e)}")
         st.error(f"Raw response: {response.text}")
+        if is_submitter:
+            release_inflight_generation(flight_key, owner)
         return None, apiCreditCost
+    finally:
+        if heartbeat is not None:
+            heartbeat.set()
+        if lease is not None:
+            lease.release(failed=lease_failed)
    
 def leonardo_image_to_image(prompt, image_file, parameters):
     """Call Leonardo API for image-to-image generation"""
     
-    # Configuration
-    # Ensure API key doesn't have any whitespace
-    api_key = LEONARDO_API_KEY.strip()
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {api_key}"
-    }
-    
-    # Debug info - hide actual key for security
-    key_preview = f"{api_key[:5]}...{api_key[-5:]}" if len(api_key) > 10 else "Invalid key format"
-    print(f"Using API key: {key_preview}")
+    # Route the job to the least-loaded healthy API key in the pool
+    try:
+        lease = get_key_pool().acquire()
+    except requests.exceptions.RequestException as e:
+        st.error(f"API Error: {str(e)}")
+        return None
+    client = lease.client
     
+    lease_failed = False
     try:
-        # Step 1: Get a presigned URL for uploading the image
-        init_url = "https://cloud.leonardo.ai/api/rest/v1/init-image"
-        
-        # Determine file extension from uploaded file
-        file_name = image_file.name
-        extension = file_name.split('.')[-1].lower()
-        
-        payload = {"extension": extension}
-        response = requests.post(init_url, json=payload, headers=headers)
-        response.raise_for_status()
-        print("Step 1 done")
-        # Step 2: Upload the image using the presigned URL
-        fields = json.loads(response.json()['uploadInitImage']['fields'])
-        upload_url = response.json()['uploadInitImage']['url']
-        image_id = response.json()['uploadInitImage']['id']
-        print("Step 2 done")
-        # Reset file pointer and prepare for upload
+        # Step 0: Orient, crop, downscale and re-encode the image. Done inline -
+        # its hash decides whether an upload (and a presigned URL) is needed at all
         image_file.seek(0)
-        print("Step 2.1 done")
-        print(image_file)
-        print(file_name)
-        print(f'image/{extension}')
-        files = {'file': (file_name, image_file, f'image/{extension}')}
-        print("Step 2.2 done")
-        
-        # Upload to the presigned URL (no headers needed for this request)
-        upload_response = requests.post(upload_url, data=fields, files=files)
-        upload_response.raise_for_status()
-        print("Step 2.3 done")
-        print(upload_response)
-        # print(f"Upload response: {upload_response.json()}")
+        init_image = preprocess_init_image(image_file.read())
+        file_name = init_image_file_name(image_file.name)
+        
+        # The same source picture was already uploaded with this key - reuse it
+        image_hash = init_image_hash(init_image)
+        image_id = get_init_image_id(image_hash, lease.key_id)
+        if not image_id:
+            # Step 1: Get a presigned URL for uploading the image
+            response = client.create_init_image(INIT_IMAGE_EXTENSION)
+            response.raise_for_status()
+            print("Step 1 done")
+            # Step 2: Upload the image using the presigned URL
+            fields = json.loads(response.json()['uploadInitImage']['fields'])
+            upload_url = response.json()['uploadInitImage']['url']
+            image_id = response.json()['uploadInitImage']['id']
+            print("Step 2 done")
+            # Upload the preprocessed buffer itself - no extra copy
+            files = {'file': (file_name, init_image, INIT_IMAGE_CONTENT_TYPE)}
+            
+            # Upload to the presigned URL (no headers needed for this request)
+            upload_response = client.upload_init_image(upload_url, fields, files)
+            upload_response.raise_for_status()
+            print("Step 2.3 done")
+            print(upload_response)
+            store_init_image_id(image_hash, lease.key_id, image_id)
         print("Step 3 done")
         # Step 3: Generate with the uploaded image
-        generation_url = "https://cloud.leonardo.ai/api/rest/v1/generations"
-        
-        # Extract parameters with defaults
-        model_id = parameters.get("model_id", "6bef9f1b-29cb-40c7-b9df-32b51c1f67d3")  # Default to Leonardo Creative "1e60896f-3c26-4296-8ecc-53e2afecc132"
-        width = parameters.get("width", 512)
-        height = parameters.get("height", 512)
-        num_images = parameters.get("num_images", 1)
-        select_model = parameters.get("select_model", "General")
-        select_dimensions = parameters.get("select_dimensions", "Square")
-        if select_model == "Raja Ravi Varma":
-            model_id = "6bef9f1b-29cb-40c7-b9df-32b51c1f67d3"
-            prompt = prompt + " in style of raja ravi varma"
-        else:
-            model_id = "6bef9f1b-29cb-40c7-b9df-32b51c1f67d3"
-            
-        
-        if select_dimensions == "Portrait":
-            height = 1024
-            width = 576
-        else:
-            height = 1024
-            width = 576
-
-
-        generation_payload = {
-            "height": height,
-            "width": width,
-            "modelId": model_id,
-            "prompt": prompt,
-            "num_images": 1,
-            "init_image_id": image_id,  # Array of image IDs as per API docs            
-            "init_strength": 0.7,
-        }
+        generation_payload = build_image_to_image_payload(prompt, image_id, parameters)
         print(generation_payload)
-        print(headers)
-        generation_response = requests.post(generation_url, json=generation_payload, headers=headers)
+        generation_response = client.create_generation(generation_payload)
         generation_response.raise_for_status()
+        lease.charge(generation_response.json()['sdGenerationJob'].get('apiCreditCost', 0))
         print("Step 3.1 done")
         
         # Step 4: Get the generated images
         generation_id = generation_response.json()['sdGenerationJob']['generationId']
-        results_url = f"https://cloud.leonardo.ai/api/rest/v1/generations/{generation_id}"
         print("Step 4 done")
         # Wait for generation to complete
-        max_attempts = 30
-        attempts = 0
-        while attempts < max_attempts:
-            time.sleep(2)  # Wait 2 seconds between checks
-            results_response = requests.get(results_url, headers=headers)
+        def fetch_status():
+            results_response = client.get_generation(generation_id)
             results_response.raise_for_status()
-            result_data = results_response.json()
-            print(result_data)
-            # Check if generation is complete
-            status = result_data.get('generations_by_pk', {}).get('status')
-            if status == "COMPLETE":
-                st.write("Generation completed successfully!")
-                return result_data
-            elif status == "FAILED":
-                st.error("Image generation failed")
-                return None
-            
-            attempts += 1
+            return results_response.json()
+        
+        policy = policy_for_model(model_type="img2img", initial_delay=2.0)
+        status, result_data = wait_for_completion(generation_id, fetch_status, policy, api_key=client.api_key)
+        if status == COMPLETE:
+            st.write("Generation completed successfully!")
+            result_data["api_key_id"] = lease.key_id
+            return result_data
+        elif status == FAILED:
+            st.error("Image generation failed")
+            return None
         
         st.warning("Generation taking longer than expected. Please check your results page later.")
         return None
         
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
+        lease_failed = is_key_error(e)
+        return None
+    except OSError as e:
+        st.error(f"Could not read the source image: {str(e)}")
         return None
+    finally:
+        lease.release(failed=lease_failed)
 
 def login_page():
     st.title("Kalki Team UI - Login")
@@ -436,6 +454,10 @@ def text_to_image_page():
         
         # Show contrast options
         contrast = st.radio("Contrast", options=["3", "3.5", "4"], index=1)
+        
+        use_cache = st.checkbox("Reuse identical previous results", value=False,
+                                help="If this exact prompt and settings were generated before, show that result "
+                                     "instead of calling the API (saves credits and time)")
     
     with tabs[2]:  # Style tab
         # Show style selection based on model type
@@ -528,59 +550,67 @@ def text_to_image_page():
         param_df = pd.DataFrame(list(param_summary.items()), columns=["Parameter", "Value"])
         st.table(param_df)
     
+    # Prepare base parameters with defaults
+    parameters = {
+        "modelId": selected_model_id,
+        "width": width,
+        "height": height,
+        "num_images": 1,  # Fixed at 1 image                
+        "contrast": contrast,
+        "enhancePrompt": True,  # Always enabled                
+    }
+    
+    # Add conditional parameters based on model type
+    if selected_style_uuid:
+        parameters["styleUUID"] = selected_style_uuid
+        
+    # Always add these for supported models
+    if selected_model_type in ["sdxl", "phoenix", "sd15"]:
+        parameters["alchemy"] = True
+    
+    if selected_model_type == "phoenix":
+        parameters["ultra"] = True
+    
+    # PhotoReal is the only toggle that remains user-controlled
+    if selected_model_type in ["sdxl", "sd15"] and 'photo_real' in locals():
+        parameters["photoReal"] = photo_real
+        if photo_real:
+            parameters["photoRealVersion"] = "v2"  # Always v2
+    
+    if selected_model_type == "sdxl" and 'preset_style_value' in locals() and preset_style_value:
+        parameters["presetStyle"] = preset_style_value
+    
+    # Clean up parameters - remove None values
+    parameters = {k: v for k, v in parameters.items() if v is not None}
+    
     # Generate button with a more prominent design
     generate_col1, generate_col2, generate_col3 = st.columns([1, 2, 1])
     with generate_col2:
         generate_button = st.button("Generate Images", type="primary", use_container_width=True)
     
+    # Many prompts at once from a CSV/JSONL file, using the settings above as defaults
+    with st.expander("Batch Generation (CSV / JSONL)"):
+        batch_generation_section(selected_project, parameters)
+    
     if generate_button:
         if not prompt:
             st.error("Please enter a prompt")
             return
             
         with st.spinner("Generating images..."):
-            # Prepare base parameters with defaults
-            parameters = {
-                "modelId": selected_model_id,
-                "width": width,
-                "height": height,
-                "num_images": 1,  # Fixed at 1 image                
-                "contrast": contrast,
-                "enhancePrompt": True,  # Always enabled                
-            }
-            
-            # Add conditional parameters based on model type
-            if selected_style_uuid:
-                parameters["styleUUID"] = selected_style_uuid
-                
-            # Always add these for supported models
-            if selected_model_type in ["sdxl", "phoenix", "sd15"]:
-                parameters["alchemy"] = True
-            
-            if selected_model_type == "phoenix":
-                parameters["ultra"] = True
-            
-            # PhotoReal is the only toggle that remains user-controlled
-            if selected_model_type in ["sdxl", "sd15"] and 'photo_real' in locals():
-                parameters["photoReal"] = photo_real
-                if photo_real:
-                    parameters["photoRealVersion"] = "v2"  # Always v2
-            
-            if selected_model_type == "sdxl" and 'preset_style_value' in locals() and preset_style_value:
-                parameters["presetStyle"] = preset_style_value
-                
-                       
-            # Clean up parameters - remove None values
-            parameters = {k: v for k, v in parameters.items() if v is not None}
-            
             # Call API
             # st.write("Sending request with parameters:", json.dumps(parameters, indent=2))
-            result, apiCreditCost = leonardo_text_to_image(prompt, parameters)
+            result, apiCreditCost = leonardo_text_to_image(prompt, parameters, use_cache=use_cache,
+                                                           username=st.session_state.user['username'])
             
 
             if result:
+                # A result shared with an identical in-flight request was already charged and logged
+                shared_result = result.get("shared_result", False)
+                
                 # Update usage
-                update_user_usage(st.session_state.user['username'], int(apiCreditCost))
+                if not shared_result:
+                    update_user_usage(st.session_state.user['username'], int(apiCreditCost))
                 
                 # Display results
                 st.subheader("Generated Images")
@@ -590,6 +620,9 @@ def text_to_image_page():
                 generated_images = generation_data.get("generated_images", [])
                 
                 if generated_images:
+                    # Fetch every image concurrently (served from cache on reruns)
+                    image_bytes = get_image_fetcher().get_many(img.get("url") for img in generated_images)
+                    
                     # Settings for the gallery display
                     if len(generated_images) <= 2:
                         cols = st.columns(len(generated_images))
@@ -598,10 +631,10 @@ def text_to_image_page():
                                 st.write(img_data)
                                 img_url = img_data.get("url")
                                 if img_url:
-                                    st.image(img_url, use_container_width=True)
+                                    st.image(image_bytes.get(img_url) or img_url, use_container_width=True)
                                     st.download_button(
                                         label="Download",
-                                        data=requests.get(img_url).content,
+                                        data=get_image_fetcher().loader(img_url),
                                         file_name=f"generation_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{i}.png",
                                         mime="image/png"
                                     )
@@ -617,10 +650,10 @@ def text_to_image_page():
                                     img_url = img_data.get("url")
                                     if img_url:
                                         with row_cols[col]:
-                                            st.image(img_url, use_container_width=True)
+                                            st.image(image_bytes.get(img_url) or img_url, use_container_width=True)
                                             st.download_button(
                                                 label="Download",
-                                                data=requests.get(img_url).content,
+                                                data=get_image_fetcher().loader(img_url),
                                                 file_name=f"generation_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{idx}.png",
                                                 mime="image/png"
                                             )
@@ -637,22 +670,344 @@ def text_to_image_page():
                             st.success(f"Preset '{preset_name}' saved!")
                     
                     # Log the generation
-                    log_generation(
-                        username=st.session_state.user['username'],
-                        prompt=prompt,
-                        source_image_path=None,
-                        generation_type="text_to_image",
-                        project=selected_project,
-                        parameters=parameters,
-                        result_images=generated_images,
-                        apiCreditCost=apiCreditCost
-                    )
+                    if not shared_result:
+                        log_generation(
+                            username=st.session_state.user['username'],
+                            prompt=prompt,
+                            source_image_path=None,
+                            generation_type="text_to_image",
+                            project=selected_project,
+                            parameters=parameters,
+                            result_images=generated_images,
+                            apiCreditCost=apiCreditCost,
+                            api_key_id=result.get("api_key_id")
+                        )
                 else:
                     st.error("No images were generated. Please try again.")
             else:
                 st.error("Generation failed. Please check the parameters and try again.")
 
+def batch_generation_section(selected_project, base_parameters):
+    """Upload a CSV/JSONL of prompts and generate them concurrently"""
+    st.caption("One row per prompt. A `prompt` column is required; any of "
+               "`model`, `style`, `preset`, `width`, `height`, `contrast`, `seed`, "
+               "`alchemy`, `ultra`, `photoReal` override the settings above for that row.")
+    
+    batch_file = st.file_uploader("Upload prompts", type=["csv", "jsonl", "json"], key="batch_file")
+    concurrency = st.slider("Concurrent generations", 1, 16, DEFAULT_CONCURRENCY, key="batch_concurrency")
+    make_renditions = st.checkbox("Create renditions of every result", key="batch_renditions")
+    
+    if not batch_file:
+        return
+    
+    try:
+        rows = parse_batch_file(batch_file.getvalue(), batch_file.name)
+    except (ValueError, json.JSONDecodeError) as e:
+        st.error(f"Could not read batch file: {str(e)}")
+        return
+    
+    st.write(f"{len(rows)} prompts loaded")
+    
+    if not st.button("Run Batch", type="primary", disabled=not rows):
+        return
+    
+    username = st.session_state.user['username']
+    daily_quota = st.session_state.user["daily_quota"]
+    
+    # Live per-row progress grid
+    grid = pd.DataFrame({
+        "Prompt": [row["prompt"][:80] for row in rows],
+        "Status": [BATCH_QUEUED] * len(rows),
+        "API Credits": ["0"] * len(rows),
+        "Image": [""] * len(rows),
+    })
+    grid_placeholder = st.empty()
+    grid_placeholder.dataframe(grid, use_container_width=True)
+    
+    def credits_left():
+        usage = get_user_usage(username)
+        return daily_quota - (usage["used_today"] if usage else 0)
+    
+    def on_update(index, status, result, apiCreditCost):
+        grid.loc[index, "Status"] = status
+        grid.loc[index, "API Credits"] = str(apiCreditCost)
+        
+        # Charge quota as each row finishes - failed rows too, once their submit was accepted
+        if int(apiCreditCost or 0):
+            update_user_usage(username, int(apiCreditCost))
+        
+        if result:
+            generated_images = result.get("generations_by_pk", {}).get("generated_images", [])
+            grid.loc[index, "Image"] = generated_images[0].get("url", "") if generated_images else ""
+            
+            # Log as each result lands
+            generation_id = log_generation(
+                username=username,
+                prompt=rows[index]["prompt"],
+                source_image_path=None,
+                generation_type="text_to_image",
+                project=selected_project,
+                parameters={**base_parameters, **rows[index]["overrides"]},
+                result_images=generated_images,
+                apiCreditCost=apiCreditCost,
+                api_key_id=result.get("api_key_id")
+            )
+            if make_renditions:
+                submit_renditions(generation_id, [img["url"] for img in generated_images if img.get("url")])
+        
+        grid_placeholder.dataframe(grid, use_container_width=True)
+    
+    outcomes = run_batch(get_key_pool(), rows, base_parameters, concurrency=concurrency,
+                         on_update=on_update, quota=QuotaReservations(credits_left))
+    
+    done = sum(1 for outcome in outcomes if outcome["status"] == BATCH_DONE)
+    st.success(f"Batch finished: {done}/{len(rows)} prompts generated")
+
+def save_source_image(source_image):
+    """Keep a copy of an uploaded source image under uploads/ and return its path"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    source_path = f"uploads/{st.session_state.user['username']}_{timestamp}.png"
+    os.makedirs("uploads", exist_ok=True)
+    with open(source_path, "wb") as f:
+        source_image.seek(0)
+        f.write(source_image.read())
+    return source_path
+
+def image_to_image_fanout_section(selected_project, source_image, base_parameters):
+    """Many prompts and/or strengths against one uploaded source image, generated concurrently"""
+    st.caption("One prompt per line. Every prompt is generated at every strength; "
+               "the source image is uploaded only once.")
+    
+    prompts_text = st.text_area("Prompts", height=120, key="fanout_prompts")
+    strengths_text = st.text_input("Init strengths (comma-separated, 0.1-0.9)", "0.3, 0.5, 0.7",
+                                   key="fanout_strengths")
+    concurrency = st.slider("Concurrent generations", 1, 16, DEFAULT_CONCURRENCY, key="fanout_concurrency")
+    
+    try:
+        strengths = parse_strengths(strengths_text)
+    except ValueError as e:
+        st.error(f"Invalid strengths: {str(e)}")
+        return
+    
+    variants = build_fanout_variants(prompts_text.splitlines(), strengths)
+    if len(variants) > MAX_FANOUT_VARIANTS:
+        st.error(f"{len(variants)} variants requested - at most {MAX_FANOUT_VARIANTS} can run at once")
+        return
+    st.write(f"{len(variants)} variants")
+    
+    if not st.button("Run Variations", type="primary", disabled=not variants):
+        return
+    
+    username = st.session_state.user['username']
+    daily_quota = st.session_state.user["daily_quota"]
+    
+    try:
+        source_image.seek(0)
+        init_image = preprocess_init_image(source_image.read()).getvalue()
+    except OSError as e:
+        st.error(f"Could not read the source image: {str(e)}")
+        return
+    image_hash = init_image_hash(io.BytesIO(init_image))
+    source_path = save_source_image(source_image)
+    
+    # Result grid - each cell fills in as soon as its variant completes
+    columns = st.columns(min(len(variants), 4))
+    cells = []
+    for index, variant in enumerate(variants):
+        with columns[index % len(columns)]:
+            strength = variant["overrides"].get("init_strength")
+            st.caption(variant["prompt"][:60] + (f" · strength {strength}" if strength is not None else ""))
+            cells.append(st.empty())
+            cells[index].info(BATCH_QUEUED)
+    
+    def credits_left():
+        usage = get_user_usage(username)
+        return daily_quota - (usage["used_today"] if usage else 0)
+    
+    def on_update(index, status, result, apiCreditCost):
+        # Charge quota as each variant finishes - failed ones too, once their submit was accepted
+        if int(apiCreditCost or 0):
+            update_user_usage(username, int(apiCreditCost))
+        
+        if not result:
+            cells[index].info(status)
+            return
+        
+        generated_images = result.get("generations_by_pk", {}).get("generated_images", [])
+        img_url = generated_images[0].get("url") if generated_images else None
+        if img_url:
+            cells[index].image(get_image_fetcher().get(img_url) or img_url, use_container_width=True)
+        else:
+            cells[index].warning("No image returned")
+        
+        # Log as each result lands
+        log_generation(
+            username=username,
+            prompt=variants[index]["prompt"],
+            source_image_path=source_path,
+            generation_type="image_to_image",
+            project=selected_project,
+            parameters={**base_parameters, **variants[index]["overrides"]},
+            result_images=generated_images,
+            apiCreditCost=apiCreditCost,
+            api_key_id=result.get("api_key_id")
+        )
+    
+    outcomes = run_image_to_image_fanout(
+        get_key_pool(), init_image, source_image.name, variants, base_parameters,
+        concurrency=concurrency, on_update=on_update, quota=QuotaReservations(credits_left),
+        lookup_init_image=lambda key_id: get_init_image_id(image_hash, key_id),
+        store_init_image=lambda key_id, init_image_id: store_init_image_id(image_hash, key_id, init_image_id)
+    )
+    
+    done = sum(1 for outcome in outcomes if outcome["status"] == BATCH_DONE)
+    st.success(f"Variations finished: {done}/{len(variants)} generated")
+
+def bulk_image_to_image_section(selected_project, select_model):
+    """Restyle many source images with one prompt through the upload/generate/download pipeline"""
+    st.caption("Every image is restyled with the same prompt. Running the same images and prompt "
+               "again resumes an interrupted run - finished images are not generated twice.")
+    
+    source_files = st.file_uploader("Upload Source Images", type=["png", "jpg", "jpeg", "webp"],
+                                    accept_multiple_files=True, key="bulk_sources")
+    prompt = st.text_area("Prompt for every image", height=100, key="bulk_prompt")
+    
+    if not source_files:
+        return
+    if not st.button("Restyle All", type="primary", disabled=not prompt):
+        return
+    
+    username = st.session_state.user['username']
+    daily_quota = st.session_state.user["daily_quota"]
+    parameters = {"select_model": select_model}
+    
+    items = [bulk_img2img.bulk_item(f.name, data=f.getvalue()) for f in source_files]
+    job_id = bulk_img2img.bulk_job_id(prompt, parameters, scope=username)
+    
+    # Live per-image progress grid
+    grid = pd.DataFrame({
+        "Image": [item["name"] for item in items],
+        "Status": [bulk_img2img.QUEUED] * len(items),
+        "API Credits": ["0"] * len(items),
+        "Result": [""] * len(items),
+    })
+    grid_placeholder = st.empty()
+    grid_placeholder.dataframe(grid, use_container_width=True)
+    
+    def credits_left():
+        usage = get_user_usage(username)
+        return daily_quota - (usage["used_today"] if usage else 0)
+    
+    def on_update(index, status, outcome):
+        grid.loc[index, "Status"] = status
+        grid.loc[index, "API Credits"] = str(outcome["apiCreditCost"])
+        grid.loc[index, "Result"] = outcome.get("result_url") or outcome.get("error") or ""
+        
+        # Charge quota as soon as a submit spends credits - a failed job is resumed, not paid for again
+        if status == bulk_img2img.SUBMITTED:
+            update_user_usage(username, int(outcome["apiCreditCost"]))
+        # Log as each result lands (items resumed from an earlier run were logged then)
+        if status == bulk_img2img.DONE and not outcome.get("resumed"):
+            log_generation(
+                username=username,
+                prompt=prompt,
+                source_image_path=items[index]["name"],
+                generation_type="image_to_image",
+                project=selected_project,
+                parameters=parameters,
+                result_images=[{"url": outcome["result_url"]}],
+                apiCreditCost=outcome["apiCreditCost"],
+                api_key_id=outcome.get("api_key_id")
+            )
+        
+        grid_placeholder.dataframe(grid, use_container_width=True)
+    
+    outcomes = bulk_img2img.run_bulk_image_to_image(
+        db_helper, job_id, items, prompt, parameters,
+        key_pool=get_key_pool(), on_update=on_update, quota=QuotaReservations(credits_left)
+    )
+    
+    done = sum(1 for outcome in outcomes if outcome["status"] == bulk_img2img.DONE)
+    st.success(f"Bulk run finished: {done}/{len(items)} images restyled")
+
+def upscale_section(selected_project, source_image, db):
+    """Tiled high-resolution upscale of the source image (4K and beyond)"""
+    st.caption("The image is split into overlapping tiles, each tile is regenerated with fine detail "
+               "and the tiles are blended back together. Failed tiles are retried on their own.")
+    
+    prompt = st.text_area("Describe the image", height=80, key="upscale_prompt")
+    long_side = st.selectbox("Long side (pixels)", [2048, 3072, 4096, 6144], index=2, key="upscale_long_side")
+    concurrency = st.slider("Concurrent tiles", 1, 16, DEFAULT_CONCURRENCY, key="upscale_concurrency")
+    
+    if not st.button("Upscale", type="primary", disabled=not prompt, key="upscale_run"):
+        return
+    
+    username = st.session_state.user['username']
+    daily_quota = st.session_state.user["daily_quota"]
+    source_image.seek(0)
+    source = source_image.read()
+    
+    progress = st.progress(0.0, text="Splitting into tiles...")
+    states = {}
+    charged = []
+    
+    def credits_left():
+        usage = get_user_usage(username)
+        return daily_quota - (usage["used_today"] if usage else 0)
+    
+    def on_update(index, status, outcome):
+        states[index] = status
+        # Charge quota as each tile is submitted (tiles submitted in an earlier run were charged then)
+        if status == upscale.bulk_img2img.SUBMITTED:
+            update_user_usage(username, int(outcome["apiCreditCost"]))
+            charged.append(int(outcome["apiCreditCost"]))
+        done = sum(1 for s in states.values() if s == upscale.bulk_img2img.DONE)
+        progress.progress(min(1.0, done / tile_total), text=f"{done}/{tile_total} tiles done")
+    
+    try:
+        tile_total = upscale.tile_count(source, long_side)
+        result = upscale.run_upscale(db, source, prompt, long_side=long_side, parameters={"select_model": "Creative"},
+                                     key_pool=get_key_pool(), concurrency=concurrency, on_update=on_update,
+                                     quota=QuotaReservations(credits_left), scope=username)
+    except OSError as e:
+        st.error(f"Could not read the source image: {str(e)}")
+        return
+    progress.empty()
+    
+    if result["path"] is None:
+        skipped = sum(1 for tile in result["tiles"] if tile["status"] == upscale.bulk_img2img.SKIPPED)
+        if skipped:
+            st.error(f"Daily quota reached: {skipped} of {len(result['tiles'])} tiles were not submitted. "
+                     "Run the upscale again once you have quota left to generate only those tiles.")
+        else:
+            st.error(f"{len(result['failed'])} of {len(result['tiles'])} tiles could not be generated. "
+                     "Run the upscale again to retry only those tiles.")
+        return
+    
+    width, height = result["size"]
+    st.image(result["path"], caption=f"Upscaled to {width}×{height}", use_container_width=True)
+    st.download_button(
+        f"Download {width}×{height} PNG",
+        data=file_loader(result["path"]),
+        file_name=f"upscale_{result['job_id'][:12]}.png",
+        mime="image/png",
+        key="upscale_download"
+    )
+    log_generation(
+        username=username,
+        prompt=prompt,
+        source_image_path=save_source_image(source_image),
+        generation_type="upscale",
+        project=selected_project,
+        parameters={"long_side": long_side, "width": width, "height": height, "tiles": len(result["tiles"])},
+        # The stitched PNG is the result - the tiles are only intermediates
+        result_images=[{"url": result["url"]}],
+        apiCreditCost=sum(charged),
+        mirror_paths=[result["mirror_path"]]
+    )
+
 def image_to_image_page():
+
     st.title("Image to Image Generator (Coming Soon)")
     
     # Project selection
@@ -680,6 +1035,14 @@ def image_to_image_page():
             num_images = 1
             select_dimensions = st.selectbox("Select Dimensions", ["Portrait", "Landscape"])
             select_model = st.selectbox("Select Style", ["Raja Ravi Varma", "Creative"])
+        
+        # One upload, many prompts and strengths at once
+        with st.expander("Variations (many prompts / strengths)"):
+            image_to_image_fanout_section(selected_project, source_image, {"select_model": select_model})
+        
+        # Print-size output from the img2img tile size
+        with st.expander("Upscale (tiled, 4K+)"):
+            upscale_section(selected_project, source_image, db_helper)
 
         # Check quota before generation
         usage = get_user_usage(st.session_state.user['username'])
@@ -719,24 +1082,16 @@ def image_to_image_page():
                     image_urls = result.get("generations_by_pk", {}).get("generated_images", [])
                     
                     if image_urls:
+                        image_bytes = get_image_fetcher().get_many(img.get("url") for img in image_urls)
                         cols = st.columns(len(image_urls))
                         for i, img_data in enumerate(image_urls):
                             with cols[i]:
                                 img_url = img_data.get("url")
-                                st.image(img_url, use_container_width=True)
+                                st.image(image_bytes.get(img_url) or img_url, use_container_width=True)
                                 st.markdown(f"[Download]({img_url})")
                         
                         # Save source image to disk and get path
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        source_path = f"uploads/{st.session_state.user['username']}_{timestamp}.png"
-                        
-                        # Ensure directory exists
-                        os.makedirs("uploads", exist_ok=True)
-                        
-                        # Save the file
-                        with open(source_path, "wb") as f:
-                            source_image.seek(0)
-                            f.write(source_image.read())
+                        source_path = save_source_image(source_image)
                         
                         # Log the generation
                         log_generation(
@@ -747,13 +1102,97 @@ def image_to_image_page():
                             project=selected_project,
                             parameters=parameters,
                             result_images=image_urls,
-                            apiCreditCost=len(image_urls)*15
+                            apiCreditCost=len(image_urls)*15,
+                            api_key_id=result.get("api_key_id")
                         )
                     
                     else:
                         st.error("No images were generated. Please try again.")
     else:
         st.info("Please upload a source image to continue")
+    
+    # Whole folders of reference images (e.g. every storyboard frame) with one prompt
+    with st.expander("Bulk Restyle (many images)"):
+        bulk_image_to_image_section(selected_project, st.selectbox("Bulk Style", ["Raja Ravi Varma", "Creative"],
+                                                                   key="bulk_style"))
+
+def zip_export_section(generations, export_name, export_key):
+    """Build a ZIP of the listed generations' images (with a manifest) and offer it for download"""
+    export = st.session_state.get("zip_export")
+    if st.button("Download project as ZIP", key="zip_export_build", disabled=not generations):
+        if export:
+            remove_export(export["path"])
+        progress = st.progress(0.0, text="Collecting images...")
+        path, counts = export_to_temp_file(
+            generations,
+            on_progress=lambda done, total: progress.progress(done / max(total, 1), text=f"{done}/{total} images")
+        )
+        progress.empty()
+        export = st.session_state.zip_export = {"key": export_key, "path": path, **counts}
+    
+    # The archive is on disk; it is only read when the save button is clicked
+    if export and export["key"] == export_key and os.path.exists(export["path"]):
+        if export["missing"]:
+            st.warning(f"{export['missing']} images could not be fetched - they are listed in the manifest without a file")
+        st.download_button(
+            f"Save ZIP ({export['images']} images)",
+            data=file_loader(export["path"]),
+            file_name=f"{export_name}.zip",
+            mime="application/zip",
+            key="zip_export_download"
+        )
+
+def renditions_section(generation_id, image_urls, mirror_paths):
+    """Create the channel renditions (social, 1080p, print...) of a generation and offer them for download"""
+    if st.button("Create Renditions", key=f"renditions_{generation_id}", disabled=not image_urls):
+        with st.spinner("Rendering..."):
+            submit_renditions(generation_id, image_urls, mirror_paths).result()
+    
+    for name, path in list_renditions(generation_id):
+        st.download_button(
+            f"Download {name}",
+            data=file_loader(path),
+            file_name=f"generation_{generation_id}_{name}",
+            mime=rendition_mime(name),
+            key=f"rendition_{generation_id}_{name}"
+        )
+
+def duplicate_caption(duplicate_of, history_df):
+    """Who made the earlier generation a result was flagged as a near-duplicate of"""
+    earlier = history_df[history_df['id'] == duplicate_of['generation_id']]
+    if len(earlier) == 0:
+        return f"generation {duplicate_of['generation_id']}"
+    return f"{earlier.iloc[0]['username']}'s generation from {earlier.iloc[0]['timestamp']}"
+
+def similar_images_section(generation_id, hashes, history_df):
+    """Find the closest images in the perceptual hash index, previewed from their thumbnails"""
+    if not any(hashes):
+        st.caption("Similar-image search is available once this generation has been hashed")
+        return
+    if not st.toggle("Find similar", key=f"similar_{generation_id}"):
+        return
+    
+    matches = find_similar(get_hash_index(get_perceptual_hashes), hashes, exclude=generation_id)
+    rows = history_df.set_index('id')
+    matches = [match for match in matches if match[0] in rows.index]
+    if not matches:
+        st.caption("No similar images found")
+        return
+    
+    columns = st.columns(4)
+    for position, (match_id, image, distance) in enumerate(matches):
+        row = rows.loc[match_id]
+        image_urls = json.loads(row['result_url'] or "[]")
+        thumbnails = json.loads(row['thumbnails'] or "[]")
+        mirror_paths = json.loads(row['mirror_paths'] or "[]")
+        preview = load_thumbnail(thumbnails[image]) if image < len(thumbnails) else None
+        with columns[position % len(columns)]:
+            if preview:
+                st.image(preview, use_container_width=True)
+            elif image < len(image_urls):
+                st.image(image_source(mirror_paths[image] if image < len(mirror_paths) else None, image_urls[image]),
+                         use_container_width=True)
+            st.caption(f"{row['username']} - {row['timestamp']} - distance {distance}")
 
 def history_page():
     st.title("Generation History")
@@ -761,7 +1200,8 @@ def history_page():
     # Get all generations (for both admin and regular users)
     query = """
      SELECT g.id, g.username, g.prompt, g.generation_type, g.project, 
-            g.parameters, g.result_url, g.timestamp, g.apiCreditCost
+            g.parameters, g.result_url, g.timestamp, g.apiCreditCost, g.thumbnails, g.placeholders, g.mirror_paths,
+            g.perceptual_hashes, g.duplicate_of
      FROM generations g
      ORDER BY g.timestamp DESC
      """
@@ -803,10 +1243,65 @@ def history_page():
             filtered_df = filtered_df[filtered_df['username'] == selected_user]
         
         st.markdown(f"Showing {len(filtered_df)} of {len(df)} generations")
+        
+        # Every image of the current filter in one archive, instead of one download per image
+        export_generations = []
+        for _, row in filtered_df.iterrows():
+            try:
+                image_urls = json.loads(row['result_url']) or []
+            except (TypeError, json.JSONDecodeError):
+                image_urls = []
+            export_generations.append({
+                "id": row['id'],
+                "project": row['project'],
+                "username": row['username'],
+                "generation_type": row['generation_type'],
+                "prompt": row['prompt'],
+                "parameters": json.loads(row['parameters'] or "{}"),
+                "timestamp": row['timestamp'],
+                "apiCreditCost": row['apiCreditCost'],
+                "image_urls": image_urls,
+                "mirror_paths": json.loads(row['mirror_paths'] or "[]"),
+            })
+        export_name = f"{selected_project if selected_project != 'All Projects' else 'all_projects'}_{datetime.now():%Y%m%d}"
+        zip_export_section(export_generations, export_name,
+                           json.dumps([selected_project, selected_type, selected_user, len(filtered_df)]))
+        view = st.radio("View", ["List", "Contact sheet"], horizontal=True, key="history_view")
         st.divider()
         
+        listed_df = filtered_df
+        if view == "Contact sheet":
+            # The whole filter as one or a few composed images instead of an st.image per generation
+            sheet_entries = []
+            for _, row in filtered_df.iterrows():
+                thumbnails = json.loads(row['thumbnails'] or "[]")
+                placeholders = json.loads(row['placeholders'] or "[]")
+                metadata = json.loads(row['parameters'] or "{}").get("display_metadata", {})
+                sheet_entries.append({
+                    "id": row['id'],
+                    "thumbnail": thumbnails[0] if thumbnails else None,
+                    "placeholder": placeholders[0] if placeholders else None,
+                    "caption": [row['username'], metadata.get("model_name", "Unknown Model"), row['timestamp']],
+                })
+            if len(sheet_entries) > SHEET_MAX_ITEMS:
+                st.caption(f"Contact sheets show the latest {SHEET_MAX_ITEMS} generations - narrow the filter to see the rest")
+            with st.spinner("Composing contact sheet..."):
+                sheets = get_contact_sheets(sheet_entries, json.dumps([selected_project, selected_type, selected_user]))
+            for sheet in sheets:
+                st.image(sheet, use_container_width=True)
+            listed_df = filtered_df.iloc[:0]
+        
+        # Rows are previewed from their thumbnails; rows without one (or a mirror) yet
+        # get their first image fetched concurrently. Full downloads are only read when clicked
+        fetcher = get_image_fetcher()
+        for result_url in listed_df[listed_df['thumbnails'].isna() & listed_df['mirror_paths'].isna()]['result_url']:
+            try:
+                fetcher.prefetch(json.loads(result_url)[:1])
+            except (TypeError, json.JSONDecodeError):
+                pass
+        
         # Use an expander for each generation
-        for i, row in filtered_df.iterrows():
+        for i, row in listed_df.iterrows():
             
 
             # Parse parameters to get metadata
@@ -820,8 +1315,16 @@ def history_page():
             username = row['username']
             
             expander_title = f"{username} - {model_name} - {dimensions} - {timestamp}"
+            # Set when the images were hashed: a near-duplicate of an earlier result
+            duplicate_of = json.loads(row['duplicate_of']) if isinstance(row['duplicate_of'], str) else None
+            if duplicate_of:
+                expander_title += " - possible duplicate"
             
             with st.expander(expander_title):
+                if duplicate_of:
+                    st.warning(f"Possible duplicate of {duplicate_caption(duplicate_of, df)} "
+                               f"({duplicate_of['distance']} hash bits apart)")
+                
                 # Display in columns - image(s) on left, details on right
                 img_col, details_col = st.columns([2, 3])
                 
@@ -830,14 +1333,26 @@ def history_page():
                     try:
                         image_urls = json.loads(row['result_url'])
                         if image_urls and len(image_urls) > 0:
-                            # Display the first image
-                            st.image(image_urls[0], use_container_width=True)
+                            # Display the first image - thumbnail (or its placeholder) unless
+                            # the full size is asked for
+                            thumbnails = json.loads(row['thumbnails'] or "[]")
+                            placeholders = json.loads(row['placeholders'] or "[]")
+                            # Local copies, preferred over the (expiring) CDN links
+                            mirror_paths = json.loads(row['mirror_paths'] or "[]")
+                            mirror_paths += [None] * (len(image_urls) - len(mirror_paths))
+                            preview = load_thumbnail(thumbnails[0]) if thumbnails else None
+                            preview = preview or (placeholders[0] if placeholders else None)
+                            
+                            if preview and not st.toggle("Full size", key=f"full_size_{row['id']}"):
+                                st.image(preview, use_container_width=True)
+                            else:
+                                st.image(image_source(mirror_paths[0], image_urls[0]), use_container_width=True)
                             
                             # Add download buttons for all images
                             for idx, img_url in enumerate(image_urls):
                                 st.download_button(
                                     f"Download Image",
-                                    data=requests.get(img_url).content,
+                                    data=mirror_loader(mirror_paths[idx], img_url),
                                     file_name=f"generation_{row['id']}_{idx}.png",
                                     mime="image/png",
                                     key=f"download_{row['id']}_{idx}"
@@ -882,6 +1397,15 @@ def history_page():
                         # Store settings in session state to be used on the generation page
                         st.session_state.reuse_settings = params
                         st.success("Settings saved! Go to the Text to Image tab to use these settings.")
+                    
+                    # Fixed renditions for downstream channels
+                    st.markdown("### Renditions")
+                    renditions_section(row['id'], json.loads(row['result_url'] or "[]"),
+                                       json.loads(row['mirror_paths'] or "[]"))
+                
+                # Near-duplicates and variations across the whole history, not just this filter
+                similar_images_section(row['id'], json.loads(row['perceptual_hashes'])
+                                       if isinstance(row['perceptual_hashes'], str) else [], df)
     else:
         st.info("No generations found in your history.")
         
@@ -1017,6 +1541,10 @@ def admin_usage_statistics():
         st.subheader("Generations by Project")
         st.bar_chart(project_stats.set_index('project'))
         st.dataframe(project_stats)
+    
+    # Live state of the Leonardo API key pool (keys are shown by fingerprint only)
+    st.subheader("API Keys")
+    st.dataframe(pd.DataFrame(get_key_pool().status()))
 
 def main():
     # Initialize database
@@ -0,0 +1,342 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from leonardo_async import (
+    AsyncLeonardoClient,
+    image_to_image_async,
+    leonardo_text_to_image_async,
+    upload_init_image_async,
+)
+from key_pool import KeyPool, KeyLease, is_key_error
+from model_parameters import modelIds, styleUUID, presetStyle
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 4
+# Most variants one image-to-image fan-out may submit
+MAX_FANOUT_VARIANTS = 32
+
+# Row statuses shown in the progress grid
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# Columns that can override the page's parameters, with their types
+INT_PARAMS = ["width", "height", "num_images", "seed"]
+BOOL_PARAMS = ["alchemy", "ultra", "photoReal", "enhancePrompt"]
+STR_PARAMS = ["modelId", "contrast", "styleUUID", "presetStyle", "photoRealVersion"]
+
+
+def _to_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y", "on")
+
+
+def normalize_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Turn one CSV/JSONL record into {"prompt": ..., "overrides": {...}}
+
+    Besides raw API parameter names, friendly columns are accepted:
+    ``model`` (a name from modelIds), ``style`` (a name from styleUUID) and
+    ``preset`` (a name from presetStyle). Empty cells are ignored.
+    """
+    row = {k.strip(): v for k, v in row.items() if k and v is not None and str(v).strip() != ""}
+    prompt = str(row.pop("prompt", "")).strip()
+
+    overrides = {}
+    if "model" in row:
+        overrides["modelId"] = modelIds.get(row.pop("model"))
+    if "style" in row:
+        overrides["styleUUID"] = styleUUID.get(row.pop("style"))
+    if "preset" in row:
+        overrides["presetStyle"] = presetStyle.get(row.pop("preset"))
+
+    for name in INT_PARAMS:
+        if name in row:
+            overrides[name] = int(float(row[name]))
+    for name in BOOL_PARAMS:
+        if name in row:
+            overrides[name] = _to_bool(row[name])
+    for name in STR_PARAMS:
+        if name in row:
+            overrides[name] = str(row[name])
+
+    return {"prompt": prompt, "overrides": {k: v for k, v in overrides.items() if v is not None}}
+
+
+def parse_batch_file(data: bytes, file_name: str) -> List[Dict[str, Any]]:
+    """
+    Parse an uploaded CSV or JSONL batch file
+
+    Args:
+        data (bytes): File contents
+        file_name (str): Original file name, used to detect the format
+
+    Returns:
+        List[Dict[str, Any]]: Rows as {"prompt": str, "overrides": dict};
+        rows without a prompt are dropped
+    """
+    text = data.decode("utf-8-sig")
+    if file_name.lower().endswith((".jsonl", ".json", ".ndjson")):
+        records = []
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError(f"line {number} is not a JSON object")
+            records.append(record)
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+
+    rows = [normalize_row(record) for record in records]
+    return [row for row in rows if row["prompt"]]
+
+
+def build_fanout_variants(prompts: List[str], strengths: List[float]) -> List[Dict[str, Any]]:
+    """
+    Every combination of prompt and init strength, as batch rows
+
+    Args:
+        prompts (List[str]): Prompts to try; blank ones are dropped
+        strengths (List[float]): init_strength values to try; empty keeps the default
+
+    Returns:
+        List[Dict[str, Any]]: Rows as {"prompt": str, "overrides": dict}
+    """
+    prompts = [prompt.strip() for prompt in prompts if prompt and prompt.strip()]
+    if not strengths:
+        return [{"prompt": prompt, "overrides": {}} for prompt in prompts]
+    return [{"prompt": prompt, "overrides": {"init_strength": float(strength)}}
+            for prompt in prompts for strength in strengths]
+
+
+def parse_strengths(text: str) -> List[float]:
+    """Parse a comma-separated list of init strengths, e.g. "0.3, 0.5, 0.7" (raises ValueError)"""
+    strengths = [float(value) for value in text.replace(";", ",").split(",") if value.strip()]
+    for strength in strengths:
+        if not 0.1 <= strength <= 0.9:
+            raise ValueError(f"init strength {strength} is outside 0.1-0.9")
+    return list(dict.fromkeys(strengths))
+
+
+class QuotaReservations:
+    """
+    Daily-quota bookkeeping for one batch
+
+    Credits are charged when a row finishes, so checking the quota only at
+    submit time would let every row in flight overrun it. Instead each row
+    reserves its estimated cost before it is submitted, and gives the
+    reservation back once its real cost has been charged. Until a row has
+    reported a cost the estimate is everything that is left - the first row
+    runs alone - after that it is the largest cost seen in the batch.
+    """
+
+    def __init__(self, credits_left: Callable[[], int]):
+        """
+        Args:
+            credits_left: Returns the user's remaining daily credits, read fresh
+                (quota minus what has been charged so far)
+        """
+        self._credits_left = credits_left
+        self._reserved: Dict[int, int] = {}
+        self._estimate: Optional[int] = None
+
+    def reserve(self, index: int) -> bool:
+        """Reserve a row's estimated cost; False if it does not fit right now"""
+        left = self._credits_left() - sum(self._reserved.values())
+        needed = left if self._estimate is None else self._estimate
+        if left <= 0 or needed > left:
+            return False
+        self._reserved[index] = needed
+        return True
+
+    def settle(self, index: int, apiCreditCost):
+        """Release a finished row's reservation (charge its real cost first)"""
+        self._reserved.pop(index, None)
+        cost = int(apiCreditCost or 0)
+        if cost > 0:
+            self._estimate = max(self._estimate or 0, cost)
+
+    @property
+    def pending(self) -> bool:
+        """Whether rows in flight still hold reservations"""
+        return bool(self._reserved)
+
+
+async def _run_batch(key_pool: KeyPool, rows: List[Dict[str, Any]], base_parameters: Dict[str, Any], concurrency: int,
+                     on_update: Callable, before_submit: Optional[Callable[[int], bool]],
+                     generate: Callable, quota: Optional[QuotaReservations] = None) -> List[Dict[str, Any]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    # Notified whenever a row gives its quota reservation back
+    settled = asyncio.Condition()
+    outcomes = [{"status": QUEUED, "result": None, "apiCreditCost": "0"} for _ in rows]
+    # One async client per API key the pool routes rows to
+    clients: Dict[str, AsyncLeonardoClient] = {}
+
+    async def client_for(lease: KeyLease) -> AsyncLeonardoClient:
+        client = clients.get(lease.key_id)
+        if client is None:
+            client = AsyncLeonardoClient(lease.api_key, limit_per_host=max(concurrency, 1))
+            await client.open()
+            clients[lease.key_id] = client
+        return client
+
+    async def run_one(index: int, row: Dict[str, Any]):
+        async with semaphore:
+            if before_submit is not None and not before_submit(index):
+                outcomes[index]["status"] = SKIPPED
+                on_update(index, SKIPPED, None, "0")
+                return
+            if quota is not None:
+                async with settled:
+                    while not quota.reserve(index):
+                        if not quota.pending:
+                            # Nothing in flight can free credits - the quota is used up
+                            outcomes[index]["status"] = SKIPPED
+                            on_update(index, SKIPPED, None, "0")
+                            return
+                        await settled.wait()
+
+            parameters = {**base_parameters, **row["overrides"]}
+            outcomes[index]["status"] = RUNNING
+            on_update(index, RUNNING, None, "0")
+
+            lease = None
+            lease_failed = False
+            try:
+                lease = await key_pool.acquire_async()
+                result, apiCreditCost = await generate(await client_for(lease), lease, row["prompt"], parameters)
+                lease.charge(apiCreditCost)
+                if result:
+                    result["api_key_id"] = lease.key_id
+            except Exception as e:
+                logger.error(f"Batch row {index} failed: {e}")
+                result, apiCreditCost = None, "0"
+                lease_failed = is_key_error(e)
+            finally:
+                if lease is not None:
+                    lease.release(failed=lease_failed)
+
+            status = DONE if result else FAILED
+            outcomes[index].update(status=status, result=result, apiCreditCost=apiCreditCost,
+                                   parameters=parameters)
+            # on_update charges the credits, so the reservation is only given back after it
+            on_update(index, status, result, apiCreditCost)
+            if quota is not None:
+                async with settled:
+                    quota.settle(index, apiCreditCost)
+                    settled.notify_all()
+
+    try:
+        await asyncio.gather(*(run_one(i, row) for i, row in enumerate(rows)))
+    finally:
+        for client in clients.values():
+            await client.close()
+
+    return outcomes
+
+
+def run_batch(key_pool: KeyPool, rows: List[Dict[str, Any]], base_parameters: Dict[str, Any],
+              concurrency: int = DEFAULT_CONCURRENCY, on_update: Optional[Callable] = None,
+              before_submit: Optional[Callable[[int], bool]] = None,
+              quota: Optional[QuotaReservations] = None) -> List[Dict[str, Any]]:
+    """
+    Generate every row of a batch with at most ``concurrency`` jobs in flight
+
+    Callbacks run on the calling thread (inside its event loop), so they can
+    safely update Streamlit elements and write to the database.
+
+    Each row runs on the least-loaded key of ``key_pool``, so the batch can
+    go past a single key's concurrency limit and credits.
+
+    Args:
+        key_pool (KeyPool): API keys to route rows to (key_pool.get_key_pool())
+        rows (List[Dict]): Rows from parse_batch_file
+        base_parameters (Dict): Parameters each row's overrides are applied to
+        concurrency (int): Maximum simultaneous generations
+        on_update: Called as on_update(index, status, result, apiCreditCost)
+            whenever a row changes state; charge non-zero costs there, even
+            for failed rows
+        before_submit: Called as before_submit(index) right before a row is
+            submitted; return False to skip it
+        quota (QuotaReservations): Daily credits to reserve rows against;
+            rows wait for a reservation and are skipped once none can fit
+
+    Returns:
+        List[Dict]: Per-row {"status", "result", "apiCreditCost", "parameters"};
+        results carry the "api_key_id" of the key that ran them
+    """
+    on_update = on_update or (lambda *args: None)
+
+    async def generate(client, lease, prompt, parameters):
+        return await leonardo_text_to_image_async(client, prompt, parameters)
+
+    return asyncio.run(_run_batch(key_pool, rows, base_parameters, concurrency, on_update, before_submit, generate,
+                                  quota))
+
+
+def run_image_to_image_fanout(key_pool: KeyPool, init_image: bytes, file_name: str, variants: List[Dict[str, Any]],
+                              base_parameters: Dict[str, Any], concurrency: int = DEFAULT_CONCURRENCY,
+                              on_update: Optional[Callable] = None,
+                              before_submit: Optional[Callable[[int], bool]] = None,
+                              lookup_init_image: Optional[Callable[[str], Optional[str]]] = None,
+                              store_init_image: Optional[Callable[[str, str], None]] = None,
+                              quota: Optional[QuotaReservations] = None) -> List[Dict[str, Any]]:
+    """
+    Generate many variants of one source image concurrently
+
+    The preprocessed image is uploaded once per API key (init images belong
+    to an account - normally that is a single upload) and every variant is
+    submitted against the same init_image_id. Variants that start while the
+    upload is still running wait for it instead of uploading again.
+
+    Args:
+        key_pool (KeyPool): API keys to route variants to
+        init_image (bytes): Preprocessed image (init_images.preprocess_init_image)
+        file_name (str): Source image file name
+        variants (List[Dict]): Rows from build_fanout_variants
+        base_parameters (Dict): Parameters each variant's overrides are applied to
+        concurrency (int): Maximum simultaneous generations
+        on_update, before_submit, quota: As for run_batch
+        lookup_init_image: Called as lookup_init_image(key_id) to reuse an
+            earlier upload; return its init_image_id or None
+        store_init_image: Called as store_init_image(key_id, init_image_id)
+            after a new upload
+
+    Returns:
+        List[Dict]: Per-variant {"status", "result", "apiCreditCost", "parameters"};
+        results carry the "api_key_id" of the key that ran them
+    """
+    on_update = on_update or (lambda *args: None)
+
+    async def main():
+        uploads: Dict[str, asyncio.Future] = {}
+
+        async def upload(client: AsyncLeonardoClient, key_id: str) -> str:
+            init_image_id = lookup_init_image(key_id) if lookup_init_image else None
+            if not init_image_id:
+                init_image_id = await upload_init_image_async(client, init_image, file_name)
+                if store_init_image:
+                    store_init_image(key_id, init_image_id)
+            return init_image_id
+
+        async def generate(client, lease, prompt, parameters):
+            task = uploads.get(lease.key_id)
+            if task is None:
+                task = uploads[lease.key_id] = asyncio.ensure_future(upload(client, lease.key_id))
+            # A failed upload fails every variant on that key, without retrying it per variant
+            init_image_id = await asyncio.shield(task)
+            return await image_to_image_async(client, prompt, init_image_id, parameters)
+
+        return await _run_batch(key_pool, variants, base_parameters, concurrency, on_update, before_submit, generate,
+                                quota)
+
+    return asyncio.run(main())
@@ -0,0 +1,397 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from batch import QuotaReservations
+from completion import wait_for_completion_async
+from image_store import get_image_store
+from init_images import init_image_hash, submit_preprocess
+from key_pool import KeyPool, KeyLease, get_key_pool, is_key_error
+from leonardo_async import (
+    AsyncLeonardoClient,
+    submit_image_to_image_async,
+    upload_init_image_async,
+)
+from polling import policy_for_model, COMPLETE, FAILED as GENERATION_FAILED
+
+logger = logging.getLogger(__name__)
+
+# Items in each stage at once; a full stage makes the one before it wait
+UPLOAD_CONCURRENCY = int(os.getenv("BULK_UPLOAD_CONCURRENCY", "2"))
+GENERATE_CONCURRENCY = int(os.getenv("BULK_GENERATE_CONCURRENCY", "4"))
+DOWNLOAD_CONCURRENCY = int(os.getenv("BULK_DOWNLOAD_CONCURRENCY", "4"))
+
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+# Item statuses shown in the progress grid
+QUEUED = "queued"
+UPLOADING = "uploading"
+GENERATING = "generating"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+# Statuses stored in the database, in order; an interrupted or failed item resumes after
+# the last one reached. SUBMITTED is also reported to on_update - the credits are spent then
+SUBMITTED = "submitted"
+GENERATED = "generated"
+
+
+def bulk_job_id(prompt: str, parameters: Dict[str, Any], scope: str = "") -> str:
+    """
+    Stable ID of a bulk job
+
+    Running the same prompt and parameters again (e.g. after an interruption)
+    gets the same ID, so finished items are not generated twice.
+    """
+    canonical = json.dumps({"scope": scope, "prompt": prompt, "parameters": parameters}, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def bulk_item(name: str, data: Optional[bytes] = None, path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Describe one source image, given either its bytes or a path to read it from
+
+    The item key combines the file name and content, so a renamed or edited
+    file counts as a new item.
+    """
+    if data is None:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+    else:
+        digest = hashlib.sha256(data).hexdigest()
+    return {"key": f"{name}:{digest[:16]}", "name": name, "data": data, "path": path}
+
+
+def folder_items(folder: str) -> List[Dict[str, Any]]:
+    """Every image directly inside a folder, in name order"""
+    names = sorted(n for n in os.listdir(folder) if n.lower().endswith(SOURCE_EXTENSIONS))
+    return [bulk_item(name, path=os.path.join(folder, name)) for name in names]
+
+
+def _read_source(item: Dict[str, Any]) -> bytes:
+    if item["data"] is not None:
+        return item["data"]
+    with open(item["path"], "rb") as f:
+        return f.read()
+
+
+async def _stage(inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], workers: int, downstream_workers: int,
+                 handle: Callable):
+    """Run ``workers`` copies of ``handle`` over a queue, passing what they return on to the next stage"""
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is None:
+                return
+            item = await handle(item)
+            if item is not None and outbox is not None:
+                # Blocks while the next stage is full - backpressure
+                await outbox.put(item)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        for _ in range(downstream_workers):
+            await outbox.put(None)
+
+
+async def _run_bulk(key_pool: KeyPool, db, job_id: str, items: List[Dict[str, Any]], prompt: str,
+                    parameters: Dict[str, Any], concurrency: Dict[str, int], on_update: Callable,
+                    before_submit: Optional[Callable[[int], bool]],
+                    quota: Optional[QuotaReservations] = None) -> List[Dict[str, Any]]:
+    saved = db.get_bulk_items(job_id)
+    outcomes = [{"status": QUEUED, "result_url": None, "apiCreditCost": "0"} for _ in items]
+    clients: Dict[str, AsyncLeonardoClient] = {}
+    # Notified whenever an item gives its quota reservation back
+    settled = asyncio.Condition()
+
+    async def client_for(api_key: str) -> AsyncLeonardoClient:
+        client = clients.get(api_key)
+        if client is None:
+            client = AsyncLeonardoClient(api_key, limit_per_host=max(concurrency.values()))
+            await client.open()
+            clients[api_key] = client
+        return client
+
+    def update(index: int, status: str, **fields):
+        outcomes[index].update(status=status, **fields)
+        on_update(index, status, outcomes[index])
+
+    def save(index: int, status: str, **fields):
+        db.save_bulk_item(job_id, items[index]["key"], items[index]["name"], status, **fields)
+
+    async def reserve(index: int) -> bool:
+        """Wait for the item's quota reservation; False once the quota is used up"""
+        if quota is None:
+            return True
+        async with settled:
+            while not quota.reserve(index):
+                if not quota.pending:
+                    # Nothing in flight can free credits
+                    return False
+                await settled.wait()
+        return True
+
+    async def settle(index: int, apiCreditCost="0"):
+        # on_update charges a submitted item's cost, so this runs after its SUBMITTED update
+        if quota is not None:
+            async with settled:
+                quota.settle(index, apiCreditCost)
+                settled.notify_all()
+
+    def fail(index: int, error: Exception, lease: Optional[KeyLease] = None):
+        # The stored stage is kept, so a rerun re-polls or re-downloads instead of paying again
+        logger.error(f"Bulk item {items[index]['name']} failed: {error}")
+        if lease is not None:
+            lease.release(failed=is_key_error(error))
+        db.record_bulk_error(job_id, items[index]["key"], items[index]["name"], FAILED, str(error))
+        update(index, FAILED, error=str(error))
+
+    async def upload(index: int) -> Optional[int]:
+        state = saved.get(items[index]["key"], {})
+        if state.get("status") in (SUBMITTED, GENERATED):
+            # Interrupted after submitting - pick the job up where it stopped
+            return index
+        if before_submit is not None and not before_submit(index):
+            update(index, SKIPPED)
+            return None
+        if not await reserve(index):
+            update(index, SKIPPED)
+            return None
+
+        update(index, UPLOADING)
+        lease = None
+        try:
+            lease = await key_pool.acquire_async()
+            init_image = (await asyncio.wrap_future(submit_preprocess(_read_source(items[index])))).getvalue()
+            image_hash = init_image_hash(init_image)
+            init_image_id = db.get_init_image_id(image_hash, lease.key_id)
+            if not init_image_id:
+                client = await client_for(lease.api_key)
+                init_image_id = await upload_init_image_async(client, init_image, items[index]["name"])
+                db.store_init_image_id(image_hash, lease.key_id, init_image_id)
+        except Exception as e:
+            fail(index, e, lease)
+            await settle(index)
+            return None
+        # Not held while the item waits for a generate worker - that would take
+        # slots from the generate stage. The init image belongs to this key, so
+        # generate leases the same key again.
+        lease.release()
+
+        outcomes[index].update(upload_key_id=lease.key_id, init_image_id=init_image_id)
+        return index
+
+    async def generate(index: int) -> Optional[int]:
+        state = saved.get(items[index]["key"], {})
+        if state.get("status") == GENERATED:
+            outcomes[index].update(result_url=state["result_url"], apiCreditCost=state.get("apiCreditCost") or "0",
+                                   api_key_id=state.get("api_key_id"))
+            return index
+
+        update(index, GENERATING)
+        upload_key_id = outcomes[index].pop("upload_key_id", None)
+        lease = None
+        try:
+            if upload_key_id is not None:
+                lease = await key_pool.acquire_async(key_id=upload_key_id)
+                client = await client_for(lease.api_key)
+                generation_id, apiCreditCost = await submit_image_to_image_async(
+                    client, prompt, outcomes[index].pop("init_image_id"), parameters)
+                lease.charge(apiCreditCost)
+                api_key_id = lease.key_id
+                save(index, SUBMITTED, generation_id=generation_id, api_key_id=api_key_id,
+                     apiCreditCost=apiCreditCost)
+                # The credits are spent whatever happens to the job from here - callers charge them now
+                update(index, SUBMITTED, generation_id=generation_id, apiCreditCost=apiCreditCost,
+                       api_key_id=api_key_id)
+                await settle(index, apiCreditCost)
+                update(index, GENERATING)
+            else:
+                # Resumed: wait on the job submitted before the interruption, with the key that owns it
+                generation_id, api_key_id = state["generation_id"], state.get("api_key_id")
+                apiCreditCost = state.get("apiCreditCost") or "0"
+                leonardo_client = key_pool.client_for(api_key_id)
+                if leonardo_client is None:
+                    raise KeyError(f"API key {api_key_id} of generation {generation_id} is no longer configured")
+                client = await client_for(leonardo_client.api_key)
+
+            policy = policy_for_model(model_type="img2img", initial_delay=2.0)
+            status, status_data = await wait_for_completion_async(
+                generation_id, lambda: client.get_generation(generation_id), policy, api_key=client.api_key)
+        except Exception as e:
+            fail(index, e, lease)
+            # Gives the reservation back if the submit itself failed
+            await settle(index)
+            return None
+        if lease is not None:
+            lease.release()
+
+        generated_images = (status_data or {}).get("generations_by_pk", {}).get("generated_images", [])
+        if status == GENERATION_FAILED or (status == COMPLETE and not generated_images):
+            # Leonardo gave up on the job - a rerun submits the item again
+            save(index, FAILED)
+        if status != COMPLETE or not generated_images:
+            fail(index, RuntimeError(f"generation {generation_id} ended {status} without an image"))
+            return None
+
+        result_url = generated_images[0]["url"]
+        save(index, GENERATED, result_url=result_url)
+        outcomes[index].update(result_url=result_url, apiCreditCost=apiCreditCost, api_key_id=api_key_id,
+                               generation_id=generation_id)
+        return index
+
+    async def download(index: int) -> None:
+        update(index, DOWNLOADING)
+        url = outcomes[index]["result_url"]
+        try:
+            # Result URLs are public CDN links - no API key needed
+            data = await (await client_for("")).download(url)
+            await asyncio.to_thread(get_image_store().put, url, data)
+        except Exception as e:
+            fail(index, e)
+            return None
+        # Callbacks log the item before it is marked done, so a crash in between
+        # re-downloads it rather than losing the log entry
+        update(index, DONE, data=data)
+        outcomes[index].pop("data", None)
+        save(index, DONE)
+
+    inbox: asyncio.Queue = asyncio.Queue()
+    to_generate: asyncio.Queue = asyncio.Queue(maxsize=concurrency["generate"])
+    to_download: asyncio.Queue = asyncio.Queue(maxsize=concurrency["download"])
+
+    for index, item in enumerate(items):
+        state = saved.get(item["key"], {})
+        if state.get("status") == DONE:
+            update(index, DONE, result_url=state.get("result_url"), apiCreditCost=state.get("apiCreditCost") or "0",
+                   api_key_id=state.get("api_key_id"), resumed=True)
+        else:
+            inbox.put_nowait(index)
+    for _ in range(concurrency["upload"]):
+        inbox.put_nowait(None)
+
+    try:
+        await asyncio.gather(
+            _stage(inbox, to_generate, concurrency["upload"], concurrency["generate"], upload),
+            _stage(to_generate, to_download, concurrency["generate"], concurrency["download"], generate),
+            _stage(to_download, None, concurrency["download"], 0, download),
+        )
+    finally:
+        for client in clients.values():
+            await client.close()
+
+    return outcomes
+
+
+def run_bulk_image_to_image(db, job_id: str, items: List[Dict[str, Any]], prompt: str, parameters: Dict[str, Any],
+                            key_pool: Optional[KeyPool] = None, upload_concurrency: int = UPLOAD_CONCURRENCY,
+                            generate_concurrency: int = GENERATE_CONCURRENCY,
+                            download_concurrency: int = DOWNLOAD_CONCURRENCY,
+                            on_update: Optional[Callable] = None,
+                            before_submit: Optional[Callable[[int], bool]] = None,
+                            quota: Optional[QuotaReservations] = None) -> List[Dict[str, Any]]:
+    """
+    Restyle many source images with one prompt, as a three-stage pipeline
+
+    Upload (preprocess, presign, upload), generate (submit, poll) and download
+    run side by side, each with its own worker count and a bounded queue in
+    front of it: while one image generates the next one uploads and the
+    previous result downloads, and a slow stage holds the others back instead
+    of piling up work. Progress is stored per item with db.save_bulk_item,
+    so running the same job again skips finished items and waits on jobs
+    that were already submitted instead of paying for them twice.
+
+    Callbacks run on the calling thread (inside its event loop), as for
+    batch.run_batch.
+
+    Args:
+        db: db_helper or db_helper_mongo
+        job_id (str): From bulk_job_id
+        items (List[Dict]): From bulk_item / folder_items
+        prompt (str): The text prompt applied to every image
+        parameters (Dict): Generation parameters (e.g. select_model, init_strength)
+        key_pool (KeyPool): API keys to route items to, defaults to get_key_pool()
+        upload_concurrency, generate_concurrency, download_concurrency (int): Workers per stage
+        on_update: Called as on_update(index, status, outcome) whenever an item
+            changes state. A SUBMITTED update carries the "apiCreditCost" the
+            submit spent - charge it then, as a failed or interrupted job is
+            not submitted again. A fresh DONE outcome carries the image bytes
+            in "data"; items finished in an earlier run come back with "resumed"
+        before_submit: Called as before_submit(index) before an item is
+            uploaded; return False to skip it
+        quota (QuotaReservations): Daily credits to reserve items against, as
+            for batch.run_batch; an item reserves before it is uploaded, gives
+            the reservation back once its SUBMITTED update has charged the
+            cost, and is skipped once no reservation can fit
+
+    Returns:
+        List[Dict]: Per-item {"status", "result_url", "apiCreditCost", ...}
+    """
+    concurrency = {
+        "upload": max(1, upload_concurrency),
+        "generate": max(1, generate_concurrency),
+        "download": max(1, download_concurrency),
+    }
+    return asyncio.run(_run_bulk(key_pool or get_key_pool(), db, job_id, items, prompt, parameters, concurrency,
+                                 on_update or (lambda *args: None), before_submit, quota))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Restyle every image in a folder with image-to-image")
+    parser.add_argument("folder", help="folder of source images")
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--style", default="Raja Ravi Varma", choices=["Raja Ravi Varma", "Creative"])
+    parser.add_argument("--strength", type=float, default=None, help="init strength (0.1-0.9)")
+    parser.add_argument("--out", default=None, help="folder for the results, defaults to <folder>/restyled")
+    parser.add_argument("--username", default="admin", help="user the generations are logged for")
+    parser.add_argument("--project", default="Bulk", help="project the generations are logged under")
+    parser.add_argument("--mongo", action="store_true", help="use the MongoDB database instead of SQLite")
+    args = parser.parse_args()
+
+    if args.mongo:
+        import db_helper_mongo as db
+    else:
+        import db_helper as db
+    db.init_db()
+
+    items = folder_items(args.folder)
+    out_dir = args.out or os.path.join(args.folder, "restyled")
+    os.makedirs(out_dir, exist_ok=True)
+    parameters = {"select_model": args.style}
+    if args.strength is not None:
+        parameters["init_strength"] = args.strength
+
+    def on_update(index, status, outcome):
+        name = items[index]["name"]
+        print(f"{name}: {status}")
+        if status == SUBMITTED:
+            db.update_user_usage(args.username, int(outcome["apiCreditCost"]))
+        if status == DONE and "data" in outcome:
+            extension = os.path.splitext(outcome["result_url"].split("?")[0])[1] or ".jpg"
+            with open(os.path.join(out_dir, os.path.splitext(name)[0] + extension), "wb") as f:
+                f.write(outcome["data"])
+            db.log_generation(
+                username=args.username,
+                prompt=args.prompt,
+                source_image_path=os.path.join(args.folder, name),
+                generation_type="image_to_image",
+                project=args.project,
+                parameters=parameters,
+                result_images=[{"url": outcome["result_url"]}],
+                apiCreditCost=outcome["apiCreditCost"],
+                api_key_id=outcome.get("api_key_id")
+            )
+
+    outcomes = run_bulk_image_to_image(db, bulk_job_id(args.prompt, parameters, scope=args.username), items,
+                                       args.prompt, parameters, on_update=on_update)
+    done = sum(1 for outcome in outcomes if outcome["status"] == DONE)
+    print(f"{done}/{len(items)} images restyled into {out_dir}")
@@ -0,0 +1,59 @@
+import os
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from polling import PollPolicy, wait_for_generation, wait_for_generation_async
+from webhooks import get_receiver, wait_for_callback, wait_for_callback_async
+from poller import get_poller
+
+logger = logging.getLogger(__name__)
+
+# How callers learn that a generation finished:
+#   poll    - per-generation status polling with backoff (default)
+#   webhook - wait for Leonardo's callback on the local receiver, polling
+#             only as a sparse fallback
+#   central - one background poller per API key sweeps every in-flight
+#             generation, using the bulk per-user listing where it can
+COMPLETION_MODE = os.getenv("LEONARDO_COMPLETION_MODE", "poll").lower()
+
+
+def _registry_for(api_key: Optional[str], generation_id: str):
+    """Callback registry to wait on for the configured mode, or None to poll"""
+    if COMPLETION_MODE == "webhook":
+        receiver = get_receiver()
+        if receiver is not None:
+            return receiver.registry
+    elif COMPLETION_MODE == "central" and api_key:
+        poller = get_poller(api_key)
+        poller.track(generation_id)
+        return poller.registry
+    return None
+
+
+def wait_for_completion(generation_id: str, fetch_status: Callable[[], Optional[Dict[str, Any]]],
+                        policy: PollPolicy, cancel_event=None,
+                        on_progress: Optional[Callable[[float, int], None]] = None,
+                        api_key: Optional[str] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Wait for a generation using the configured completion mode
+
+    Same contract as polling.wait_for_generation; falls back to polling when
+    the webhook receiver is unavailable, or in central mode when no
+    ``api_key`` is given.
+    """
+    registry = _registry_for(api_key, generation_id)
+    if registry is not None:
+        return wait_for_callback(registry, generation_id, fetch_status, policy,
+                                 cancel_event=cancel_event, on_progress=on_progress)
+    return wait_for_generation(fetch_status, policy, cancel_event=cancel_event, on_progress=on_progress)
+
+
+async def wait_for_completion_async(generation_id: str, fetch_status, policy: PollPolicy, cancel_event=None,
+                                    on_progress: Optional[Callable[[float, int], None]] = None,
+                                    api_key: Optional[str] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """asyncio version of wait_for_completion; ``fetch_status`` is a coroutine function"""
+    registry = _registry_for(api_key, generation_id)
+    if registry is not None:
+        return await wait_for_callback_async(registry, generation_id, fetch_status, policy,
+                                             cancel_event=cancel_event, on_progress=on_progress)
+    return await wait_for_generation_async(fetch_status, policy, cancel_event=cancel_event, on_progress=on_progress)
@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from image_store import get_image_store
+from thumbnails import load_thumbnail
+
+logger = logging.getLogger(__name__)
+
+# Sheet layout: cells per row, cells per sheet and cap on generations per request
+SHEET_COLUMNS = int(os.getenv("CONTACT_SHEET_COLUMNS", "6"))
+SHEET_ROWS = int(os.getenv("CONTACT_SHEET_ROWS", "10"))
+SHEET_MAX_ITEMS = int(os.getenv("CONTACT_SHEET_MAX_ITEMS", "300"))
+SHEET_QUALITY = int(os.getenv("CONTACT_SHEET_QUALITY", "80"))
+
+CELL_SIZE = 256
+CAPTION_LINES = 3
+LINE_HEIGHT = 16
+PADDING = 8
+BACKGROUND = (24, 24, 24)
+EMPTY_CELL = (48, 48, 48)
+TEXT_COLOR = (230, 230, 230)
+
+
+def _font() -> ImageFont.ImageFont:
+    try:
+        return ImageFont.load_default(size=13)
+    except TypeError:
+        # Pillow < 10.1 has a single fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+def _placeholder_image(data_uri: Optional[str]) -> Optional[Image.Image]:
+    if not data_uri or "," not in data_uri:
+        return None
+    return Image.open(io.BytesIO(base64.b64decode(data_uri.split(",", 1)[1])))
+
+
+def _cell_image(entry: Dict[str, Any]) -> Optional[Image.Image]:
+    """The entry's stored thumbnail, else its placeholder - never a CDN request"""
+    try:
+        data = load_thumbnail(entry.get("thumbnail"))
+        if data is not None:
+            return Image.open(io.BytesIO(data))
+        return _placeholder_image(entry.get("placeholder"))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Contact sheet cell {entry.get('id')}: {e}")
+        return None
+
+
+def _fit_text(draw: ImageDraw.ImageDraw, text: str, font, width: int) -> str:
+    """Shorten a caption line with an ellipsis until it fits the cell"""
+    text = str(text)
+    if draw.textlength(text, font=font) <= width:
+        return text
+    while text and draw.textlength(text + "…", font=font) > width:
+        text = text[:-1]
+    return text + "…"
+
+
+def compose_sheet(entries: List[Dict[str, Any]], columns: int = SHEET_COLUMNS) -> Image.Image:
+    """
+    Lay out thumbnails with their captions on one canvas
+
+    Every cell is pasted into a single image, so a sheet is one encode and
+    one request for the browser, however many generations it shows.
+    """
+    font = _font()
+    rows = max(1, math.ceil(len(entries) / columns))
+    cell_width = CELL_SIZE + 2 * PADDING
+    cell_height = CELL_SIZE + CAPTION_LINES * LINE_HEIGHT + 2 * PADDING
+    sheet = Image.new("RGB", (columns * cell_width, rows * cell_height), BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+
+    for index, entry in enumerate(entries):
+        left = (index % columns) * cell_width + PADDING
+        top = (index // columns) * cell_height + PADDING
+
+        image = _cell_image(entry)
+        if image is None:
+            draw.rectangle((left, top, left + CELL_SIZE - 1, top + CELL_SIZE - 1), fill=EMPTY_CELL)
+        else:
+            # Placeholders are a few pixels - scaled up they become the blurred preview
+            image = ImageOps.contain(image.convert("RGB"), (CELL_SIZE, CELL_SIZE), Image.BILINEAR)
+            sheet.paste(image, (left + (CELL_SIZE - image.width) // 2, top + (CELL_SIZE - image.height) // 2))
+
+        for line, text in enumerate(entry.get("caption", [])[:CAPTION_LINES]):
+            draw.text((left, top + CELL_SIZE + 2 + line * LINE_HEIGHT), _fit_text(draw, text, font, CELL_SIZE),
+                      fill=TEXT_COLOR, font=font)
+    return sheet
+
+
+def sheet_cache_key(entries: List[Dict[str, Any]], filter_key: str) -> str:
+    """
+    Cache key of a filter's sheets at the current data version
+
+    The version is the entries' IDs and thumbnail hashes, so new generations
+    or thumbnails that have landed since produce new sheets.
+    """
+    version = [(str(entry.get("id")), entry.get("thumbnail"), entry.get("caption")) for entry in entries]
+    layout = [SHEET_COLUMNS, SHEET_ROWS, SHEET_MAX_ITEMS, SHEET_QUALITY]
+    canonical = json.dumps([filter_key, layout, version], default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_contact_sheets(entries: List[Dict[str, Any]], filter_key: str) -> List[bytes]:
+    """
+    Contact sheets (JPEG bytes) of up to SHEET_MAX_ITEMS generations
+
+    Args:
+        entries (List[Dict]): Dicts with "id", "thumbnail" (image store hash),
+            "placeholder" (data URI) and "caption" (list of short lines)
+        filter_key (str): Identifies the history filter the entries come from
+
+    Returns:
+        List[bytes]: One JPEG per SHEET_COLUMNS x SHEET_ROWS generations,
+        served from the image store when this filter and data version were
+        composed before
+    """
+    entries = entries[:SHEET_MAX_ITEMS]
+    if not entries:
+        return []
+    per_sheet = SHEET_COLUMNS * SHEET_ROWS
+    count = math.ceil(len(entries) / per_sheet)
+    key = sheet_cache_key(entries, filter_key)
+    store = get_image_store()
+
+    sheets = [store.get(f"contact_sheet:{key}:{n}") for n in range(count)]
+    if all(sheet is not None for sheet in sheets):
+        return sheets
+
+    sheets = []
+    for n in range(count):
+        buffer = io.BytesIO()
+        compose_sheet(entries[n * per_sheet:(n + 1) * per_sheet]).save(buffer, "JPEG", quality=SHEET_QUALITY,
+                                                                       optimize=True)
+        store.put(f"contact_sheet:{key}:{n}", buffer.getvalue())
+        sheets.append(buffer.getvalue())
+    return sheets
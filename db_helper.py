@@ -1,8 +1,12 @@
 import sqlite3
 import hashlib
 import json
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from model_parameters import get_model_name_from_id, get_style_name_from_id
+from thumbnails import submit_thumbnails
+from mirror import submit_mirror
+from perceptual_hash import submit_hashes
 import os
 
 # Database setup
@@ -18,7 +22,25 @@ else:
     os.makedirs(".streamlit", exist_ok=True)
     DB_PATH = ".streamlit/leonardo_team.db"
 
+# Generation result cache settings
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
 
+# Identical submissions by the same user share one generation while it runs. The
+# submitter heart-beats its claim; one silent for this long was abandoned
+SINGLE_FLIGHT_STALE_AFTER = int(os.getenv("SINGLE_FLIGHT_STALE_AFTER", "30"))  # seconds
+# A finished flight still absorbs double clicks and reruns for this long
+SINGLE_FLIGHT_COMPLETE_TTL = int(os.getenv("SINGLE_FLIGHT_COMPLETE_TTL", "10"))  # seconds
+
+# Uploaded init images are reused for this long before being uploaded again
+INIT_IMAGE_TTL = int(os.getenv("INIT_IMAGE_TTL", str(7 * 24 * 3600)))  # seconds
+
+
+def _add_column(c, table, column, column_type):
+    """Add a column to an existing table unless it is already there"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
@@ -64,6 +86,83 @@ def init_db():
     )
     ''')
     
+    # Create generation result cache table if it doesn't exist
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS result_cache (
+        cache_key TEXT PRIMARY KEY,
+        payload TEXT NOT NULL,
+        generated_images TEXT NOT NULL,
+        apiCreditCost INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        last_hit TEXT NOT NULL,
+        hits INTEGER DEFAULT 0
+    )
+    ''')
+    
+    # Create in-flight generations table (single-flight de-duplication)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS inflight_generations (
+        flight_key TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        generation_id TEXT,
+        apiCreditCost INTEGER DEFAULT 0,
+        status TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''')
+    
+    # Create generation timings table (latency model history)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS generation_timings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        latency_group TEXT NOT NULL,
+        megapixels REAL NOT NULL,
+        duration REAL NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_generation_timings_group ON generation_timings (latency_group, id)")
+    
+    # Create init images table (uploaded init images by content hash, per API key)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS init_images (
+        image_hash TEXT NOT NULL,
+        api_key_id TEXT NOT NULL,
+        init_image_id TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (image_hash, api_key_id)
+    )
+    ''')
+    
+    # Create bulk items table (per-image progress of bulk image-to-image jobs, for resuming)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS bulk_items (
+        job_id TEXT NOT NULL,
+        item_key TEXT NOT NULL,
+        source_name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        generation_id TEXT,
+        api_key_id TEXT,
+        result_url TEXT,
+        apiCreditCost INTEGER,
+        updated_at TEXT NOT NULL,
+        PRIMARY KEY (job_id, item_key)
+    )
+    ''')
+    
+    # Columns added after the tables were first created
+    _add_column(c, "generations", "api_key_id", "TEXT")
+    _add_column(c, "inflight_generations", "api_key_id", "TEXT")
+    _add_column(c, "inflight_generations", "owner", "TEXT")
+    _add_column(c, "inflight_generations", "heartbeat_at", "TEXT")
+    _add_column(c, "inflight_generations", "completed_at", "TEXT")
+    _add_column(c, "generations", "thumbnails", "TEXT")
+    _add_column(c, "generations", "placeholders", "TEXT")
+    _add_column(c, "generations", "mirror_paths", "TEXT")
+    _add_column(c, "generations", "perceptual_hashes", "TEXT")
+    _add_column(c, "generations", "duplicate_of", "TEXT")
+    _add_column(c, "bulk_items", "error", "TEXT")
+    
     # Insert admin user if it doesn't exist
     c.execute("SELECT * FROM users WHERE username='admin'")
     if not c.fetchone():
@@ -143,7 +242,8 @@ def update_user_usage(username, apiCreditCost):
     conn.close()
 
 
-def log_generation(username, prompt, source_image_path, generation_type, project, parameters, result_images, apiCreditCost):
+def log_generation(username, prompt, source_image_path, generation_type, project, parameters, result_images, apiCreditCost,
+                   api_key_id=None, mirror_paths=None):
     """
     Log a generation with enhanced metadata for better history display
     
@@ -156,6 +256,9 @@ def log_generation(username, prompt, source_image_path, generation_type, project
     - parameters: Dictionary of parameters used
     - result_images: List of result image data including URLs
     - apiCreditCost: The cost of the generation in API credits
+    - api_key_id: Fingerprint of the Leonardo API key that ran it (key_pool.api_key_id)
+    - mirror_paths: Paths relative to mirror.MIRROR_DIR for results that are already
+      local files (e.g. a stitched upscale); the images are then not mirrored again
     """
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -184,10 +287,441 @@ def log_generation(username, prompt, source_image_path, generation_type, project
     
     c.execute('''
     INSERT INTO generations 
-    (username, prompt, source_image_path, generation_type, project, parameters, result_url, timestamp, apiCreditCost)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    (username, prompt, source_image_path, generation_type, project, parameters, result_url, timestamp, apiCreditCost, api_key_id,
+     mirror_paths)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (username, prompt, source_image_path, generation_type, project, 
-          json.dumps(enhanced_params), json.dumps(image_urls), timestamp, apiCreditCost))
+          json.dumps(enhanced_params), json.dumps(image_urls), timestamp, apiCreditCost, api_key_id,
+          None if mirror_paths is None else json.dumps(mirror_paths)))
+    generation_id = c.lastrowid
+    
+    conn.commit()
+    conn.close()
+    
+    # Gallery thumbnails and placeholders are built in the background
+    submit_thumbnails(image_urls, lambda thumbnails, placeholders:
+                      set_generation_thumbnails(generation_id, thumbnails, placeholders))
+    # ...and copied off the expiring CDN links into the local mirror
+    if mirror_paths is None:
+        submit_mirror(image_urls, lambda mirror_paths: set_generation_mirrors(generation_id, mirror_paths))
+    # ...and hashed for similar-image search, flagging near-duplicates of earlier results
+    submit_hashes(generation_id, image_urls, get_perceptual_hashes,
+                  lambda hashes, duplicate_of: set_generation_hashes(generation_id, hashes, duplicate_of))
+    
+    return generation_id
+
+def set_generation_thumbnails(generation_id, thumbnails, placeholders):
+    """
+    Store the gallery thumbnails of a logged generation
+    
+    Parameters:
+    - generation_id: Row ID in the generations table
+    - thumbnails: Image store content hashes, one per result image (None if missing)
+    - placeholders: Tiny placeholder data URIs, one per result image
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("UPDATE generations SET thumbnails=?, placeholders=? WHERE id=?",
+             (json.dumps(thumbnails), json.dumps(placeholders), generation_id))
+    
+    conn.commit()
+    conn.close()
+
+def get_generations_without_thumbnails(limit=100):
+    """(id, image URLs) of logged generations that have no thumbnails yet, oldest first"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("SELECT id, result_url FROM generations WHERE thumbnails IS NULL ORDER BY id LIMIT ?", (limit,))
+    rows = c.fetchall()
+    
+    conn.close()
+    return [(row[0], json.loads(row[1] or "[]")) for row in rows]
+
+def set_generation_mirrors(generation_id, mirror_paths):
+    """
+    Store where the result images of a logged generation were mirrored
+    
+    Parameters:
+    - generation_id: Row ID in the generations table
+    - mirror_paths: Paths relative to mirror.MIRROR_DIR, one per result image (None if missing)
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("UPDATE generations SET mirror_paths=? WHERE id=?", (json.dumps(mirror_paths), generation_id))
+    
+    conn.commit()
+    conn.close()
+
+def get_generations_without_mirrors(limit=100):
+    """
+    (id, image URLs, mirror paths) of logged generations with images not mirrored yet, oldest first
+    
+    Partially mirrored generations (a null among their paths) are included so
+    the missing images are retried; mirror paths is None if nothing was mirrored.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    # Paths are content hashes, so "null" in the JSON can only be a missing image
+    c.execute('''
+    SELECT id, result_url, mirror_paths FROM generations
+    WHERE mirror_paths IS NULL OR mirror_paths LIKE '%null%' ORDER BY id LIMIT ?
+    ''', (limit,))
+    rows = c.fetchall()
+    
+    conn.close()
+    return [(row[0], json.loads(row[1] or "[]"), json.loads(row[2]) if row[2] else None) for row in rows]
+
+def set_generation_hashes(generation_id, hashes, duplicate_of=None):
+    """
+    Store the perceptual hashes of a logged generation's images
+    
+    Parameters:
+    - generation_id: Row ID in the generations table
+    - hashes: {"phash", "dhash"} hex strings, one per result image (None if missing)
+    - duplicate_of: {"generation_id", "image", "distance"} of the closest earlier
+      near-duplicate (perceptual_hash.find_duplicate), or None
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("UPDATE generations SET perceptual_hashes=?, duplicate_of=? WHERE id=?",
+             (json.dumps(hashes), json.dumps(duplicate_of) if duplicate_of else None, generation_id))
+    
+    conn.commit()
+    conn.close()
+
+def get_generations_without_hashes(limit=100):
+    """(id, image URLs, mirror paths) of logged generations that are not hashed yet, oldest first"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("SELECT id, result_url, mirror_paths FROM generations WHERE perceptual_hashes IS NULL ORDER BY id LIMIT ?",
+             (limit,))
+    rows = c.fetchall()
+    
+    conn.close()
+    return [(row[0], json.loads(row[1] or "[]"), json.loads(row[2] or "[]")) for row in rows]
+
+def get_perceptual_hashes():
+    """(id, hashes) of every hashed generation, oldest first - the source of the similarity index"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("SELECT id, perceptual_hashes FROM generations WHERE perceptual_hashes IS NOT NULL ORDER BY id")
+    rows = c.fetchall()
+    
+    conn.close()
+    return [(row[0], json.loads(row[1])) for row in rows]
+
+
+def get_cached_result(cache_key):
+    """
+    Look up a cached generation result
+    
+    Parameters:
+    - cache_key: Canonical hash of the request payload
+    
+    Returns the stored generated_images list, or None on a miss/expired entry
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    now = datetime.now()
+    oldest = datetime.fromtimestamp(now.timestamp() - RESULT_CACHE_TTL).isoformat()
+    
+    c.execute("SELECT generated_images FROM result_cache WHERE cache_key=? AND created_at>=?", (cache_key, oldest))
+    row = c.fetchone()
+    
+    if row:
+        c.execute("UPDATE result_cache SET last_hit=?, hits=hits+1 WHERE cache_key=?", (now.isoformat(), cache_key))
+        conn.commit()
+    
+    conn.close()
+    
+    return json.loads(row[0]) if row else None
+
+def store_cached_result(cache_key, payload, generated_images, apiCreditCost):
+    """
+    Store a generation result in the cache, then evict expired entries and
+    the least recently used ones beyond RESULT_CACHE_MAX_ENTRIES
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    now = datetime.now()
+    oldest = datetime.fromtimestamp(now.timestamp() - RESULT_CACHE_TTL).isoformat()
+    
+    c.execute('''
+    INSERT OR REPLACE INTO result_cache 
+    (cache_key, payload, generated_images, apiCreditCost, created_at, last_hit, hits)
+    VALUES (?, ?, ?, ?, ?, ?, 0)
+    ''', (cache_key, json.dumps(payload), json.dumps(generated_images), int(apiCreditCost),
+          now.isoformat(), now.isoformat()))
+    
+    # TTL eviction
+    c.execute("DELETE FROM result_cache WHERE created_at<?", (oldest,))
+    
+    # Size eviction - keep the most recently used entries
+    c.execute('''
+    DELETE FROM result_cache WHERE cache_key NOT IN (
+        SELECT cache_key FROM result_cache ORDER BY last_hit DESC LIMIT ?
+    )
+    ''', (RESULT_CACHE_MAX_ENTRIES,))
+    
+    conn.commit()
+    conn.close()
+
+
+def claim_inflight_generation(flight_key, username):
+    """
+    Try to become the one submitter of a generation
+    
+    Parameters:
+    - flight_key: Identifies the request (user + canonical payload)
+    - username: The user submitting
+    
+    Returns an owner token if the caller should submit - pass it to the
+    other *_inflight_generation calls - or None while an identical generation
+    is in progress (its submitter still heart-beating) or finished less than
+    SINGLE_FLIGHT_COMPLETE_TTL ago
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    now = datetime.now()
+    stale = (now - timedelta(seconds=SINGLE_FLIGHT_STALE_AFTER)).isoformat()
+    expired = (now - timedelta(seconds=SINGLE_FLIGHT_COMPLETE_TTL)).isoformat()
+    owner = uuid.uuid4().hex
+    
+    # Forget abandoned claims and finished flights, then claim atomically via the primary key
+    c.execute('''
+    DELETE FROM inflight_generations
+    WHERE (status='PENDING' AND COALESCE(heartbeat_at, created_at)<?)
+       OR (status='COMPLETE' AND COALESCE(completed_at, created_at)<?)
+    ''', (stale, expired))
+    c.execute('''
+    INSERT OR IGNORE INTO inflight_generations 
+    (flight_key, username, generation_id, apiCreditCost, status, created_at, owner, heartbeat_at)
+    VALUES (?, ?, NULL, 0, 'PENDING', ?, ?, ?)
+    ''', (flight_key, username, now.isoformat(), owner, now.isoformat()))
+    claimed = c.rowcount == 1
+    
+    conn.commit()
+    conn.close()
+    return owner if claimed else None
+
+def heartbeat_inflight_generation(flight_key, owner):
+    """Keep a claim alive; returns False if the caller no longer owns it"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("UPDATE inflight_generations SET heartbeat_at=? WHERE flight_key=? AND owner=? AND status='PENDING'",
+             (datetime.now().isoformat(), flight_key, owner))
+    owned = c.rowcount == 1
+    
+    conn.commit()
+    conn.close()
+    return owned
+
+def attach_inflight_generation(flight_key, owner, generation_id, apiCreditCost, api_key_id=None):
+    """Record the Leonardo generation ID (and the key that submitted it) of the caller's claim"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    UPDATE inflight_generations SET generation_id=?, apiCreditCost=?, api_key_id=?, heartbeat_at=?
+    WHERE flight_key=? AND owner=?
+    ''', (generation_id, int(apiCreditCost), api_key_id, datetime.now().isoformat(), flight_key, owner))
+    
+    conn.commit()
+    conn.close()
+
+def get_inflight_generation(flight_key):
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("SELECT generation_id, apiCreditCost, status, api_key_id FROM inflight_generations WHERE flight_key=?", (flight_key,))
+    row = c.fetchone()
+    
+    conn.close()
+    
+    if row:
+        return {"generation_id": row[0], "apiCreditCost": row[1], "status": row[2], "api_key_id": row[3]}
+    return None
+
+def complete_inflight_generation(flight_key, owner):
+    """
+    Mark the caller's flight as finished
+    
+    It stays for SINGLE_FLIGHT_COMPLETE_TTL, so a double click shares the
+    result, and then expires so deliberate reruns generate again. Only the
+    owner charges quota and logs the generation.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    UPDATE inflight_generations SET status='COMPLETE', completed_at=?
+    WHERE flight_key=? AND owner=? AND status='PENDING'
+    ''', (datetime.now().isoformat(), flight_key, owner))
+    
+    conn.commit()
+    conn.close()
+
+def release_inflight_generation(flight_key, owner):
+    """Drop the caller's claim after a failure so the request can be retried right away"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute("DELETE FROM inflight_generations WHERE flight_key=? AND owner=? AND status='PENDING'",
+             (flight_key, owner))
+    
+    conn.commit()
+    conn.close()
+
+
+def record_generation_timing(latency_group, megapixels, duration):
+    """
+    Record how long a completed generation took
+    
+    Parameters:
+    - latency_group: Configuration key from latency.latency_group
+    - megapixels: Total megapixels requested (latency.latency_size)
+    - duration: Seconds from submit to completion
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    INSERT INTO generation_timings (latency_group, megapixels, duration, created_at)
+    VALUES (?, ?, ?, ?)
+    ''', (latency_group, megapixels, duration, datetime.now().isoformat()))
+    
+    conn.commit()
+    conn.close()
+
+def get_generation_timings(latency_group, limit=200):
+    """Most recent (megapixels, duration) pairs recorded for a configuration"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    SELECT megapixels, duration FROM generation_timings 
+    WHERE latency_group=? ORDER BY id DESC LIMIT ?
+    ''', (latency_group, limit))
+    rows = c.fetchall()
+    
+    conn.close()
+    return rows
+
+def get_init_image_id(image_hash, api_key_id):
+    """
+    Look up an init image that was already uploaded
+    
+    Parameters:
+    - image_hash: init_images.init_image_hash of the preprocessed image
+    - api_key_id: Fingerprint of the key it was uploaded with (init images belong to an account)
+    
+    Returns the Leonardo init_image_id, or None on a miss/expired entry
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    oldest = datetime.fromtimestamp(datetime.now().timestamp() - INIT_IMAGE_TTL).isoformat()
+    c.execute('''
+    SELECT init_image_id FROM init_images 
+    WHERE image_hash=? AND api_key_id=? AND created_at>=?
+    ''', (image_hash, api_key_id or "", oldest))
+    row = c.fetchone()
+    
+    conn.close()
+    return row[0] if row else None
+
+def store_init_image_id(image_hash, api_key_id, init_image_id):
+    """Remember an uploaded init image, and drop the expired ones"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    now = datetime.now()
+    oldest = datetime.fromtimestamp(now.timestamp() - INIT_IMAGE_TTL).isoformat()
+    c.execute('''
+    INSERT OR REPLACE INTO init_images (image_hash, api_key_id, init_image_id, created_at)
+    VALUES (?, ?, ?, ?)
+    ''', (image_hash, api_key_id or "", init_image_id, now.isoformat()))
+    c.execute("DELETE FROM init_images WHERE created_at<?", (oldest,))
+    
+    conn.commit()
+    conn.close()
+
+def get_bulk_items(job_id):
+    """
+    Progress of every item of a bulk image-to-image job
+    
+    Returns a dict of item_key -> {"source_name", "status", "generation_id",
+    "api_key_id", "result_url", "apiCreditCost", "error"}
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    SELECT item_key, source_name, status, generation_id, api_key_id, result_url, apiCreditCost, error 
+    FROM bulk_items WHERE job_id=?
+    ''', (job_id,))
+    rows = c.fetchall()
+    
+    conn.close()
+    return {
+        row[0]: {"source_name": row[1], "status": row[2], "generation_id": row[3],
+                 "api_key_id": row[4], "result_url": row[5], "apiCreditCost": row[6], "error": row[7]}
+        for row in rows
+    }
+
+def save_bulk_item(job_id, item_key, source_name, status, generation_id=None, api_key_id=None, result_url=None,
+                   apiCreditCost=None):
+    """Record an item's progress; fields left as None keep their stored value, a previous error is cleared"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    INSERT INTO bulk_items 
+    (job_id, item_key, source_name, status, generation_id, api_key_id, result_url, apiCreditCost, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (job_id, item_key) DO UPDATE SET 
+        status=excluded.status,
+        generation_id=COALESCE(excluded.generation_id, generation_id),
+        api_key_id=COALESCE(excluded.api_key_id, api_key_id),
+        result_url=COALESCE(excluded.result_url, result_url),
+        apiCreditCost=COALESCE(excluded.apiCreditCost, apiCreditCost),
+        error=NULL,
+        updated_at=excluded.updated_at
+    ''', (job_id, item_key, source_name, status, generation_id, api_key_id, result_url,
+          None if apiCreditCost is None else int(apiCreditCost), datetime.now().isoformat()))
+    
+    conn.commit()
+    conn.close()
+
+def record_bulk_error(job_id, item_key, source_name, status, error):
+    """
+    Record why an item failed without touching the stage it reached
+    
+    ``status`` is only stored for an item with no progress yet; one that was
+    already submitted or generated keeps that status, so the next run
+    resumes it instead of paying for it again.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    
+    c.execute('''
+    INSERT INTO bulk_items (job_id, item_key, source_name, status, error, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (job_id, item_key) DO UPDATE SET 
+        error=excluded.error,
+        updated_at=excluded.updated_at
+    ''', (job_id, item_key, source_name, status, error, datetime.now().isoformat()))
     
     conn.commit()
     conn.close()
@@ -1,8 +1,12 @@
 import pymongo
 import hashlib
 import json
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from model_parameters import get_model_name_from_id, get_style_name_from_id
+from thumbnails import submit_thumbnails
+from mirror import submit_mirror
+from perceptual_hash import submit_hashes
 import os
 from bson.objectid import ObjectId
 from pymongo import MongoClient
@@ -20,6 +24,24 @@ db = client['kalkimedia']
 users = db['users']
 projects = db['projects']
 generations = db['generations']
+result_cache = db['result_cache']
+inflight_generations = db['inflight_generations']
+generation_timings = db['generation_timings']
+init_images = db['init_images']
+bulk_items = db['bulk_items']
+
+# Generation result cache settings
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
+
+# Identical submissions by the same user share one generation while it runs. The
+# submitter heart-beats its claim; one silent for this long was abandoned
+SINGLE_FLIGHT_STALE_AFTER = int(os.getenv("SINGLE_FLIGHT_STALE_AFTER", "30"))  # seconds
+# A finished flight still absorbs double clicks and reruns for this long
+SINGLE_FLIGHT_COMPLETE_TTL = int(os.getenv("SINGLE_FLIGHT_COMPLETE_TTL", "10"))  # seconds
+
+# Uploaded init images are reused for this long before being uploaded again
+INIT_IMAGE_TTL = int(os.getenv("INIT_IMAGE_TTL", str(7 * 24 * 3600)))  # seconds
 
 
 def init_db():
@@ -29,6 +51,15 @@ def init_db():
     projects.create_index([("user_id", 1), ("name", 1)], unique=True)
     generations.create_index("user_id")
     generations.create_index("created_at")
+    result_cache.create_index("cache_key", unique=True)
+    result_cache.create_index("last_hit")
+    # MongoDB removes expired cache entries itself
+    result_cache.create_index("created_at", expireAfterSeconds=RESULT_CACHE_TTL)
+    inflight_generations.create_index("flight_key", unique=True)
+    generation_timings.create_index([("latency_group", 1), ("created_at", -1)])
+    init_images.create_index([("image_hash", 1), ("api_key_id", 1)], unique=True)
+    init_images.create_index("created_at", expireAfterSeconds=INIT_IMAGE_TTL)
+    bulk_items.create_index([("job_id", 1), ("item_key", 1)], unique=True)
     
 
 def create_user(username, password, role, daily_quota):
@@ -167,7 +198,8 @@ def update_user_usage(username, apiCreditCost):
             }
         )
 
-def log_generation(username, prompt, source_image_path, generation_type, project, parameters, result_images, apiCreditCost):
+def log_generation(username, prompt, source_image_path, generation_type, project, parameters, result_images, apiCreditCost,
+                   api_key_id=None, mirror_paths=None):
     """
     Log a generation with enhanced metadata for better history display in MongoDB
     
@@ -180,6 +212,9 @@ def log_generation(username, prompt, source_image_path, generation_type, project
     - parameters: Dictionary of parameters used
     - result_images: List of result image data including URLs
     - apiCreditCost: The cost of the generation in API credits
+    - api_key_id: Fingerprint of the Leonardo API key that ran it (key_pool.api_key_id)
+    - mirror_paths: Paths relative to mirror.MIRROR_DIR for results that are already
+      local files (e.g. a stitched upscale); the images are then not mirrored again
     """
     # Get current timestamp
     timestamp = datetime.now().isoformat()
@@ -215,14 +250,334 @@ def log_generation(username, prompt, source_image_path, generation_type, project
         "result_urls": image_urls,
         "timestamp": timestamp,
         "apiCreditCost": apiCreditCost,
+        "api_key_id": api_key_id,
         "created_at": datetime.utcnow()
     }
+    if mirror_paths is not None:
+        generation_doc["mirror_paths"] = mirror_paths
     
     # Insert the generation document
     result = generations.insert_one(generation_doc)
     
+    # Gallery thumbnails and placeholders are built in the background
+    submit_thumbnails(image_urls, lambda thumbnails, placeholders:
+                      set_generation_thumbnails(result.inserted_id, thumbnails, placeholders))
+    # ...and copied off the expiring CDN links into the local mirror
+    if mirror_paths is None:
+        submit_mirror(image_urls, lambda mirror_paths: set_generation_mirrors(result.inserted_id, mirror_paths))
+    # ...and hashed for similar-image search, flagging near-duplicates of earlier results
+    submit_hashes(result.inserted_id, image_urls, get_perceptual_hashes,
+                  lambda hashes, duplicate_of: set_generation_hashes(result.inserted_id, hashes, duplicate_of))
+    
     return result.inserted_id
 
+def set_generation_thumbnails(generation_id, thumbnails, placeholders):
+    """
+    Store the gallery thumbnails of a logged generation
+    
+    Args:
+        generation_id: _id of the generation document
+        thumbnails: Image store content hashes, one per result image (None if missing)
+        placeholders: Tiny placeholder data URIs, one per result image
+    """
+    generations.update_one(
+        {"_id": generation_id},
+        {"$set": {"thumbnails": thumbnails, "placeholders": placeholders}}
+    )
+
+def get_generations_without_thumbnails(limit=100):
+    """(_id, image URLs) of logged generations that have no thumbnails yet, oldest first"""
+    cursor = generations.find(
+        {"thumbnails": {"$exists": False}},
+        {"result_urls": 1}
+    ).sort("_id", pymongo.ASCENDING).limit(limit)
+    return [(doc["_id"], doc.get("result_urls") or []) for doc in cursor]
+
+def set_generation_mirrors(generation_id, mirror_paths):
+    """
+    Store where the result images of a logged generation were mirrored
+    
+    Args:
+        generation_id: _id of the generation document
+        mirror_paths: Paths relative to mirror.MIRROR_DIR, one per result image (None if missing)
+    """
+    generations.update_one({"_id": generation_id}, {"$set": {"mirror_paths": mirror_paths}})
+
+def get_generations_without_mirrors(limit=100):
+    """
+    (_id, image URLs, mirror paths) of logged generations with images not mirrored yet, oldest first
+    
+    Partially mirrored generations (a null among their paths) are included so
+    the missing images are retried; mirror paths is None if nothing was mirrored.
+    """
+    # Matches a missing field as well as an array with a null element
+    cursor = generations.find(
+        {"mirror_paths": None},
+        {"result_urls": 1, "mirror_paths": 1}
+    ).sort("_id", pymongo.ASCENDING).limit(limit)
+    return [(doc["_id"], doc.get("result_urls") or [], doc.get("mirror_paths")) for doc in cursor]
+
+def set_generation_hashes(generation_id, hashes, duplicate_of=None):
+    """
+    Store the perceptual hashes of a logged generation's images
+    
+    Args:
+        generation_id: _id of the generation document
+        hashes: {"phash", "dhash"} hex strings, one per result image (None if missing)
+        duplicate_of: {"generation_id", "image", "distance"} of the closest earlier
+            near-duplicate (perceptual_hash.find_duplicate), or None
+    """
+    generations.update_one(
+        {"_id": generation_id},
+        {"$set": {"perceptual_hashes": hashes, "duplicate_of": duplicate_of}}
+    )
+
+def get_generations_without_hashes(limit=100):
+    """(_id, image URLs, mirror paths) of logged generations that are not hashed yet, oldest first"""
+    cursor = generations.find(
+        {"perceptual_hashes": {"$exists": False}},
+        {"result_urls": 1, "mirror_paths": 1}
+    ).sort("_id", pymongo.ASCENDING).limit(limit)
+    return [(doc["_id"], doc.get("result_urls") or [], doc.get("mirror_paths") or []) for doc in cursor]
+
+def get_perceptual_hashes():
+    """(_id, hashes) of every hashed generation, oldest first - the source of the similarity index"""
+    cursor = generations.find(
+        {"perceptual_hashes": {"$exists": True}},
+        {"perceptual_hashes": 1}
+    ).sort("_id", pymongo.ASCENDING)
+    return [(doc["_id"], doc["perceptual_hashes"]) for doc in cursor]
+
+def get_cached_result(cache_key):
+    """
+    Look up a cached generation result in MongoDB
+    
+    Args:
+        cache_key: Canonical hash of the request payload
+    
+    Returns:
+        The stored generated_images list, or None on a miss/expired entry
+    """
+    now = datetime.utcnow()
+    
+    # The TTL monitor only runs once a minute, so check expiry here as well
+    entry = result_cache.find_one_and_update(
+        {"cache_key": cache_key, "created_at": {"$gte": now - timedelta(seconds=RESULT_CACHE_TTL)}},
+        {"$set": {"last_hit": now}, "$inc": {"hits": 1}},
+        projection={"generated_images": 1, "_id": 0}
+    )
+    
+    return entry["generated_images"] if entry else None
+
+def store_cached_result(cache_key, payload, generated_images, apiCreditCost):
+    """
+    Store a generation result in the MongoDB cache and evict the least
+    recently used entries beyond RESULT_CACHE_MAX_ENTRIES
+    
+    Args:
+        cache_key: Canonical hash of the request payload
+        payload: The request payload that was sent
+        generated_images: The generated_images list from the API
+        apiCreditCost: What the original generation cost
+    """
+    now = datetime.utcnow()
+    
+    result_cache.update_one(
+        {"cache_key": cache_key},
+        {"$set": {
+            "payload": payload,
+            "generated_images": generated_images,
+            "apiCreditCost": int(apiCreditCost),
+            "created_at": now,
+            "last_hit": now,
+            "hits": 0
+        }},
+        upsert=True
+    )
+    
+    # Size eviction - drop everything older than the Nth most recently used entry
+    overflow = result_cache.find({}, {"last_hit": 1}).sort("last_hit", pymongo.DESCENDING).skip(RESULT_CACHE_MAX_ENTRIES).limit(1)
+    for entry in overflow:
+        result_cache.delete_many({"last_hit": {"$lte": entry["last_hit"]}})
+
+def claim_inflight_generation(flight_key, username):
+    """
+    Try to become the one submitter of a generation
+    
+    Args:
+        flight_key: Identifies the request (user + canonical payload)
+        username: The user submitting
+    
+    Returns:
+        An owner token if the caller should submit - pass it to the other
+        *_inflight_generation calls - or None while an identical generation
+        is in progress (its submitter still heart-beating) or finished less
+        than SINGLE_FLIGHT_COMPLETE_TTL ago
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=SINGLE_FLIGHT_STALE_AFTER)
+    owner = uuid.uuid4().hex
+    
+    # Forget abandoned claims and finished flights, then claim atomically via the unique index
+    inflight_generations.delete_many({"$or": [
+        {"status": "PENDING", "heartbeat_at": {"$lt": stale}},
+        {"status": "PENDING", "heartbeat_at": {"$exists": False}, "created_at": {"$lt": stale}},
+        {"status": "COMPLETE", "completed_at": {"$lt": now - timedelta(seconds=SINGLE_FLIGHT_COMPLETE_TTL)}},
+    ]})
+    try:
+        inflight_generations.insert_one({
+            "flight_key": flight_key,
+            "username": username,
+            "generation_id": None,
+            "apiCreditCost": 0,
+            "status": "PENDING",
+            "owner": owner,
+            "heartbeat_at": now,
+            "created_at": now
+        })
+        return owner
+    except pymongo.errors.DuplicateKeyError:
+        return None
+
+def heartbeat_inflight_generation(flight_key, owner):
+    """Keep a claim alive; returns False if the caller no longer owns it"""
+    result = inflight_generations.update_one(
+        {"flight_key": flight_key, "owner": owner, "status": "PENDING"},
+        {"$set": {"heartbeat_at": datetime.utcnow()}}
+    )
+    return result.matched_count == 1
+
+def attach_inflight_generation(flight_key, owner, generation_id, apiCreditCost, api_key_id=None):
+    """Record the Leonardo generation ID (and the key that submitted it) of the caller's claim"""
+    inflight_generations.update_one(
+        {"flight_key": flight_key, "owner": owner},
+        {"$set": {"generation_id": generation_id, "apiCreditCost": int(apiCreditCost), "api_key_id": api_key_id,
+                  "heartbeat_at": datetime.utcnow()}}
+    )
+
+def get_inflight_generation(flight_key):
+    """
+    Get the state of a flight
+    
+    Returns:
+        Dictionary with generation_id, apiCreditCost, status and api_key_id, or None
+    """
+    return inflight_generations.find_one(
+        {"flight_key": flight_key},
+        {"generation_id": 1, "apiCreditCost": 1, "status": 1, "api_key_id": 1, "_id": 0}
+    )
+
+def complete_inflight_generation(flight_key, owner):
+    """
+    Mark the caller's flight as finished
+    
+    It stays for SINGLE_FLIGHT_COMPLETE_TTL, so a double click shares the
+    result, and then expires so deliberate reruns generate again. Only the
+    owner charges quota and logs the generation.
+    """
+    inflight_generations.update_one(
+        {"flight_key": flight_key, "owner": owner, "status": "PENDING"},
+        {"$set": {"status": "COMPLETE", "completed_at": datetime.utcnow()}}
+    )
+
+def release_inflight_generation(flight_key, owner):
+    """Drop the caller's claim after a failure so the request can be retried right away"""
+    inflight_generations.delete_one({"flight_key": flight_key, "owner": owner, "status": "PENDING"})
+
+def record_generation_timing(latency_group, megapixels, duration):
+    """
+    Record how long a completed generation took
+    
+    Args:
+        latency_group: Configuration key from latency.latency_group
+        megapixels: Total megapixels requested (latency.latency_size)
+        duration: Seconds from submit to completion
+    """
+    generation_timings.insert_one({
+        "latency_group": latency_group,
+        "megapixels": megapixels,
+        "duration": duration,
+        "created_at": datetime.utcnow()
+    })
+
+def get_generation_timings(latency_group, limit=200):
+    """Most recent (megapixels, duration) pairs recorded for a configuration"""
+    cursor = generation_timings.find(
+        {"latency_group": latency_group},
+        {"megapixels": 1, "duration": 1, "_id": 0}
+    ).sort("created_at", pymongo.DESCENDING).limit(limit)
+    return [(entry["megapixels"], entry["duration"]) for entry in cursor]
+
+def get_init_image_id(image_hash, api_key_id):
+    """
+    Look up an init image that was already uploaded
+    
+    Args:
+        image_hash: init_images.init_image_hash of the preprocessed image
+        api_key_id: Fingerprint of the key it was uploaded with (init images belong to an account)
+    
+    Returns:
+        The Leonardo init_image_id, or None on a miss/expired entry
+    """
+    # The TTL monitor only runs once a minute, so check expiry here as well
+    entry = init_images.find_one(
+        {"image_hash": image_hash, "api_key_id": api_key_id or "",
+         "created_at": {"$gte": datetime.utcnow() - timedelta(seconds=INIT_IMAGE_TTL)}},
+        {"init_image_id": 1, "_id": 0}
+    )
+    return entry["init_image_id"] if entry else None
+
+def store_init_image_id(image_hash, api_key_id, init_image_id):
+    """Remember an uploaded init image (MongoDB expires it after INIT_IMAGE_TTL)"""
+    init_images.update_one(
+        {"image_hash": image_hash, "api_key_id": api_key_id or ""},
+        {"$set": {"init_image_id": init_image_id, "created_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+def get_bulk_items(job_id):
+    """
+    Progress of every item of a bulk image-to-image job
+    
+    Returns:
+        Dict of item_key -> {"source_name", "status", "generation_id",
+        "api_key_id", "result_url", "apiCreditCost", "error"}
+    """
+    cursor = bulk_items.find({"job_id": job_id}, {"_id": 0, "job_id": 0, "updated_at": 0})
+    return {entry.pop("item_key"): entry for entry in cursor}
+
+def save_bulk_item(job_id, item_key, source_name, status, generation_id=None, api_key_id=None, result_url=None,
+                   apiCreditCost=None):
+    """Record an item's progress; fields left as None keep their stored value, a previous error is cleared"""
+    fields = {
+        "source_name": source_name,
+        "status": status,
+        "generation_id": generation_id,
+        "api_key_id": api_key_id,
+        "result_url": result_url,
+        "apiCreditCost": None if apiCreditCost is None else int(apiCreditCost),
+    }
+    update = {k: v for k, v in fields.items() if v is not None}
+    update["error"] = None
+    update["updated_at"] = datetime.utcnow()
+    bulk_items.update_one({"job_id": job_id, "item_key": item_key}, {"$set": update}, upsert=True)
+
+def record_bulk_error(job_id, item_key, source_name, status, error):
+    """
+    Record why an item failed without touching the stage it reached
+    
+    Args:
+        status: Only stored for an item with no progress yet; one that was
+            already submitted or generated keeps that status, so the next
+            run resumes it instead of paying for it again
+    """
+    bulk_items.update_one(
+        {"job_id": job_id, "item_key": item_key},
+        {"$set": {"error": error, "updated_at": datetime.utcnow()},
+         "$setOnInsert": {"source_name": source_name, "status": status}},
+        upsert=True
+    )
+
 def create_project(name, description, created_by):
     """
     Create a new project in MongoDB
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Optional
+
+from image_store import get_image_store
+
+logger = logging.getLogger(__name__)
+
+# Concurrent downloads of result images
+FETCH_WORKERS = int(os.getenv("IMAGE_FETCH_WORKERS", "8"))
+# In-memory cache of downloaded images, shared by every session
+MEMORY_CACHE_BYTES = int(os.getenv("IMAGE_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Seconds a page waits for its images before showing them without bytes
+FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", "30"))
+
+
+class ImageFetcher:
+    """
+    Concurrent, de-duplicated, cached downloads of result images.
+
+    Fetches run on a thread pool and read through the disk image store
+    (image_store.py), which only goes to the CDN for unknown or stale URLs.
+    Requests for a URL that is already being fetched join the pending
+    future instead of downloading it again, and finished downloads are kept
+    in an LRU cache bounded by ``cache_bytes``, so reruns and other sessions
+    get the bytes without touching the network.
+    """
+
+    def __init__(self, max_workers: int = FETCH_WORKERS, cache_bytes: int = MEMORY_CACHE_BYTES):
+        """
+        Args:
+            max_workers (int): Simultaneous downloads
+            cache_bytes (int): Upper bound for the in-memory cache
+        """
+        self.cache_bytes = cache_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-fetch")
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._cached_bytes = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _download(self, url: str) -> bytes:
+        return get_image_store().fetch(url)
+
+    def _store(self, url: str, data: bytes):
+        with self._lock:
+            if url in self._cache or len(data) > self.cache_bytes:
+                return
+            self._cache[url] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+
+    def _finish(self, url: str, future: Future):
+        with self._lock:
+            self._inflight.pop(url, None)
+        if future.exception() is None:
+            self._store(url, future.result())
+        else:
+            logger.warning(f"Could not fetch {url}: {future.exception()}")
+
+    def submit(self, url: str) -> Future:
+        """Start fetching a URL (or join the fetch already running) and return its future"""
+        with self._lock:
+            data = self._cache.get(url)
+            if data is not None:
+                self._cache.move_to_end(url)
+                future = Future()
+                future.set_result(data)
+                return future
+            future = self._inflight.get(url)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._download, url)
+            self._inflight[url] = future
+        # Registered outside the lock - the callback runs right away (and takes
+        # the lock) if the download has already finished
+        future.add_done_callback(lambda f, url=url: self._finish(url, f))
+        return future
+
+    def prefetch(self, urls: Iterable[str]):
+        """Start fetching every URL in the background"""
+        for url in urls:
+            if url:
+                self.submit(url)
+
+    def get(self, url: str, timeout: Optional[float] = FETCH_TIMEOUT) -> Optional[bytes]:
+        """Bytes of one image, or None if it could not be fetched in time"""
+        try:
+            return self.submit(url).result(timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Image fetch failed for {url}: {e}")
+            return None
+
+    def loader(self, url: str) -> Callable[[], bytes]:
+        """
+        Zero-argument callable producing the bytes of ``url``
+
+        Pass it as ``data`` to st.download_button: the image is only read
+        when the user clicks, instead of being fetched while the page renders
+        and held in Streamlit's media store for every session.
+        """
+        return lambda: self.get(url) or b""
+
+    def get_many(self, urls: Iterable[str], timeout: Optional[float] = FETCH_TIMEOUT) -> Dict[str, Optional[bytes]]:
+        """
+        Fetch several images concurrently
+
+        Returns:
+            Dict[str, Optional[bytes]]: URL -> bytes, None for failed or late fetches
+        """
+        futures = {url: self.submit(url) for url in dict.fromkeys(urls) if url}
+        wait(futures.values(), timeout=timeout)
+        return {
+            url: future.result() if future.done() and future.exception() is None else None
+            for url, future in futures.items()
+        }
+
+
+_fetcher: Optional[ImageFetcher] = None
+_fetcher_lock = threading.Lock()
+
+
+def get_image_fetcher() -> ImageFetcher:
+    """Return the process-wide image fetcher"""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = ImageFetcher()
+        return _fetcher
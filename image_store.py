@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+from leonardo_client import get_client
+
+logger = logging.getLogger(__name__)
+
+# Store location - next to the app database, so it survives restarts
+if os.path.exists("/mount/src"):
+    STORE_DIR = os.getenv("IMAGE_STORE_DIR", "/mount/src/imagegeneration/.streamlit/image_store")
+else:
+    STORE_DIR = os.getenv("IMAGE_STORE_DIR", ".streamlit/image_store")
+# Disk budget; least recently used images are evicted beyond it
+STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Gallery thumbnails live in a store of their own, so full-size images can never evict them
+THUMBNAIL_STORE_DIR = os.getenv("THUMBNAIL_STORE_DIR", os.path.join(os.path.dirname(STORE_DIR), "thumbnail_store"))
+THUMBNAIL_STORE_MAX_BYTES = int(os.getenv("THUMBNAIL_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Stored copies older than this are revalidated against the CDN with their ETag
+REVALIDATE_AFTER = float(os.getenv("IMAGE_STORE_REVALIDATE_AFTER", str(24 * 3600)))  # seconds
+
+
+class ImageStore:
+    """
+    Content-addressed disk cache for result images.
+
+    Image bytes are stored once per SHA-256 under ``blobs/``; a small SQLite
+    index maps each URL to its hash and ETag and tracks last access for LRU
+    eviction against ``max_bytes``. Stale entries are revalidated with
+    If-None-Match, so an unchanged image costs a 304 instead of a download.
+    """
+
+    def __init__(self, root: str = STORE_DIR, max_bytes: int = STORE_MAX_BYTES,
+                 revalidate_after: float = REVALIDATE_AFTER):
+        """
+        Args:
+            root (str): Directory holding the index and blobs
+            max_bytes (int): Disk budget for blobs
+            revalidate_after (float): Age in seconds after which a URL is revalidated
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.index_path = os.path.join(root, "index.db")
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        conn = self._connect()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS urls (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            etag TEXT,
+            validated_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_last_access ON blobs (last_access)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_path, timeout=30)
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def _read_blob(self, sha256: str) -> Optional[bytes]:
+        try:
+            with open(self.blob_path(sha256), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_blob(self, sha256: str, data: bytes):
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _lookup(self, url: str) -> Optional[Tuple[str, Optional[str], float]]:
+        conn = self._connect()
+        row = conn.execute("SELECT sha256, etag, validated_at FROM urls WHERE url=?", (url,)).fetchone()
+        conn.close()
+        return row
+
+    def _touch(self, sha256: str, url: Optional[str] = None):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("UPDATE blobs SET last_access=? WHERE sha256=?", (now, sha256))
+        if url is not None:
+            conn.execute("UPDATE urls SET validated_at=? WHERE url=?", (now, url))
+        conn.commit()
+        conn.close()
+
+    def get_by_hash(self, sha256: str) -> Optional[bytes]:
+        """Bytes of a stored image by content hash"""
+        data = self._read_blob(sha256)
+        if data is not None:
+            self._touch(sha256)
+        return data
+
+    def get(self, url: str) -> Optional[bytes]:
+        """Stored bytes of a URL without any network access, or None"""
+        row = self._lookup(url)
+        if row is None:
+            return None
+        return self.get_by_hash(row[0])
+
+    def put(self, url: str, data: bytes, etag: Optional[str] = None) -> str:
+        """Store an image for a URL and return its content hash"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        self._write_blob(sha256, data)
+
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO blobs (sha256, size, last_access) VALUES (?, ?, ?)",
+                         (sha256, len(data), now))
+            conn.execute("INSERT OR REPLACE INTO urls (url, sha256, etag, validated_at) VALUES (?, ?, ?, ?)",
+                         (url, sha256, etag, now))
+            conn.commit()
+            self._evict(conn)
+            conn.close()
+        return sha256
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Drop least recently used blobs until the store fits its budget"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for sha256, size in conn.execute("SELECT sha256, size FROM blobs ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.blob_path(sha256))
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM blobs WHERE sha256=?", (sha256,))
+            conn.execute("DELETE FROM urls WHERE sha256=?", (sha256,))
+            total -= size
+        conn.commit()
+
+    def fetch(self, url: str) -> bytes:
+        """
+        Bytes of a URL, from disk when possible
+
+        A stored copy is served as is while fresh; once older than
+        ``revalidate_after`` it is revalidated with its ETag. Anything else is
+        downloaded and stored. Raises requests exceptions on download errors.
+        """
+        row = self._lookup(url)
+        if row is not None:
+            sha256, etag, validated_at = row
+            if time.time() - validated_at < self.revalidate_after:
+                data = self.get_by_hash(sha256)
+                if data is not None:
+                    return data
+        else:
+            etag = None
+
+        # Result URLs are public CDN links - no API key needed
+        response = get_client("").fetch(url, etag=etag if row is not None else None)
+        if response.status_code == 304:
+            data = self._read_blob(row[0])
+            if data is not None:
+                self._touch(row[0], url)
+                return data
+            # Blob evicted or removed underneath us - download it again
+            response = get_client("").fetch(url)
+
+        response.raise_for_status()
+        self.put(url, response.content, response.headers.get("ETag"))
+        return response.content
+
+
+_store: Optional[ImageStore] = None
+_thumbnail_store: Optional[ImageStore] = None
+_store_lock = threading.Lock()
+
+
+def get_image_store() -> ImageStore:
+    """Return the process-wide image store"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore()
+        return _store
+
+
+def get_thumbnail_store() -> ImageStore:
+    """Return the process-wide thumbnail store (separate directory and budget)"""
+    global _thumbnail_store
+    with _store_lock:
+        if _thumbnail_store is None:
+            _thumbnail_store = ImageStore(THUMBNAIL_STORE_DIR, THUMBNAIL_STORE_MAX_BYTES)
+        return _thumbnail_store
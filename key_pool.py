@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+import requests
+
+from leonardo_client import LeonardoClient, get_client
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated keys; a single LEONARDO_API_KEY still works on its own
+API_KEYS = [k.strip() for k in os.getenv("LEONARDO_API_KEYS", os.getenv("LEONARDO_API_KEY", "")).split(",") if k.strip()]
+# Jobs allowed in flight per key (lowered to the account's concurrency slots if /me reports fewer)
+KEY_MAX_CONCURRENCY = int(os.getenv("LEONARDO_KEY_MAX_CONCURRENCY", "5"))
+# How long a key's credit balance from /me is trusted
+CREDITS_TTL = float(os.getenv("LEONARDO_CREDITS_TTL", "300"))  # seconds
+# After a failed /me the key's balance is not asked for again for this long
+CREDITS_RETRY_AFTER = float(os.getenv("LEONARDO_CREDITS_RETRY_AFTER", "30"))  # seconds
+# Keys with fewer credits left are not used for new jobs
+MIN_CREDITS = int(os.getenv("LEONARDO_KEY_MIN_CREDITS", "1"))
+# A key that errored is skipped for this long
+KEY_COOLDOWN = float(os.getenv("LEONARDO_KEY_COOLDOWN", "60"))  # seconds
+
+
+class NoKeyAvailableError(requests.exceptions.RequestException):
+    """Raised when every key is busy, out of credits or unhealthy"""
+
+
+def is_key_failure(status_code: int) -> bool:
+    """Whether an API status means the key itself is unusable right now (auth, credits, outage)"""
+    return status_code in (401, 402, 403) or status_code >= 500
+
+
+def is_key_error(error: Exception) -> bool:
+    """Whether a request exception (requests or aiohttp) should bench the key that raised it"""
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return is_key_failure(error.response.status_code)
+    if isinstance(error, aiohttp.ClientResponseError):
+        return is_key_failure(error.status)
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+def api_key_id(api_key: str) -> str:
+    """Short stable fingerprint of a key - safe to log and store, unlike the key"""
+    return "key-" + hashlib.sha256((api_key or "").strip().encode("utf-8")).hexdigest()[:10]
+
+
+class KeyState:
+    def __init__(self, api_key: str, max_concurrent: int):
+        self.api_key = api_key
+        self.key_id = api_key_id(api_key)
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.credits: Optional[int] = None
+        self.credits_checked = 0.0
+        # Whether the last /me succeeded - a failure is cached for a shorter time
+        self.credits_fresh = False
+        # Held while /me is being called, so concurrent acquirers make one call
+        self.refresh_lock = threading.Lock()
+        self.unhealthy_until = 0.0
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / max(self.max_concurrent, 1)
+
+    def status(self) -> Dict[str, object]:
+        return {
+            "key_id": self.key_id,
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "credits": self.credits,
+            "healthy": time.monotonic() >= self.unhealthy_until,
+        }
+
+
+class KeyLease:
+    """One job's hold on a key; release it when the job is finished"""
+
+    def __init__(self, pool: "KeyPool", state: KeyState):
+        self.pool = pool
+        self.state = state
+        self.key_id = state.key_id
+        self.client: LeonardoClient = get_client(state.api_key)
+        self._released = False
+
+    @property
+    def api_key(self) -> str:
+        return self.state.api_key
+
+    def charge(self, apiCreditCost):
+        """Deduct a submitted job's cost from the cached balance"""
+        self.pool.charge(self.state, apiCreditCost)
+
+    def release(self, failed: bool = False):
+        if not self._released:
+            self._released = True
+            self.pool.release(self.state, failed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release(failed=exc_type is not None)
+
+
+class KeyPool:
+    """
+    Routes jobs across several Leonardo API keys.
+
+    Every key has a maximum number of jobs in flight and a credit balance
+    read from /me (cached for ``credits_ttl`` seconds, decremented locally as
+    jobs are submitted; a failed read is retried after ``credits_retry_after``).
+    A job goes to the least-loaded key that is healthy, has a free slot and
+    enough credits; keys that error are benched for KEY_COOLDOWN seconds.
+    """
+
+    def __init__(self, api_keys: List[str], max_concurrent: int = KEY_MAX_CONCURRENCY,
+                 credits_ttl: float = CREDITS_TTL, min_credits: int = MIN_CREDITS,
+                 credits_retry_after: float = CREDITS_RETRY_AFTER):
+        self.states = [KeyState(key, max_concurrent) for key in dict.fromkeys(api_keys)]
+        self.credits_ttl = credits_ttl
+        self.credits_retry_after = credits_retry_after
+        self.min_credits = min_credits
+        self._condition = threading.Condition()
+
+    def _credits_stale(self, state: KeyState) -> bool:
+        ttl = self.credits_ttl if state.credits_fresh else self.credits_retry_after
+        return time.monotonic() - state.credits_checked >= ttl
+
+    def _refresh_credits(self, state: KeyState):
+        """Re-read a key's balance from /me once the cached value is stale (pool lock not held)"""
+        if not self._credits_stale(state):
+            return
+        # Single flight per key - while one caller asks /me the others use the cached balance
+        if not state.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if not self._credits_stale(state):
+                return
+            try:
+                response = get_client(state.api_key).get_me()
+                if response.status_code != 200:
+                    raise requests.exceptions.HTTPError(f"status {response.status_code}")
+                details = response.json()["user_details"][0]
+            except (requests.exceptions.RequestException, KeyError, IndexError, ValueError) as e:
+                logger.warning(f"Could not read credits for {state.key_id}: {e}")
+                with self._condition:
+                    state.credits_fresh = False
+                    state.credits_checked = time.monotonic()
+                return
+
+            with self._condition:
+                state.credits = int(details.get("apiSubscriptionTokens") or 0) + int(details.get("apiPaidTokens") or 0)
+                state.credits_fresh = True
+                state.credits_checked = time.monotonic()
+                slots = details.get("apiConcurrencySlots")
+                if slots:
+                    state.max_concurrent = min(state.max_concurrent, int(slots))
+        finally:
+            state.refresh_lock.release()
+
+    def _states_for(self, key_id: Optional[str]) -> List[KeyState]:
+        states = [state for state in self.states if key_id is None or state.key_id == key_id]
+        if not states:
+            # Nothing to wait for - fail now rather than at the timeout
+            raise NoKeyAvailableError(f"Leonardo API key {key_id} is not configured" if key_id
+                                      else "No Leonardo API key is configured")
+        return states
+
+    def try_acquire(self, key_id: Optional[str] = None) -> Optional[KeyLease]:
+        """
+        Lease the least-loaded usable key, or None if none is free right now
+
+        ``key_id`` restricts the choice to the key with that fingerprint, e.g.
+        for a job that needs an init image uploaded with it. Raises
+        NoKeyAvailableError if no such key is configured.
+        """
+        states = self._states_for(key_id)
+        for state in states:
+            self._refresh_credits(state)
+
+        with self._condition:
+            now = time.monotonic()
+            candidates = [
+                state for state in states
+                if now >= state.unhealthy_until
+                and state.in_flight < state.max_concurrent
+                and (state.credits is None or state.credits >= self.min_credits)
+            ]
+            if not candidates:
+                return None
+            # Least loaded first, then the one with the most credits left
+            state = min(candidates, key=lambda s: (s.load, -(s.credits or 0)))
+            state.in_flight += 1
+            return KeyLease(self, state)
+
+    def acquire(self, timeout: float = 60, key_id: Optional[str] = None) -> KeyLease:
+        """Lease a key (``key_id`` if given), waiting up to ``timeout`` seconds for a free slot"""
+        self._states_for(key_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            lease = self.try_acquire(key_id)
+            if lease is not None:
+                return lease
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise NoKeyAvailableError("All Leonardo API keys are busy, out of credits or failing")
+            with self._condition:
+                self._condition.wait(min(remaining, 1.0))
+
+    async def acquire_async(self, timeout: float = 60, key_id: Optional[str] = None) -> KeyLease:
+        """asyncio version of acquire"""
+        self._states_for(key_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            lease = await asyncio.to_thread(self.try_acquire, key_id)
+            if lease is not None:
+                return lease
+            if time.monotonic() >= deadline:
+                raise NoKeyAvailableError("All Leonardo API keys are busy, out of credits or failing")
+            await asyncio.sleep(0.25)
+
+    def charge(self, state: KeyState, apiCreditCost):
+        with self._condition:
+            if state.credits is not None:
+                state.credits -= int(apiCreditCost or 0)
+
+    def release(self, state: KeyState, failed: bool = False):
+        with self._condition:
+            state.in_flight = max(0, state.in_flight - 1)
+            if failed:
+                state.unhealthy_until = time.monotonic() + KEY_COOLDOWN
+                logger.warning(f"Benching {state.key_id} for {KEY_COOLDOWN:.0f}s after an error")
+            self._condition.notify_all()
+
+    def client_for(self, key_id: Optional[str]) -> Optional[LeonardoClient]:
+        """Client of the key with this fingerprint (e.g. to follow a job it submitted)"""
+        for state in self.states:
+            if state.key_id == key_id:
+                return get_client(state.api_key)
+        return None
+
+    def status(self) -> List[Dict[str, object]]:
+        """Per-key load, credits and health, for display"""
+        with self._condition:
+            return [state.status() for state in self.states]
+
+
+_pool: Optional[KeyPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_key_pool() -> KeyPool:
+    """Return the process-wide key pool built from LEONARDO_API_KEYS"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = KeyPool(API_KEYS)
+        return _pool
@@ -0,0 +1,130 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from polling import PollPolicy
+
+logger = logging.getLogger(__name__)
+
+# Fewer recorded generations than this for a configuration -> no estimate
+MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", "5"))
+# Most recent timings used per configuration
+MAX_SAMPLES = int(os.getenv("LATENCY_MAX_SAMPLES", "200"))
+
+
+def latency_group(payload: Dict[str, Any]) -> str:
+    """
+    Configuration a generation's latency is modelled for
+
+    Model and the expensive modes change the render time per pixel; size and
+    image count are the model's input (see latency_size).
+    """
+    return "|".join([
+        str(payload.get("modelId")),
+        "alchemy" if payload.get("alchemy") else "-",
+        "ultra" if payload.get("ultra") else "-",
+        "photoReal" if payload.get("photoReal") else "-",
+    ])
+
+
+def latency_size(payload: Dict[str, Any]) -> float:
+    """Total megapixels requested - width x height x number of images"""
+    return payload.get("width", 512) * payload.get("height", 512) * payload.get("num_images", 1) / 1_000_000
+
+
+def completion_duration(status_data: Optional[Dict[str, Any]], submitted_at: float) -> Optional[float]:
+    """
+    Seconds from submit (a time.monotonic() reading) to completion, or None if unknown
+
+    Webhook callbacks and central poller sweeps stamp ``completed_at`` when
+    the result arrives (webhooks.CallbackRegistry.deliver). Poll loops stamp
+    the midpoint between the last pending check and the one that saw the job
+    done (polling.stamp_completion), so samples do not drift towards the
+    backoff schedule.
+    """
+    completed_at = (status_data or {}).get("completed_at")
+    if completed_at is None:
+        return None
+    return max(0.0, completed_at - submitted_at)
+
+
+def _quantile(values: Sequence[float], q: float) -> float:
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class LatencyEstimate:
+    """Expected duration of a generation with a low/high band, in seconds"""
+
+    def __init__(self, expected: float, low: float, high: float, samples: int):
+        self.expected = expected
+        self.low = low
+        self.high = high
+        self.samples = samples
+
+    def __repr__(self):
+        return f"LatencyEstimate(expected={self.expected:.1f}, low={self.low:.1f}, high={self.high:.1f}, samples={self.samples})"
+
+
+def estimate_latency(timings: List[Tuple[float, float]], size: float) -> Optional[LatencyEstimate]:
+    """
+    Fit duration = a + b * megapixels to one configuration's timings
+
+    Args:
+        timings (List[Tuple[float, float]]): (megapixels, seconds) of past generations
+        size (float): Megapixels of the generation to estimate
+
+    Returns:
+        Optional[LatencyEstimate]: Prediction with a 10th-90th percentile band
+        from the fit's residuals, or None if there is too little history
+    """
+    if len(timings) < MIN_SAMPLES:
+        return None
+
+    sizes = [s for s, _ in timings]
+    durations = [d for _, d in timings]
+    mean_size = sum(sizes) / len(sizes)
+    mean_duration = sum(durations) / len(durations)
+
+    # Least squares; every sample the same size -> just the mean
+    spread = sum((s - mean_size) ** 2 for s in sizes)
+    slope = sum((s - mean_size) * (d - mean_duration) for s, d in timings) / spread if spread else 0.0
+    slope = max(slope, 0.0)
+    intercept = mean_duration - slope * mean_size
+
+    residuals = [d - (intercept + slope * s) for s, d in timings]
+    expected = max(0.0, intercept + slope * size)
+    return LatencyEstimate(
+        expected=expected,
+        low=max(0.0, expected + _quantile(residuals, 0.1)),
+        high=max(expected, expected + _quantile(residuals, 0.9)),
+        samples=len(timings),
+    )
+
+
+def policy_with_latency(policy: PollPolicy, estimate: Optional[LatencyEstimate]) -> PollPolicy:
+    """
+    Adjust a poll policy to the expected latency
+
+    The first status check waits until completion is plausible (the low end
+    of the estimate) instead of polling a job that cannot be done yet; the
+    deadline is stretched if history says the job can legitimately run longer.
+    """
+    if estimate is None:
+        return policy
+    first_delay = min(max(policy.initial_delay, estimate.low), policy.deadline * 0.8)
+    deadline = max(policy.deadline, estimate.high * 2)
+    return PollPolicy(deadline=deadline, initial_delay=policy.initial_delay, factor=policy.factor,
+                      max_interval=policy.max_interval, jitter=policy.jitter, first_delay=first_delay)
+
+
+def eta_text(elapsed: float, estimate: LatencyEstimate) -> str:
+    remaining = estimate.expected - elapsed
+    if remaining > 1:
+        return f"About {remaining:.0f}s remaining ({elapsed:.0f}s elapsed)"
+    if elapsed < estimate.high:
+        return f"Finishing up... ({elapsed:.0f}s elapsed)"
+    return f"Taking longer than usual... ({elapsed:.0f}s elapsed)"
@@ -0,0 +1,321 @@
+import asyncio
+import inspect
+import json
+import logging
+from typing import IO, Any, Awaitable, Dict, List, Optional, Tuple, Union
+
+import aiohttp
+
+from polling import COMPLETE, FAILED, PollPolicy, policy_for_model
+from completion import wait_for_completion_async
+import rate_limit
+from rate_limit import TokenBucket, CircuitBreaker, CircuitOpenError, parse_retry_after
+from init_images import submit_preprocess, init_image_file_name, INIT_IMAGE_EXTENSION, INIT_IMAGE_CONTENT_TYPE
+from leonardo_client import (
+    BASE_URL,
+    DEFAULT_POOL_MAXSIZE,
+    DEFAULT_TIMEOUT,
+    build_image_to_image_payload,
+    build_text_to_image_payload,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLeonardoClient:
+    """
+    asyncio counterpart of LeonardoClient.
+
+    Submits, status polls and downloads are coroutines sharing one aiohttp
+    connection pool, so a single event loop can drive hundreds of
+    generations at once instead of parking a thread in time.sleep() per job.
+    API calls share the rate limiters and circuit breaker of the API key with
+    the sync client (see rate_limit.limits_for).
+
+    Use as an async context manager:
+
+        async with AsyncLeonardoClient(api_key) as client:
+            result, cost = await leonardo_text_to_image_async(client, prompt, parameters)
+    """
+
+    def __init__(self, api_key: str, limit: int = DEFAULT_POOL_MAXSIZE * 5,
+                 limit_per_host: int = DEFAULT_POOL_MAXSIZE, timeout: float = DEFAULT_TIMEOUT,
+                 submit_limiter: Optional[TokenBucket] = None, status_limiter: Optional[TokenBucket] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            api_key (str): Leonardo API key
+            limit (int): Maximum simultaneous connections overall
+            limit_per_host (int): Maximum simultaneous connections per host
+            timeout (float): Per-request timeout in seconds
+            submit_limiter (TokenBucket): Budget for submits, defaults to the key's shared one
+            status_limiter (TokenBucket): Budget for status checks, defaults to the key's shared one
+            breaker (CircuitBreaker): Circuit breaker, defaults to the key's shared one
+        """
+        self.api_key = (api_key or "").strip()
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "accept": "application/json"
+        }
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session: Optional[aiohttp.ClientSession] = None
+        limits = rate_limit.limits_for(self.api_key)
+        self.submit_limiter = submit_limiter or limits.submit_limiter
+        self.status_limiter = status_limiter or limits.status_limiter
+        self.breaker = breaker or limits.breaker
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request_json(self, method: str, url: str, limiter: TokenBucket, idempotent: bool,
+                            **kwargs) -> Dict[str, Any]:
+        """Rate-limited, breaker-guarded API call - same retry and breaker rules as LeonardoClient._request"""
+        for attempt in range(rate_limit.MAX_RETRIES + 1):
+            trial = self.breaker.before_request()
+            try:
+                await limiter.acquire_async()
+                async with self.session.request(method, url, headers=self.headers, **kwargs) as response:
+                    if response.status == 429:
+                        self.breaker.record_success()
+                        delay = parse_retry_after(response.headers.get("Retry-After"),
+                                                  rate_limit.RETRY_BACKOFF * 2 ** attempt)
+                        logger.warning(f"Rate limited by Leonardo, pausing {delay:.1f}s")
+                        self.submit_limiter.pause(delay)
+                        self.status_limiter.pause(delay)
+                        continue
+
+                    if response.status >= 500:
+                        self.breaker.record_failure()
+                        if idempotent and attempt < rate_limit.MAX_RETRIES:
+                            await asyncio.sleep(rate_limit.RETRY_BACKOFF * 2 ** attempt)
+                            continue
+                    else:
+                        self.breaker.record_success()
+
+                    response.raise_for_status()
+                    return await response.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.breaker.record_failure()
+                if not idempotent or attempt == rate_limit.MAX_RETRIES:
+                    raise
+                await asyncio.sleep(rate_limit.RETRY_BACKOFF * 2 ** attempt)
+            except BaseException:
+                # Cancelled, or the answer was already recorded - make sure no trial is left open
+                if trial:
+                    self.breaker.release_trial()
+                raise
+
+        # Still rate limited after every retry
+        response.raise_for_status()
+
+    async def create_generation(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Submit a generation job"""
+        return await self._request_json("POST", f"{BASE_URL}/generations", self.submit_limiter,
+                                        idempotent=False, json=payload)
+
+    async def get_generation(self, generation_id: str) -> Dict[str, Any]:
+        """Fetch the status/result of a generation job"""
+        return await self._request_json("GET", f"{BASE_URL}/generations/{generation_id}", self.status_limiter,
+                                        idempotent=True)
+
+    async def create_init_image(self, extension: str) -> Dict[str, Any]:
+        """Request a presigned upload URL for an init image"""
+        return await self._request_json("POST", f"{BASE_URL}/init-image", self.submit_limiter,
+                                        idempotent=False, json={"extension": extension})
+
+    async def upload_init_image(self, upload_url: str, fields: Dict[str, Any], file_name: str,
+                                data: Union[bytes, IO[bytes]], content_type: str):
+        """Upload an init image to its presigned URL (no API headers needed)"""
+        form = aiohttp.FormData()
+        for name, value in fields.items():
+            form.add_field(name, value)
+        # S3 presigned POSTs require the file to be the last field
+        form.add_field("file", data, filename=file_name, content_type=content_type)
+        async with self.session.post(upload_url, data=form) as response:
+            response.raise_for_status()
+
+    async def download(self, url: str) -> bytes:
+        """Download a result image"""
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+async def wait_for_generation(client: AsyncLeonardoClient, generation_id: str, policy: PollPolicy,
+                              cancel_event: Optional[asyncio.Event] = None) -> Optional[Dict[str, Any]]:
+    """
+    Poll a generation until it completes, fails, times out or is cancelled
+
+    Returns:
+        Optional[Dict[str, Any]]: Final status payload, or None if it did not complete
+    """
+    status, status_data = await wait_for_completion_async(
+        generation_id, lambda: client.get_generation(generation_id), policy, cancel_event=cancel_event,
+        api_key=client.api_key)
+
+    if status == COMPLETE:
+        return status_data
+    elif status == FAILED:
+        logger.error(f"Generation {generation_id} failed: {status_data.get('error')}")
+    else:
+        logger.error(f"Generation {generation_id} stopped waiting: {status}")
+    return None
+
+
+async def download_images(client: AsyncLeonardoClient, result: Dict[str, Any]) -> List[bytes]:
+    """Download every generated image of a completed generation concurrently"""
+    generated_images = result.get("generations_by_pk", {}).get("generated_images", [])
+    urls = [img["url"] for img in generated_images if img.get("url")]
+    return list(await asyncio.gather(*(client.download(url) for url in urls)))
+
+
+async def leonardo_text_to_image_async(client: AsyncLeonardoClient, prompt: str, parameters: Dict[str, Any],
+                                       policy: Optional[PollPolicy] = None,
+                                       cancel_event: Optional[asyncio.Event] = None) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    Async text-to-image generation: submit, then poll until done
+
+    Args:
+        client (AsyncLeonardoClient): Open async client
+        prompt (str): The text prompt for image generation
+        parameters (Dict[str, Any]): Generation parameters
+        policy (PollPolicy): Polling policy, defaults to the model's policy
+        cancel_event (asyncio.Event): Set it to stop waiting for the result
+
+    Returns:
+        Tuple[Optional[Dict[str, Any]], str]: (generation result or None, apiCreditCost)
+    """
+    apiCreditCost = "0"
+    payload = build_text_to_image_payload(prompt, parameters)
+
+    try:
+        logger.debug(f"Request payload: {json.dumps(payload, indent=2)}")
+        generation_data = await client.create_generation(payload)
+
+        generation_id = generation_data.get("sdGenerationJob", {}).get("generationId")
+        apiCreditCost = generation_data.get("sdGenerationJob", {}).get("apiCreditCost", "0")
+        if not generation_id:
+            logger.error(f"Failed to get generation ID from API: {generation_data}")
+            return None, apiCreditCost
+
+        policy = policy or policy_for_model(payload["modelId"])
+        return await wait_for_generation(client, generation_id, policy, cancel_event), apiCreditCost
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+        logger.error(f"API Error: {str(e)}")
+        return None, apiCreditCost
+
+
+async def upload_init_image_async(client: AsyncLeonardoClient,
+                                  init_image: Union[bytes, IO[bytes], Awaitable[Union[bytes, IO[bytes]]]],
+                                  file_name: str) -> str:
+    """
+    Upload a preprocessed init image and return its init_image_id
+
+    ``init_image`` may also be an awaitable of the image (e.g. a preprocessing
+    future); it is only awaited after the presigned URL has been requested, so
+    both overlap. Raises aiohttp errors if the presign or upload fails.
+    """
+    # Step 1: Get a presigned URL for uploading the image
+    init_data = (await client.create_init_image(INIT_IMAGE_EXTENSION))['uploadInitImage']
+    fields = json.loads(init_data['fields'])
+    if inspect.isawaitable(init_image):
+        init_image = await init_image
+
+    # Step 2: Upload the image using the presigned URL
+    await client.upload_init_image(init_data['url'], fields, init_image_file_name(file_name),
+                                   init_image, INIT_IMAGE_CONTENT_TYPE)
+    return init_data['id']
+
+
+async def submit_image_to_image_async(client: AsyncLeonardoClient, prompt: str, init_image_id: str,
+                                      parameters: Dict[str, Any]) -> Tuple[str, str]:
+    """
+    Submit an image-to-image job without waiting for it
+
+    Returns:
+        Tuple[str, str]: (generation_id, apiCreditCost); raises aiohttp errors
+        or KeyError if the job was not accepted
+    """
+    generation_payload = build_image_to_image_payload(prompt, init_image_id, parameters)
+    generation_data = await client.create_generation(generation_payload)
+    return (generation_data['sdGenerationJob']['generationId'],
+            generation_data['sdGenerationJob'].get("apiCreditCost", "0"))
+
+
+async def image_to_image_async(client: AsyncLeonardoClient, prompt: str, init_image_id: str,
+                               parameters: Dict[str, Any], policy: Optional[PollPolicy] = None,
+                               cancel_event: Optional[asyncio.Event] = None) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    Generate from an init image that is already uploaded: submit, then poll
+
+    Any number of these can run concurrently against one init_image_id.
+
+    Returns:
+        Tuple[Optional[Dict[str, Any]], str]: (generation result or None, apiCreditCost)
+    """
+    apiCreditCost = "0"
+    try:
+        generation_id, apiCreditCost = await submit_image_to_image_async(client, prompt, init_image_id, parameters)
+
+        policy = policy or policy_for_model(model_type="img2img", initial_delay=2.0)
+        return await wait_for_generation(client, generation_id, policy, cancel_event), apiCreditCost
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, KeyError) as e:
+        logger.error(f"API Error: {str(e)}")
+        return None, apiCreditCost
+
+
+async def leonardo_image_to_image_async(client: AsyncLeonardoClient, prompt: str, image_bytes: bytes,
+                                        file_name: str, parameters: Dict[str, Any],
+                                        policy: Optional[PollPolicy] = None,
+                                        cancel_event: Optional[asyncio.Event] = None) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    Async image-to-image generation: upload the init image, submit, then poll
+
+    Args:
+        client (AsyncLeonardoClient): Open async client
+        prompt (str): The text prompt for image generation
+        image_bytes (bytes): Source image contents
+        file_name (str): Source image file name
+        parameters (Dict[str, Any]): Generation parameters
+        policy (PollPolicy): Polling policy, defaults to the img2img policy
+        cancel_event (asyncio.Event): Set it to stop waiting for the result
+
+    Returns:
+        Tuple[Optional[Dict[str, Any]], str]: (generation result or None, apiCreditCost)
+    """
+    try:
+        # Step 0: Preprocess on the worker pool while the upload URL is requested
+        preprocessed = asyncio.wrap_future(submit_preprocess(image_bytes))
+
+        # Steps 1-2: Presign and upload
+        init_image_id = await upload_init_image_async(client, preprocessed, file_name)
+
+        # Steps 3-4: Generate with the uploaded image and wait for the result
+        return await image_to_image_async(client, prompt, init_image_id, parameters, policy, cancel_event)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, KeyError) as e:
+        # Nothing was submitted yet, so nothing was charged
+        logger.error(f"API Error: {str(e)}")
+        return None, "0"
+    except OSError as e:
+        logger.error(f"Could not read the source image: {str(e)}")
+        return None, "0"
@@ -1,8 +1,16 @@
 import requests
 import json
+import hashlib
 import time
 import logging
+import os
+import threading
 from typing import Dict, Optional, Any
+from requests.adapters import HTTPAdapter
+from polling import policy_for_model, COMPLETE, FAILED, TIMEOUT
+from completion import wait_for_completion
+import rate_limit
+from rate_limit import TokenBucket, CircuitBreaker, parse_retry_after
 
 # Configure logging
 logging.basicConfig(
@@ -11,7 +19,282 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def leonardo_text_to_image(prompt: str, parameters: Dict[str, Any], api_key: str) -> Optional[Dict[str, Any]]:
+BASE_URL = "https://cloud.leonardo.ai/api/rest/v1"
+
+# Connection pool sizing (override through the environment)
+# pool_connections: number of distinct hosts kept alive (API, S3 upload, CDN)
+# pool_maxsize: number of keep-alive connections kept per host
+DEFAULT_POOL_CONNECTIONS = int(os.getenv("LEONARDO_POOL_CONNECTIONS", "10"))
+DEFAULT_POOL_MAXSIZE = int(os.getenv("LEONARDO_POOL_MAXSIZE", "20"))
+DEFAULT_TIMEOUT = float(os.getenv("LEONARDO_HTTP_TIMEOUT", "60"))
+
+# Every img2img generation is rendered in portrait at this size
+IMG2IMG_WIDTH = 576
+IMG2IMG_HEIGHT = 1024
+# How strongly the init image shapes the result, unless init_strength is given
+IMG2IMG_INIT_STRENGTH = 0.7
+
+
+class LeonardoClient:
+    """
+    Leonardo REST API client backed by a single pooled keep-alive session.
+
+    The submit request, every status poll and every image download reuse the
+    connections held by the session instead of paying a new TCP+TLS handshake
+    for each call.
+
+    API calls go through the token buckets and circuit breaker of the API key
+    (see rate_limit.limits_for): a 429 pauses every caller of the key for its
+    Retry-After, status checks are retried, and repeated 5xx responses make
+    calls fail fast.
+    """
+
+    def __init__(self, api_key: str, pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize: int = DEFAULT_POOL_MAXSIZE, timeout: float = DEFAULT_TIMEOUT,
+                 submit_limiter: Optional[TokenBucket] = None, status_limiter: Optional[TokenBucket] = None,
+                 breaker: Optional[CircuitBreaker] = None):
+        """
+        Args:
+            api_key (str): Leonardo API key
+            pool_connections (int): Number of host connection pools to keep
+            pool_maxsize (int): Maximum keep-alive connections per host
+            timeout (float): Per-request timeout in seconds
+            submit_limiter (TokenBucket): Budget for submits, defaults to the key's shared one
+            status_limiter (TokenBucket): Budget for status checks, defaults to the key's shared one
+            breaker (CircuitBreaker): Circuit breaker, defaults to the key's shared one
+        """
+        self.api_key = (api_key or "").strip()
+        self.timeout = timeout
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "accept": "application/json"
+        }
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        limits = rate_limit.limits_for(self.api_key)
+        self.submit_limiter = submit_limiter or limits.submit_limiter
+        self.status_limiter = status_limiter or limits.status_limiter
+        self.breaker = breaker or limits.breaker
+
+    def _request(self, method: str, url: str, limiter: TokenBucket, idempotent: bool, **kwargs) -> requests.Response:
+        """
+        Rate-limited, breaker-guarded API call
+
+        429 responses are always retried after Retry-After (the request was
+        not accepted). 5xx, connection errors and timeouts are only retried
+        for idempotent calls, since a failed submit may still have created a
+        job. Every attempt records an outcome with the breaker: a 429 means
+        the API is up (only the limiter pauses), 5xx and timeouts are failures.
+        """
+        for attempt in range(rate_limit.MAX_RETRIES + 1):
+            trial = self.breaker.before_request()
+            try:
+                limiter.acquire()
+                response = self.session.request(method, url, headers=self.headers, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.record_failure()
+                if not idempotent or attempt == rate_limit.MAX_RETRIES:
+                    raise
+                time.sleep(rate_limit.RETRY_BACKOFF * 2 ** attempt)
+                continue
+            except BaseException:
+                # No answer from the API either way - let the next request be the trial
+                if trial:
+                    self.breaker.release_trial()
+                raise
+
+            if response.status_code == 429:
+                self.breaker.record_success()
+                delay = parse_retry_after(response.headers.get("Retry-After"), rate_limit.RETRY_BACKOFF * 2 ** attempt)
+                logger.warning(f"Rate limited by Leonardo, pausing {delay:.1f}s")
+                self.submit_limiter.pause(delay)
+                self.status_limiter.pause(delay)
+                continue
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+                if idempotent and attempt < rate_limit.MAX_RETRIES:
+                    time.sleep(rate_limit.RETRY_BACKOFF * 2 ** attempt)
+                    continue
+                return response
+
+            self.breaker.record_success()
+            return response
+
+        return response
+
+    def create_generation(self, payload: Dict[str, Any]) -> requests.Response:
+        """Submit a generation job"""
+        return self._request("POST", f"{BASE_URL}/generations", self.submit_limiter, idempotent=False, json=payload)
+
+    def get_generation(self, generation_id: str) -> requests.Response:
+        """Fetch the status/result of a generation job"""
+        return self._request("GET", f"{BASE_URL}/generations/{generation_id}", self.status_limiter, idempotent=True)
+
+    def get_me(self) -> requests.Response:
+        """Fetch the account behind the API key (user ID, remaining credits)"""
+        return self._request("GET", f"{BASE_URL}/me", self.status_limiter, idempotent=True)
+
+    def get_user_generations(self, user_id: str, offset: int = 0, limit: int = 50) -> requests.Response:
+        """List a user's generations, newest first"""
+        return self._request("GET", f"{BASE_URL}/generations/user/{user_id}", self.status_limiter, idempotent=True,
+                             params={"offset": offset, "limit": limit})
+
+    def create_init_image(self, extension: str) -> requests.Response:
+        """Request a presigned upload URL for an init image"""
+        return self._request("POST", f"{BASE_URL}/init-image", self.submit_limiter, idempotent=False,
+                             json={"extension": extension})
+
+    def upload_init_image(self, upload_url: str, fields: Dict[str, Any], files: Dict[str, Any]) -> requests.Response:
+        """Upload an init image to its presigned URL (no API headers needed)"""
+        return self.session.post(upload_url, data=fields, files=files, timeout=self.timeout)
+
+    def download(self, url: str) -> bytes:
+        """Download a result image"""
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def fetch(self, url: str, etag: Optional[str] = None) -> requests.Response:
+        """GET a result image, conditionally on ``etag`` (a 304 means the stored copy is current)"""
+        headers = {"If-None-Match": etag} if etag else {}
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_clients: Dict[str, LeonardoClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key: str) -> LeonardoClient:
+    """
+    Return the process-wide shared client for an API key
+
+    All Streamlit sessions run in the same process, so sharing one client
+    lets them share its connection pool.
+    """
+    key = (api_key or "").strip()
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = LeonardoClient(key)
+            _clients[key] = client
+        return client
+
+
+def build_text_to_image_payload(prompt: str, parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the /generations payload for a text-to-image request
+    
+    Args:
+        prompt (str): The text prompt for image generation
+        parameters (Dict[str, Any]): Generation parameters chosen in the UI
+        
+    Returns:
+        Dict[str, Any]: Request payload
+    """
+    # Start with base payload
+    payload = {
+        "prompt": prompt,
+        "num_images": parameters.get("num_images", 1),
+        "width": parameters.get("width", 512),
+        "height": parameters.get("height", 512),
+    }
+    
+    # Add model ID (required)
+    payload["modelId"] = parameters.get("modelId", "b2614463-296c-462a-9586-aafdb8f00e36")
+    
+    # Add contrast if provided
+    if "contrast" in parameters:
+        payload["contrast"] = float(parameters["contrast"])
+    
+    # Add model-specific parameters
+    # Phoenix and SDXL models
+    if "alchemy" in parameters:
+        payload["alchemy"] = parameters["alchemy"]
+    
+    # Phoenix models
+    if "ultra" in parameters:
+        payload["ultra"] = parameters["ultra"]
+
+    # Ultra and alchemy are mutually exclusive - ultra wins
+    if payload.get("ultra") == True and payload.get("alchemy") == True:
+        del payload["alchemy"]
+    
+    # SDXL and SD15 models
+    if "photoReal" in parameters:
+        payload["photoReal"] = parameters["photoReal"]
+        if parameters["photoReal"] and "photoRealVersion" in parameters:
+            payload["photoRealVersion"] = parameters["photoRealVersion"]
+    
+    # Style options
+    if "styleUUID" in parameters and parameters["styleUUID"]:
+        payload["styleUUID"] = parameters["styleUUID"]
+    
+    # Preset style for SDXL
+    if "presetStyle" in parameters and parameters["presetStyle"]:
+        payload["presetStyle"] = parameters["presetStyle"]
+    
+    # Add prompt enhancement if specified
+    if "enhancePrompt" in parameters:
+        payload["enhancePrompt"] = parameters["enhancePrompt"]
+    
+    # Fixed seed for reproducible results
+    if parameters.get("seed") is not None:
+        payload["seed"] = int(parameters["seed"])
+    
+    return payload
+
+
+def payload_cache_key(payload: Dict[str, Any]) -> str:
+    """
+    Canonical hash of a generation payload
+
+    Key order and whitespace do not matter, so the same prompt and settings
+    always map to the same key.
+    """
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def build_image_to_image_payload(prompt: str, init_image_id: str, parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the /generations payload for an image-to-image request
+    
+    Args:
+        prompt (str): The text prompt for image generation
+        init_image_id (str): ID of the uploaded init image
+        parameters (Dict[str, Any]): Generation parameters chosen in the UI;
+            ``init_strength`` (0.1-0.9) overrides IMG2IMG_INIT_STRENGTH
+        
+    Returns:
+        Dict[str, Any]: Request payload
+    """
+    select_model = parameters.get("select_model", "General")
+    model_id = "6bef9f1b-29cb-40c7-b9df-32b51c1f67d3"  # Leonardo Creative
+    if select_model == "Raja Ravi Varma":
+        prompt = prompt + " in style of raja ravi varma"
+    
+    return {
+        "height": IMG2IMG_HEIGHT,
+        "width": IMG2IMG_WIDTH,
+        "modelId": model_id,
+        "prompt": prompt,
+        "num_images": 1,
+        "init_image_id": init_image_id,
+        "init_strength": float(parameters.get("init_strength", IMG2IMG_INIT_STRENGTH)),
+    }
+
+
+def leonardo_text_to_image(prompt: str, parameters: Dict[str, Any], api_key: str,
+                           cancel_event: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
     """
     Call Leonardo API for text-to-image generation
     
@@ -19,17 +302,12 @@ def leonardo_text_to_image(prompt: str, parameters: Dict[str, Any], api_key: str
         prompt (str): The text prompt for image generation
         parameters (Dict[str, Any]): Generation parameters
         api_key (str): Leonardo API key
+        cancel_event (threading.Event): Set it to stop waiting for the result
         
     Returns:
         Optional[Dict[str, Any]]: Generation result or None if failed
     """
-    url = "https://cloud.leonardo.ai/api/rest/v1/generations"
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "accept": "application/json"
-    }
+    client = get_client(api_key)
     
     payload = {
         "modelId": "b63f7119-31dc-4540-969b-2a9df997e173",  # "SDXL 0.9"
@@ -49,7 +327,7 @@ def leonardo_text_to_image(prompt: str, parameters: Dict[str, Any], api_key: str
         logger.debug(f"Request payload: {json.dumps(payload, indent=2)}")
         
         # First create the generation
-        response = requests.post(url, json=payload, headers=headers)
+        response = client.create_generation(payload)
         
         # Log the response for debugging
         logger.debug(f"Initial API Response: {response.text}")
@@ -71,39 +349,28 @@ def leonardo_text_to_image(prompt: str, parameters: Dict[str, Any], api_key: str
         logger.info(f"Generation ID received: {generation_id}")
             
         # Poll for the generation result
-        status_url = f"https://cloud.leonardo.ai/api/rest/v1/generations/{generation_id}"
-        max_attempts = 30  # 30 seconds maximum wait time
-        attempt = 0
-        
-        # Create a progress bar
-        
-        while attempt < max_attempts:
-            status_response = requests.get(status_url, headers=headers)
-            
+        def fetch_status():
+            status_response = client.get_generation(generation_id)
             if status_response.status_code != 200:
                 logger.error(f"Status check failed: {status_response.status_code}")
                 logger.error(f"Response: {status_response.text}")
                 return None
-                
-            status_data = status_response.json()
-            logger.debug(f"Status check {attempt + 1}/{max_attempts}")
-            
-            # Update progress
-            progress = min(1.0, (attempt + 1) / max_attempts)
-           
-            
-            if status_data['generations_by_pk']['status'] == "COMPLETE":
-                logger.info("Generation completed successfully!")
-                return status_data
-            elif status_data['generations_by_pk']['status'] == "FAILED":
-                logger.error("Generation failed!")
-                logger.error(f"Generation failed: {status_data.get('error')}")
-                return None
-                
-            time.sleep(1)  # Wait 1 second before next poll
-            attempt += 1
-            
-        logger.error("Generation timed out")
+            return status_response.json()
+        
+        def log_progress(elapsed, attempt):
+            logger.debug(f"Status check {attempt}, {elapsed:.0f}s elapsed")
+        
+        status, status_data = wait_for_completion(generation_id, fetch_status, policy_for_model(payload["modelId"]),
+                                                  cancel_event=cancel_event, on_progress=log_progress, api_key=api_key)
+        
+        if status == COMPLETE:
+            logger.info("Generation completed successfully!")
+            return status_data
+        elif status == FAILED:
+            logger.error("Generation failed!")
+            logger.error(f"Generation failed: {status_data.get('error')}")
+        elif status == TIMEOUT:
+            logger.error("Generation timed out")
         return None
         
     except requests.exceptions.RequestException as e:
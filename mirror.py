@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+from urllib.parse import urlparse
+
+from image_fetch import get_image_fetcher
+from image_store import get_image_store
+
+logger = logging.getLogger(__name__)
+
+# Permanent local copies of result images - unlike the image store, never evicted
+if os.path.exists("/mount/src"):
+    MIRROR_DIR = os.getenv("MIRROR_DIR", "/mount/src/imagegeneration/.streamlit/mirror")
+else:
+    MIRROR_DIR = os.getenv("MIRROR_DIR", ".streamlit/mirror")
+# Images copied at once
+MIRROR_WORKERS = int(os.getenv("MIRROR_WORKERS", "4"))
+
+
+def mirror_path(relative_path: str) -> str:
+    """Absolute location of a mirrored image (rows store the path relative to MIRROR_DIR)"""
+    return os.path.join(MIRROR_DIR, relative_path)
+
+
+def mirror_image(url: str) -> str:
+    """
+    Copy one result image into the mirror and return its path relative to MIRROR_DIR
+
+    Files are named by content hash, so the same image is stored once. The
+    bytes come through the image store, which skips the CDN when it already
+    has them. Raises requests exceptions or OSError on failure.
+    """
+    data = get_image_store().fetch(url)
+    extension = os.path.splitext(urlparse(url).path)[1].lower() or ".png"
+    digest = hashlib.sha256(data).hexdigest()
+    relative_path = os.path.join(digest[:2], digest + extension)
+
+    path = mirror_path(relative_path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return relative_path
+
+
+def mirror_images(image_urls: List[str]) -> List[Optional[str]]:
+    """Mirror every image of a generation; None where one could not be copied"""
+    mirrored = []
+    for url in image_urls:
+        try:
+            mirrored.append(mirror_image(url))
+        except Exception as e:
+            logger.warning(f"Could not mirror {url}: {e}")
+            mirrored.append(None)
+    return mirrored
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def submit_mirror(image_urls: List[str], on_done: Callable[[List[Optional[str]]], None]):
+    """
+    Mirror images in the background and hand the paths to ``on_done(mirror_paths)``
+
+    Used by log_generation. At most MIRROR_WORKERS images are copied at
+    once; on_done is not called if nothing could be copied, so the
+    generation stays unmirrored and is retried by the backfill.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MIRROR_WORKERS, thread_name_prefix="mirror")
+
+    def run():
+        try:
+            mirrored = mirror_images(image_urls)
+            if any(mirrored):
+                on_done(mirrored)
+        except Exception as e:
+            logger.error(f"Mirror job failed: {e}")
+
+    if image_urls:
+        _executor.submit(run)
+
+
+def read_mirror(relative_path: Optional[str]) -> Optional[bytes]:
+    """Bytes of a mirrored image, or None if there is no mirror"""
+    if not relative_path:
+        return None
+    try:
+        with open(mirror_path(relative_path), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def mirror_loader(relative_path: Optional[str], url: str) -> Callable[[], bytes]:
+    """
+    Zero-argument callable producing an image for st.download_button
+
+    Reads the mirror and only falls back to the CDN (through the image
+    fetcher) when the image has not been mirrored.
+    """
+    fallback = get_image_fetcher().loader(url)
+    return lambda: read_mirror(relative_path) or fallback()
+
+
+def image_source(relative_path: Optional[str], url: str):
+    """What to hand st.image: the mirrored bytes if there are any, else the fetched image or URL"""
+    return read_mirror(relative_path) or get_image_fetcher().get(url) or url
+
+
+def _mirror_missing(image_urls: List[str], mirror_paths: Optional[List[Optional[str]]]) -> List[Optional[str]]:
+    """Mirror the images of a generation that have no path yet, keeping the ones already mirrored"""
+    mirror_paths = list(mirror_paths or [])
+    mirror_paths += [None] * (len(image_urls) - len(mirror_paths))
+    return [path or mirror_images([url])[0] for url, path in zip(image_urls, mirror_paths)]
+
+
+def backfill(db, batch_size: int = 100) -> int:
+    """
+    Mirror the images of logged generations that have no mirror yet
+
+    Partially mirrored generations are completed; images that still cannot
+    be copied are retried by the next run.
+
+    Args:
+        db: db_helper or db_helper_mongo
+        batch_size (int): Generations processed per round
+
+    Returns:
+        int: Number of generations updated
+    """
+    updated = 0
+    failed = set()
+    with ThreadPoolExecutor(max_workers=MIRROR_WORKERS, thread_name_prefix="mirror-backfill") as executor:
+        while True:
+            pending = [row for row in db.get_generations_without_mirrors(batch_size + len(failed))
+                       if row[0] not in failed][:batch_size]
+            if not pending:
+                return updated
+            mirrored_rows = executor.map(lambda row: _mirror_missing(row[1], row[2]), pending)
+            for (generation_id, image_urls, mirror_paths), mirrored in zip(pending, mirrored_rows):
+                if mirrored != mirror_paths and (any(mirrored) or not image_urls):
+                    db.set_generation_mirrors(generation_id, mirrored)
+                    updated += 1
+                if not all(mirrored):
+                    # Keep what is missing for a later run, but do not retry it in this one
+                    failed.add(generation_id)
+            logger.info(f"Mirrored {updated} generations")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mirror the result images of existing generations")
+    parser.add_argument("--mongo", action="store_true", help="use the MongoDB database instead of SQLite")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.mongo:
+        import db_helper_mongo as db
+    else:
+        import db_helper as db
+    db.init_db()
+    print(f"Mirrored {backfill(db, args.batch_size)} generations")
@@ -44,6 +44,17 @@ modelTypes = {
     "3D Animation Style": "sd15"
 }
 
+# Total time (seconds) to wait for a generation of each model type before
+# reporting it as timed out. Phoenix Ultra renders routinely take well over 30s.
+modelDeadlines = {
+    "flux": 60,
+    "phoenix": 180,
+    "sdxl": 90,
+    "sd15": 60,
+    "img2img": 120,
+}
+DEFAULT_DEADLINE = 120
+
 
 styleUUID = {
     "3D Render": "debdf72a-91a4-467b-bf61-cc02bdeb69c6",
@@ -151,6 +162,14 @@ def get_model_name_from_id(model_id):
             return name
     return "Unknown Model"
 
+def get_model_type_from_id(model_id):
+    """Get model type (flux, phoenix, sdxl, sd15) from model ID"""
+    return modelTypes.get(get_model_name_from_id(model_id))
+
+def get_deadline_for_model_type(model_type):
+    """Get the total polling deadline in seconds for a model type"""
+    return modelDeadlines.get(model_type, DEFAULT_DEADLINE)
+
 def get_style_name_from_id(style_uuid):
     """Get style name from style UUID"""
     from model_parameters import styleUUID
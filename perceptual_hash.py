@@ -0,0 +1,339 @@
+import argparse
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from image_fetch import get_image_fetcher
+from mirror import read_mirror
+
+logger = logging.getLogger(__name__)
+
+# Distances are pHash + dHash Hamming distances, 0 (identical) to 128
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", "10"))
+# Unrelated images average 64; below ~36 they are rare even among 100k
+SIMILAR_DISTANCE = int(os.getenv("SIMILAR_DISTANCE", "36"))
+# An app process reloads the index this often, to pick up hashes written by other processes
+HASH_INDEX_REFRESH = int(os.getenv("HASH_INDEX_REFRESH", "300"))  # seconds
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+# Extra candidates taken before dropping the images of the excluded generation
+EXCLUDE_MARGIN = 16
+
+Hashes = Dict[str, str]
+Match = Tuple[Any, int, int]
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix, so a 2-D DCT is two matrix products"""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+_POPCOUNT = np.array([bin(n).count("1") for n in range(256)], dtype=np.uint8)
+
+
+def _to_hex(bits: np.ndarray) -> str:
+    return np.packbits(bits.astype(np.uint8).ravel()).tobytes().hex()
+
+
+def phash(image: Image.Image) -> str:
+    """64-bit DCT perceptual hash as 16 hex digits - robust to scaling, compression and small edits"""
+    pixels = np.asarray(image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float32)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term is the overall brightness, so it is left out of the median
+    return _to_hex(low > np.median(low[1:]))
+
+
+def dhash(image: Image.Image) -> str:
+    """64-bit difference hash as 16 hex digits: whether each pixel is brighter than its left neighbour"""
+    pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS), dtype=np.int16)
+    return _to_hex(pixels[:, 1:] > pixels[:, :-1])
+
+
+def image_hashes(data: bytes) -> Hashes:
+    """{"phash", "dhash"} of an encoded image"""
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEGs can be decoded at a fraction of their size - the hashes only need 32 px
+        image.draft("RGB", (DCT_SIZE * 4, DCT_SIZE * 4))
+        image = ImageOps.exif_transpose(image)
+        return {"phash": phash(image), "dhash": dhash(image)}
+
+
+def hash_images(image_urls: List[str], mirror_paths: Optional[List[Optional[str]]] = None) -> List[Optional[Hashes]]:
+    """
+    Hashes of every result image of a generation, None where one could not be read
+
+    Mirrored images are read locally; the rest come through the image
+    fetcher, and so from the image store when the thumbnail job already
+    fetched them.
+    """
+    mirror_paths = mirror_paths or []
+    images = {index: read_mirror(mirror_paths[index] if index < len(mirror_paths) else None)
+              for index in range(len(image_urls))}
+    fetched = get_image_fetcher().get_many(url for index, url in enumerate(image_urls) if images[index] is None)
+
+    hashes = []
+    for index, url in enumerate(image_urls):
+        data = images[index] or fetched.get(url)
+        try:
+            if data is None:
+                raise ValueError("image could not be fetched")
+            hashes.append(image_hashes(data))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not hash {url}: {e}")
+            hashes.append(None)
+    return hashes
+
+
+def _pair(hashes: Hashes) -> List[int]:
+    return [int(hashes["phash"], 16), int(hashes["dhash"], 16)]
+
+
+class HashIndex:
+    """
+    Perceptual hashes of every result image in two contiguous uint64 columns
+
+    A query XORs the whole array with the query hashes and counts bits, so a
+    scan is a handful of vectorized passes - a few milliseconds for 100k
+    images - instead of a Python loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hashes = np.zeros((1024, 2), dtype=np.uint64)
+        self._images = np.zeros(1024, dtype=np.int32)
+        self._generation_ids: List[Any] = []
+        self._known = set()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, generation_id, hashes: List[Optional[Hashes]]):
+        """Index the images of a generation; generations already in the index are ignored"""
+        self.add_many([(generation_id, hashes)])
+
+    def add_many(self, rows):
+        """Index (generation_id, hashes) rows with one array copy, as when loading the whole history"""
+        pairs, images, generation_ids = [], [], []
+        with self._lock:
+            for generation_id, hashes in rows:
+                if str(generation_id) in self._known or not hashes:
+                    continue
+                self._known.add(str(generation_id))
+                for image_index, image_hash in enumerate(hashes):
+                    if image_hash:
+                        pairs.append(_pair(image_hash))
+                        images.append(image_index)
+                        generation_ids.append(generation_id)
+            if not pairs:
+                return
+
+            needed = self._count + len(pairs)
+            if needed > len(self._hashes):
+                capacity = max(needed, 2 * len(self._hashes))
+                # New arrays rather than resizing, so running queries keep a consistent view
+                grown_hashes = np.zeros((capacity, 2), dtype=np.uint64)
+                grown_images = np.zeros(capacity, dtype=np.int32)
+                grown_hashes[:self._count] = self._hashes[:self._count]
+                grown_images[:self._count] = self._images[:self._count]
+                self._hashes, self._images = grown_hashes, grown_images
+            self._hashes[self._count:needed] = np.array(pairs, dtype=np.uint64)
+            self._images[self._count:needed] = images
+            self._generation_ids.extend(generation_ids)
+            self._count = needed
+
+    def distances(self, hashes: Hashes) -> np.ndarray:
+        """pHash + dHash Hamming distance of every indexed image to ``hashes``"""
+        with self._lock:
+            indexed = self._hashes[:self._count]
+        difference = np.bitwise_xor(indexed, np.array(_pair(hashes), dtype=np.uint64))
+        if hasattr(np, "bitwise_count"):
+            return np.bitwise_count(difference).sum(axis=1, dtype=np.int32)
+        # NumPy < 2.0: count the bits of every byte with a lookup table
+        return _POPCOUNT[difference.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+    def query(self, hashes: Hashes, max_distance: int = SIMILAR_DISTANCE, limit: int = 12,
+              exclude=None) -> List[Match]:
+        """
+        Nearest indexed images to ``hashes``
+
+        Args:
+            hashes (Dict): {"phash", "dhash"} as from image_hashes
+            max_distance (int): Largest distance returned
+            limit (int): Most matches returned
+            exclude: Generation whose own images are left out
+
+        Returns:
+            List[Tuple]: (generation_id, image index, distance), closest first
+        """
+        distances = self.distances(hashes)
+        hits = np.flatnonzero(distances <= max_distance)
+        wanted = limit + EXCLUDE_MARGIN
+        if len(hits) > wanted:
+            hits = hits[np.argpartition(distances[hits], wanted)[:wanted]]
+        hits = hits[np.argsort(distances[hits], kind="stable")]
+
+        matches = []
+        for position in hits:
+            generation_id = self._generation_ids[position]
+            if exclude is not None and str(generation_id) == str(exclude):
+                continue
+            matches.append((generation_id, int(self._images[position]), int(distances[position])))
+            if len(matches) >= limit:
+                break
+        return matches
+
+
+def build_index(rows) -> HashIndex:
+    """Index from (generation_id, hashes) rows, as returned by db.get_perceptual_hashes()"""
+    index = HashIndex()
+    index.add_many(rows)
+    return index
+
+
+_indexes: Dict[Callable, Tuple[HashIndex, float]] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_hash_index(load: Callable) -> HashIndex:
+    """
+    Process-wide index over ``load()`` (db.get_perceptual_hashes)
+
+    Built on first use and rebuilt every HASH_INDEX_REFRESH seconds;
+    generations hashed by this process are added to it straight away.
+    """
+    with _indexes_lock:
+        index, built_at = _indexes.get(load, (None, 0.0))
+        if index is None or time.monotonic() - built_at > HASH_INDEX_REFRESH:
+            started = time.perf_counter()
+            index = build_index(load())
+            _indexes[load] = (index, time.monotonic())
+            logger.info(f"Hash index built: {len(index)} images in {time.perf_counter() - started:.2f}s")
+        return index
+
+
+def find_similar(index: HashIndex, hashes: List[Optional[Hashes]], exclude=None,
+                 max_distance: int = SIMILAR_DISTANCE, limit: int = 12) -> List[Match]:
+    """Closest images to any image of a generation, each indexed image listed once"""
+    best: Dict[Tuple[str, int], Match] = {}
+    for image_hash in hashes:
+        if not image_hash:
+            continue
+        for match in index.query(image_hash, max_distance, limit, exclude=exclude):
+            key = (str(match[0]), match[1])
+            if key not in best or match[2] < best[key][2]:
+                best[key] = match
+    return sorted(best.values(), key=lambda match: match[2])[:limit]
+
+
+def find_duplicate(index: HashIndex, generation_id, hashes: List[Optional[Hashes]],
+                   max_distance: int = DUPLICATE_DISTANCE) -> Optional[Dict[str, Any]]:
+    """
+    The closest other generation within ``max_distance``, or None
+
+    Returns:
+        Dict: {"generation_id", "image", "distance"}, stored as the new
+        generation's duplicate_of
+    """
+    matches = find_similar(index, hashes, exclude=generation_id, max_distance=max_distance, limit=1)
+    if not matches:
+        return None
+    duplicate_id, image, distance = matches[0]
+    return {"generation_id": duplicate_id, "image": image, "distance": distance}
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def submit_hashes(generation_id, image_urls: List[str], load: Callable,
+                  on_done: Callable[[List[Optional[Hashes]], Optional[Dict[str, Any]]], None]):
+    """
+    Hash a new generation's images in the background and flag it if it duplicates an earlier one
+
+    Used by log_generation. Calls ``on_done(hashes, duplicate_of)`` (see
+    find_duplicate), then adds the generation to the index of ``load``. It is
+    not called if no image could be hashed, so the backfill retries the
+    generation later.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hashes")
+
+    def run():
+        try:
+            hashes = hash_images(image_urls)
+            if not any(hashes):
+                return
+            index = get_hash_index(load)
+            on_done(hashes, find_duplicate(index, generation_id, hashes))
+            index.add(generation_id, hashes)
+        except Exception as e:
+            logger.error(f"Hash job failed: {e}")
+
+    if image_urls:
+        _executor.submit(run)
+
+
+def backfill(db, batch_size: int = 100) -> int:
+    """
+    Hash the images of logged generations that have no hashes yet
+
+    Oldest generations go first and join the index as they are hashed, so a
+    generation is flagged as a duplicate of an earlier one.
+
+    Args:
+        db: db_helper or db_helper_mongo
+        batch_size (int): Generations processed per round
+
+    Returns:
+        int: Number of generations updated
+    """
+    index = build_index(db.get_perceptual_hashes())
+    updated = 0
+    failed = set()
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash-backfill") as executor:
+        while True:
+            pending = [row for row in db.get_generations_without_hashes(batch_size + len(failed))
+                       if row[0] not in failed][:batch_size]
+            if not pending:
+                return updated
+            for (generation_id, image_urls, _), hashes in zip(pending,
+                                                               executor.map(lambda p: hash_images(p[1], p[2]), pending)):
+                if image_urls and not any(hashes):
+                    # Keep it for a later run, but do not retry it in this one
+                    failed.add(generation_id)
+                    continue
+                db.set_generation_hashes(generation_id, hashes, find_duplicate(index, generation_id, hashes))
+                index.add(generation_id, hashes)
+                updated += 1
+            logger.info(f"Hashed {updated} generations")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute perceptual hashes for existing generations")
+    parser.add_argument("--mongo", action="store_true", help="use the MongoDB database instead of SQLite")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.mongo:
+        import db_helper_mongo as db
+    else:
+        import db_helper as db
+    db.init_db()
+    print(f"Hashed {backfill(db, args.batch_size)} generations")
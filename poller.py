@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from polling import COMPLETE, FAILED, generation_status
+from webhooks import CallbackRegistry
+
+logger = logging.getLogger(__name__)
+
+# One sweep over every pending generation this often
+SWEEP_INTERVAL = float(os.getenv("LEONARDO_POLLER_INTERVAL", "2"))
+# Page size of the per-user generations listing (the API caps it at 50)
+LIST_PAGE_SIZE = int(os.getenv("LEONARDO_POLLER_PAGE_SIZE", "50"))
+# Listing pages fetched per sweep before falling back to single lookups
+MAX_LIST_PAGES = int(os.getenv("LEONARDO_POLLER_MAX_PAGES", "3"))
+# Generations missing from the listing that are checked one by one per sweep
+MAX_SINGLE_FETCHES = int(os.getenv("LEONARDO_POLLER_SINGLE_FETCHES", "5"))
+
+
+class CentralPoller:
+    """
+    One background thread that watches every in-flight generation of an API key.
+
+    Instead of each caller running its own status loop against
+    /generations/{id}, callers register the generation ID and wait on a
+    future. Every sweep lists the account's most recent generations through
+    /generations/user/{userId} - one request covers up to LIST_PAGE_SIZE
+    jobs - and resolves the futures of those that finished. Generations that
+    are too old to show up in the listing are looked up individually, a few
+    per sweep.
+
+    Futures live in a CallbackRegistry, so waiters use the same
+    webhooks.wait_for_callback loop as webhook mode.
+    """
+
+    def __init__(self, client, interval: float = SWEEP_INTERVAL, page_size: int = LIST_PAGE_SIZE):
+        """
+        Args:
+            client (LeonardoClient): Client used for the listing and lookups
+            interval (float): Seconds between sweeps
+            page_size (int): Generations fetched per listing page
+        """
+        self.client = client
+        self.interval = interval
+        self.page_size = page_size
+        self.registry = CallbackRegistry()
+        self._user_id: Optional[str] = None
+        self._last_checked: Dict[str, float] = {}
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, generation_id: str) -> Future:
+        """Start watching a generation; the future resolves with its final status payload"""
+        future = self.registry.expect(generation_id)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="leonardo-poller", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return future
+
+    def untrack(self, generation_id: str):
+        self.registry.discard(generation_id)
+
+    def _run(self):
+        while True:
+            pending = self.registry.pending_ids()
+            if not pending:
+                # Nothing in flight - sleep until the next track()
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            try:
+                self.sweep(pending)
+            except Exception as e:
+                logger.error(f"Central poller sweep failed: {e}")
+            time.sleep(self.interval)
+
+    def _get_user_id(self) -> Optional[str]:
+        if self._user_id is None:
+            response = self.client.get_me()
+            if response.status_code != 200:
+                logger.error(f"Could not look up the API user: {response.status_code}")
+                return None
+            self._user_id = response.json()["user_details"][0]["user"]["id"]
+        return self._user_id
+
+    def _list_generations(self, pending: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Most recent generations of the account by ID, enough pages to cover ``pending``"""
+        user_id = self._get_user_id()
+        if user_id is None:
+            return {}
+
+        wanted = set(pending)
+        listed = {}
+        for page in range(MAX_LIST_PAGES):
+            response = self.client.get_user_generations(user_id, offset=page * self.page_size, limit=self.page_size)
+            if response.status_code != 200:
+                logger.warning(f"Generations listing failed: {response.status_code}")
+                break
+            generations = response.json().get("generations", [])
+            for generation in generations:
+                listed[generation.get("id")] = generation
+            if wanted <= listed.keys() or len(generations) < self.page_size:
+                break
+        return listed
+
+    def _resolve(self, generation_id: str, status_data: Dict[str, Any]):
+        if generation_status(status_data) in (COMPLETE, FAILED):
+            self.registry.deliver(generation_id, status_data)
+            self._last_checked.pop(generation_id, None)
+
+    def sweep(self, pending: List[str]):
+        """Check every pending generation once"""
+        try:
+            listed = self._list_generations(pending)
+        except (requests.exceptions.RequestException, KeyError, IndexError, ValueError) as e:
+            logger.warning(f"Generations listing unavailable, checking one by one: {e}")
+            listed = {}
+
+        missing = []
+        for generation_id in pending:
+            generation = listed.get(generation_id)
+            if generation is None:
+                missing.append(generation_id)
+            else:
+                # Listing entries have the same shape as generations_by_pk
+                self._resolve(generation_id, {"generations_by_pk": generation})
+
+        # Least recently checked first, so every missing generation gets its turn
+        missing.sort(key=lambda generation_id: self._last_checked.get(generation_id, 0.0))
+        for generation_id in missing[:MAX_SINGLE_FETCHES]:
+            self._last_checked[generation_id] = time.monotonic()
+            try:
+                response = self.client.get_generation(generation_id)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Status check for {generation_id} failed: {e}")
+                continue
+            if response.status_code == 200:
+                self._resolve(generation_id, response.json())
+
+        # Forget bookkeeping for generations nobody waits on any more
+        for generation_id in set(self._last_checked) - set(pending):
+            del self._last_checked[generation_id]
+
+
+_pollers: Dict[str, CentralPoller] = {}
+_pollers_lock = threading.Lock()
+
+
+def get_poller(api_key: str) -> CentralPoller:
+    """Return the process-wide poller for an API key"""
+    # Imported here - leonardo_client itself depends on completion/poller
+    from leonardo_client import get_client
+
+    key = (api_key or "").strip()
+    with _pollers_lock:
+        poller = _pollers.get(key)
+        if poller is None:
+            poller = CentralPoller(get_client(key))
+            _pollers[key] = poller
+        return poller
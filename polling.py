@@ -0,0 +1,189 @@
+import asyncio
+import random
+import threading
+import time
+import logging
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from model_parameters import get_deadline_for_model_type, get_model_type_from_id
+
+logger = logging.getLogger(__name__)
+
+# Terminal states reported by wait_for_generation
+COMPLETE = "COMPLETE"
+FAILED = "FAILED"
+TIMEOUT = "TIMEOUT"
+CANCELLED = "CANCELLED"
+ERROR = "ERROR"
+
+
+class PollPolicy:
+    """
+    Exponential backoff with jitter, bounded by a total deadline.
+
+    The first status check happens after ``initial_delay`` seconds; every
+    following wait grows by ``factor`` up to ``max_interval``. Each wait is
+    randomised by +/- ``jitter`` (a fraction) so that many sessions polling
+    at once do not fall into lock-step.
+
+    ``first_delay`` (e.g. from the latency model) postpones the first check
+    until the job can plausibly be done; the backoff then starts over from
+    ``initial_delay``.
+    """
+
+    def __init__(self, deadline: float, initial_delay: float = 1.0, factor: float = 1.5,
+                 max_interval: float = 8.0, jitter: float = 0.25, first_delay: Optional[float] = None):
+        """
+        Args:
+            deadline (float): Total seconds to wait before giving up
+            initial_delay (float): Seconds before the first status check
+            factor (float): Backoff multiplier between checks
+            max_interval (float): Upper bound for a single wait
+            jitter (float): Relative randomisation of each wait (0 - 1)
+            first_delay (float): Seconds before the first check, if different
+        """
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.factor = factor
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.first_delay = first_delay
+
+    def delays(self) -> Iterator[float]:
+        """Yield successive wait times (before jitter), forever"""
+        if self.first_delay is not None:
+            yield self.first_delay
+        interval = self.initial_delay
+        while True:
+            yield interval
+            interval = min(self.max_interval, interval * self.factor)
+
+    def jittered(self, interval: float) -> float:
+        spread = interval * self.jitter
+        return max(0.0, random.uniform(interval - spread, interval + spread))
+
+
+def policy_for_model(model_id: Optional[str] = None, model_type: Optional[str] = None, **overrides) -> PollPolicy:
+    """
+    Build the poll policy for a model
+
+    The total deadline comes from model_parameters.modelDeadlines, looked up
+    by model type (given directly or derived from the model ID).
+    """
+    if model_type is None:
+        model_type = get_model_type_from_id(model_id)
+    overrides.setdefault("deadline", get_deadline_for_model_type(model_type))
+    return PollPolicy(**overrides)
+
+
+def generation_status(status_data: Dict[str, Any]) -> Optional[str]:
+    """Status string (PENDING, COMPLETE, FAILED) of a /generations/{id} payload"""
+    return (status_data.get("generations_by_pk") or {}).get("status")
+
+
+def stamp_completion(status_data: Dict[str, Any], pending_at: float, seen_at: float) -> Dict[str, Any]:
+    """
+    Stamp a completion found by polling with ``completed_at`` (time.monotonic())
+
+    The job finished between the last check that was still pending
+    (``pending_at``, or the start of the wait) and the check that saw it done
+    (``seen_at``); the midpoint halves the error a backoff step adds to the
+    latency model's samples. A payload that already carries an exact stamp
+    (a webhook callback) keeps it.
+    """
+    status_data.setdefault("completed_at", (pending_at + seen_at) / 2)
+    return status_data
+
+
+def wait_for_generation(fetch_status: Callable[[], Optional[Dict[str, Any]]], policy: PollPolicy,
+                        cancel_event: Optional[threading.Event] = None,
+                        on_progress: Optional[Callable[[float, int], None]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Poll a generation until it reaches a terminal state
+
+    Args:
+        fetch_status: Returns the /generations/{id} payload, or None if the
+            status request itself failed (the caller reports the error)
+        policy (PollPolicy): Backoff and deadline settings
+        cancel_event (threading.Event): Set it to stop waiting early
+        on_progress: Called as on_progress(elapsed_seconds, attempt) after
+            every status check that is still pending
+
+    Returns:
+        Tuple[str, Optional[Dict]]: (COMPLETE | FAILED | TIMEOUT | CANCELLED | ERROR,
+        last status payload); a COMPLETE payload is stamped (stamp_completion)
+    """
+    cancel_event = cancel_event or threading.Event()
+    start = time.monotonic()
+    pending_at = start
+    status_data = None
+
+    for attempt, interval in enumerate(policy.delays(), start=1):
+        remaining = policy.deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        # Event.wait doubles as an interruptible sleep
+        if cancel_event.wait(min(policy.jittered(interval), remaining)):
+            return CANCELLED, status_data
+
+        status_data = fetch_status()
+        if status_data is None:
+            return ERROR, None
+        checked_at = time.monotonic()
+
+        status = generation_status(status_data)
+        if status == COMPLETE:
+            stamp_completion(status_data, pending_at, checked_at)
+        if status in (COMPLETE, FAILED):
+            return status, status_data
+        pending_at = checked_at
+
+        if on_progress:
+            on_progress(time.monotonic() - start, attempt)
+
+    logger.warning(f"Generation still pending after {policy.deadline:.0f}s")
+    return TIMEOUT, status_data
+
+
+async def wait_for_generation_async(fetch_status, policy: PollPolicy,
+                                    cancel_event: Optional[asyncio.Event] = None,
+                                    on_progress: Optional[Callable[[float, int], None]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    asyncio version of wait_for_generation
+
+    ``fetch_status`` is a coroutine function. Besides ``cancel_event``, the
+    wait can be cancelled by cancelling the task that awaits it.
+    """
+    cancel_event = cancel_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    pending_at = time.monotonic()
+    status_data = None
+
+    for attempt, interval in enumerate(policy.delays(), start=1):
+        remaining = policy.deadline - (loop.time() - start)
+        if remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(cancel_event.wait(), timeout=min(policy.jittered(interval), remaining))
+            return CANCELLED, status_data
+        except asyncio.TimeoutError:
+            pass
+
+        status_data = await fetch_status()
+        if status_data is None:
+            return ERROR, None
+        checked_at = time.monotonic()
+
+        status = generation_status(status_data)
+        if status == COMPLETE:
+            stamp_completion(status_data, pending_at, checked_at)
+        if status in (COMPLETE, FAILED):
+            return status, status_data
+        pending_at = checked_at
+
+        if on_progress:
+            on_progress(loop.time() - start, attempt)
+
+    logger.warning(f"Generation still pending after {policy.deadline:.0f}s")
+    return TIMEOUT, status_data
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Request budgets per Leonardo API key (requests per second and burst size)
+SUBMIT_RATE = float(os.getenv("LEONARDO_SUBMIT_RATE", "2"))
+SUBMIT_BURST = int(os.getenv("LEONARDO_SUBMIT_BURST", "5"))
+STATUS_RATE = float(os.getenv("LEONARDO_STATUS_RATE", "10"))
+STATUS_BURST = int(os.getenv("LEONARDO_STATUS_BURST", "20"))
+
+# Circuit breaker: open after this many consecutive 5xx/connection failures,
+# then let a single trial request through after the cool-down
+BREAKER_FAILURES = int(os.getenv("LEONARDO_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("LEONARDO_BREAKER_COOLDOWN", "30"))
+
+# Retries for idempotent requests (status checks) on 429/5xx
+MAX_RETRIES = int(os.getenv("LEONARDO_MAX_RETRIES", "3"))
+RETRY_BACKOFF = 1.0
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling the API while the circuit breaker is open"""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by every session using an API key.
+
+    ``reserve()`` books a token and returns how long the caller has to wait
+    for it, so the same bucket serves blocking code (``acquire``) and
+    coroutines (``acquire_async``). ``pause()`` holds every caller back,
+    which is how a 429 Retry-After is honoured for the whole key.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    closed    - requests flow; failures are counted
+    open      - requests fail fast with CircuitOpenError until the cool-down ends
+    half-open - one trial request is allowed; success closes, failure re-opens
+
+    Every request let through must end in record_success, record_failure or
+    release_trial, or a half-open breaker keeps waiting for its trial.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.cooldown
+
+    def before_request(self) -> bool:
+        """
+        Raise CircuitOpenError if the call should not be made
+
+        Returns:
+            bool: True if this call is the half-open trial
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at < self.cooldown or self._trial_in_flight:
+                raise CircuitOpenError("Leonardo API is failing; requests are paused for a moment")
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Circuit breaker opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+
+    def release_trial(self):
+        """End a request without an outcome (e.g. cancelled) - the next request becomes the trial"""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+def parse_retry_after(value: Optional[str], default: float = RETRY_BACKOFF) -> float:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+class KeyLimits:
+    """Request budgets and circuit breaker of one API key"""
+
+    def __init__(self):
+        self.submit_limiter = TokenBucket(SUBMIT_RATE, SUBMIT_BURST)
+        self.status_limiter = TokenBucket(STATUS_RATE, STATUS_BURST)
+        self.breaker = CircuitBreaker()
+
+
+_limits: Dict[str, KeyLimits] = {}
+_limits_lock = threading.Lock()
+
+
+def limits_for(api_key: str) -> KeyLimits:
+    """
+    Return the process-wide limits of an API key
+
+    Leonardo rate-limits and fails per key, so every sync and async client of
+    a key shares one set, while a throttled or broken key in the pool never
+    holds back the others.
+    """
+    key = (api_key or "").strip()
+    with _limits_lock:
+        limits = _limits.get(key)
+        if limits is None:
+            limits = KeyLimits()
+            _limits[key] = limits
+        return limits
@@ -0,0 +1,166 @@
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from image_fetch import get_image_fetcher
+from mirror import MIRROR_DIR, read_mirror
+
+logger = logging.getLogger(__name__)
+
+# Fixed renditions for downstream channels. "fit" is "crop" (fill the frame,
+# centre-cropped) or "contain" (whole image inside the frame); no size keeps
+# the original size
+DEFAULT_RENDITIONS: Dict[str, Dict[str, Any]] = {
+    "social-square": {"width": 1080, "height": 1080, "fit": "crop", "format": "JPEG", "quality": 90},
+    "1080p-landscape": {"width": 1920, "height": 1080, "fit": "crop", "format": "JPEG", "quality": 90},
+    "print-tiff": {"format": "TIFF", "dpi": 300},
+}
+# JSON file with {name: spec} replacing the defaults
+RENDITIONS_CONFIG = os.getenv("RENDITIONS_CONFIG")
+RENDITION_WORKERS = int(os.getenv("RENDITION_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "TIFF": ".tif"}
+MIME_TYPES = {".jpg": "image/jpeg", ".png": "image/png", ".webp": "image/webp", ".tif": "image/tiff"}
+
+
+def load_renditions() -> Dict[str, Dict[str, Any]]:
+    """Configured rendition specs: RENDITIONS_CONFIG if set, else DEFAULT_RENDITIONS"""
+    if RENDITIONS_CONFIG:
+        with open(RENDITIONS_CONFIG, encoding="utf-8") as f:
+            return json.load(f)
+    return DEFAULT_RENDITIONS
+
+
+def rendition_dir(generation_id) -> str:
+    """Folder holding a generation's renditions, next to the mirrored originals"""
+    return os.path.join(MIRROR_DIR, "renditions", re.sub(r"[^A-Za-z0-9_-]+", "_", str(generation_id)))
+
+
+def _render(image: Image.Image, spec: Dict[str, Any]) -> Tuple[bytes, str]:
+    """Encode one rendition of an already decoded image; returns (bytes, extension)"""
+    image_format = spec.get("format", "JPEG").upper()
+    if spec.get("width") and spec.get("height"):
+        size = (int(spec["width"]), int(spec["height"]))
+        if spec.get("fit", "crop") == "contain":
+            image = ImageOps.contain(image, size, Image.LANCZOS)
+        else:
+            image = ImageOps.fit(image, size, Image.LANCZOS)
+
+    options: Dict[str, Any] = {}
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+        options.update(quality=int(spec.get("quality", 90)), optimize=True)
+    elif image_format == "WEBP":
+        options.update(quality=int(spec.get("quality", 90)))
+    elif image_format == "TIFF":
+        options.update(compression="tiff_lzw")
+    if spec.get("dpi"):
+        options["dpi"] = (int(spec["dpi"]), int(spec["dpi"]))
+
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue(), EXTENSIONS.get(image_format, "." + image_format.lower())
+
+
+def render_image(data: bytes, out_dir: str, prefix: str, specs: Dict[str, Dict[str, Any]]) -> List[str]:
+    """
+    Decode an image once and write every rendition of it into ``out_dir``
+
+    Runs in the rendition process pool, so it only takes and returns plain
+    values. Files are named ``<prefix>_<rendition><ext>``.
+
+    Returns:
+        List[str]: Paths of the files written
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image.load()
+        for name, spec in specs.items():
+            encoded, extension = _render(image, spec)
+            path = os.path.join(out_dir, f"{prefix}_{name}{extension}")
+            # Write then rename, so readers never see a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+            written.append(path)
+    return written
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_io_executor: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _pools() -> Tuple[ProcessPoolExecutor, ThreadPoolExecutor]:
+    global _process_pool, _io_executor
+    with _pool_lock:
+        if _process_pool is None:
+            # spawn, not fork - the app process runs many threads
+            _process_pool = ProcessPoolExecutor(max_workers=RENDITION_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            _io_executor = ThreadPoolExecutor(max_workers=RENDITION_WORKERS, thread_name_prefix="renditions")
+        return _process_pool, _io_executor
+
+
+def submit_renditions(generation_id, image_urls: List[str], mirror_paths: Optional[List[Optional[str]]] = None,
+                      specs: Optional[Dict[str, Dict[str, Any]]] = None) -> Future:
+    """
+    Create every configured rendition of a generation's images in the background
+
+    Each original is read once - from the mirror if it has one, else through
+    the image fetcher - and rendered in the process pool, so encoding large
+    TIFFs does not hold up the app. Files land in rendition_dir(generation_id).
+
+    Returns:
+        Future: Resolves to the list of files written; images that could not
+        be read or rendered are logged and skipped
+    """
+    process_pool, io_executor = _pools()
+    specs = specs or load_renditions()
+    mirror_paths = mirror_paths or []
+    out_dir = rendition_dir(generation_id)
+
+    def run() -> List[str]:
+        jobs = []
+        for index, url in enumerate(image_urls):
+            data = read_mirror(mirror_paths[index] if index < len(mirror_paths) else None)
+            data = data or get_image_fetcher().get(url)
+            if data is None:
+                logger.warning(f"No image to render for generation {generation_id}: {url}")
+                continue
+            jobs.append(process_pool.submit(render_image, data, out_dir, str(index), specs))
+
+        written = []
+        for job in jobs:
+            try:
+                written.extend(job.result())
+            except Exception as e:
+                logger.error(f"Rendition failed for generation {generation_id}: {e}")
+        return written
+
+    return io_executor.submit(run)
+
+
+def list_renditions(generation_id) -> List[Tuple[str, str]]:
+    """(file name, path) of the renditions stored for a generation"""
+    out_dir = rendition_dir(generation_id)
+    try:
+        names = sorted(n for n in os.listdir(out_dir) if not n.endswith(".tmp"))
+    except FileNotFoundError:
+        return []
+    return [(name, os.path.join(out_dir, name)) for name in names]
+
+
+def rendition_mime(file_name: str) -> str:
+    return MIME_TYPES.get(os.path.splitext(file_name)[1].lower(), "application/octet-stream")
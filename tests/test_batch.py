@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import pytest
+
+from batch import DONE, SKIPPED, QuotaReservations, _run_batch, parse_batch_file
+from key_pool import KeyPool
+
+
+def _pool() -> KeyPool:
+    pool = KeyPool(["test-key"], max_concurrent=8)
+    # Known balance, so acquiring a key does not ask the API for it
+    for state in pool.states:
+        state.credits = 10_000
+        state.credits_checked = time.monotonic()
+    return pool
+
+
+def test_jsonl_rows_must_be_objects():
+    with pytest.raises(ValueError):
+        parse_batch_file(b'{"prompt": "a cat"}\n"just a string"\n', "batch.jsonl")
+    with pytest.raises(ValueError):
+        parse_batch_file(b"[1, 2]\n", "batch.jsonl")
+
+
+def test_jsonl_rows_are_parsed():
+    rows = parse_batch_file(b'{"prompt": "a cat", "width": "768"}\n\n{"prompt": ""}\n', "batch.jsonl")
+    assert rows == [{"prompt": "a cat", "overrides": {"width": 768}}]
+
+
+def test_first_reservation_takes_everything_left_then_uses_largest_cost():
+    left = [20]
+    quota = QuotaReservations(lambda: left[0])
+
+    assert quota.reserve(0)
+    assert not quota.reserve(1)
+
+    left[0] -= 6
+    quota.settle(0, "6")
+    assert quota.reserve(1)
+    assert quota.reserve(2)
+    assert not quota.reserve(3)  # 14 left, 12 reserved
+
+
+def test_batch_never_runs_past_the_quota():
+    daily_quota, cost = 20, 7
+    used = [0]
+    in_flight, most_in_flight = [0], [0]
+
+    async def generate(client, lease, prompt, parameters):
+        in_flight[0] += 1
+        most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+        await asyncio.sleep(0.01)
+        in_flight[0] -= 1
+        return {"generations_by_pk": {"generated_images": []}}, str(cost)
+
+    def on_update(index, status, result, apiCreditCost):
+        used[0] += int(apiCreditCost or 0)
+
+    rows = [{"prompt": f"prompt {i}", "overrides": {}} for i in range(6)]
+    quota = QuotaReservations(lambda: daily_quota - used[0])
+    outcomes = asyncio.run(_run_batch(_pool(), rows, {}, 4, on_update, None, generate, quota))
+
+    statuses = [outcome["status"] for outcome in outcomes]
+    assert statuses.count(DONE) == 2
+    assert statuses.count(SKIPPED) == 4
+    assert used[0] <= daily_quota
+    assert most_in_flight[0] <= 2
@@ -0,0 +1,167 @@
+import asyncio
+import io
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import bulk_img2img
+from batch import QuotaReservations
+import db_helper
+from key_pool import KeyPool
+from leonardo_async import AsyncLeonardoClient
+from polling import COMPLETE, FAILED, TIMEOUT
+
+
+class _Api:
+    """Stands in for Leonardo: counts submits and answers waits from a script"""
+
+    def __init__(self):
+        self.submits = 0
+        self.waits = []
+        self.download_errors = []
+
+    async def upload(self, client, image, name):
+        return "init-1"
+
+    async def submit(self, client, prompt, init_image_id, parameters):
+        self.submits += 1
+        return f"gen-{self.submits}", "5"
+
+    async def wait(self, generation_id, fetch_status, policy, api_key=None):
+        status = self.waits.pop(0)
+        images = [{"url": f"https://cdn.example/{generation_id}.png"}] if status == COMPLETE else []
+        return status, {"generations_by_pk": {"status": status, "generated_images": images}}
+
+
+class _Store:
+    def put(self, url, data):
+        pass
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_helper, "DB_PATH", str(tmp_path / "test.db"))
+    db_helper.init_db()
+
+    api = _Api()
+    preprocessed = Future()
+    preprocessed.set_result(io.BytesIO(b"init image"))
+    monkeypatch.setattr(bulk_img2img, "submit_preprocess", lambda data: preprocessed)
+    monkeypatch.setattr(bulk_img2img, "upload_init_image_async", api.upload)
+    monkeypatch.setattr(bulk_img2img, "submit_image_to_image_async", api.submit)
+    monkeypatch.setattr(bulk_img2img, "wait_for_completion_async", api.wait)
+    monkeypatch.setattr(bulk_img2img, "get_image_store", lambda: _Store())
+
+    async def download(self, url):
+        if api.download_errors:
+            raise api.download_errors.pop(0)
+        return b"result"
+    monkeypatch.setattr(AsyncLeonardoClient, "download", download)
+    return api
+
+
+def _pool() -> KeyPool:
+    pool = KeyPool(["test-key"])
+    for state in pool.states:
+        state.credits = 10_000
+        state.credits_checked = time.monotonic()
+    return pool
+
+
+def _run(items, updates):
+    return bulk_img2img.run_bulk_image_to_image(
+        db_helper, "job-1", items, "a prompt", {"select_model": "Creative"}, key_pool=_pool(),
+        on_update=lambda index, status, outcome: updates.append((status, outcome.get("apiCreditCost"))))
+
+
+def test_failed_wait_keeps_the_submitted_stage_and_resumes_without_paying_again(api):
+    items = [bulk_img2img.bulk_item("a.png", data=b"source")]
+    updates = []
+
+    api.waits.append(TIMEOUT)
+    assert _run(items, updates)[0]["status"] == bulk_img2img.FAILED
+    stored = db_helper.get_bulk_items("job-1")[items[0]["key"]]
+    assert stored["status"] == bulk_img2img.SUBMITTED
+    assert stored["generation_id"] == "gen-1"
+    assert stored["error"]
+    # Charged once, as soon as the submit went through
+    assert [update for update in updates if update[0] == bulk_img2img.SUBMITTED] == [(bulk_img2img.SUBMITTED, "5")]
+
+    updates.clear()
+    api.waits.append(COMPLETE)
+    assert _run(items, updates)[0]["status"] == bulk_img2img.DONE
+    assert api.submits == 1
+    assert not any(status == bulk_img2img.SUBMITTED for status, _ in updates)
+    stored = db_helper.get_bulk_items("job-1")[items[0]["key"]]
+    assert stored["status"] == bulk_img2img.DONE
+    assert stored["error"] is None
+
+
+def test_job_failed_by_leonardo_is_submitted_again(api):
+    items = [bulk_img2img.bulk_item("a.png", data=b"source")]
+
+    api.waits.append(FAILED)
+    _run(items, [])
+    assert db_helper.get_bulk_items("job-1")[items[0]["key"]]["status"] == bulk_img2img.FAILED
+
+    api.waits.append(COMPLETE)
+    assert _run(items, [])[0]["status"] == bulk_img2img.DONE
+    assert api.submits == 2
+
+
+def test_failed_download_keeps_the_result_url(api):
+    items = [bulk_img2img.bulk_item("a.png", data=b"source")]
+
+    api.waits.append(COMPLETE)
+    api.download_errors.append(OSError("connection reset"))
+    _run(items, [])
+    stored = db_helper.get_bulk_items("job-1")[items[0]["key"]]
+    assert stored["status"] == bulk_img2img.GENERATED
+    assert stored["result_url"] == "https://cdn.example/gen-1.png"
+
+    assert _run(items, [])[0]["status"] == bulk_img2img.DONE
+    assert api.submits == 1
+
+
+def test_uploaded_items_do_not_hold_key_slots_while_queued(api, monkeypatch):
+    pool = _pool()
+    state = pool.states[0]
+    held = []
+
+    async def wait(generation_id, fetch_status, policy, api_key=None):
+        # Let the upload workers run ahead and fill the queue first
+        await asyncio.sleep(0.05)
+        held.append(state.in_flight)
+        return await api.wait(generation_id, fetch_status, policy, api_key)
+    monkeypatch.setattr(bulk_img2img, "wait_for_completion_async", wait)
+
+    items = [bulk_img2img.bulk_item(f"{n}.png", data=b"source") for n in range(4)]
+    api.waits.extend([COMPLETE] * 4)
+    outcomes = bulk_img2img.run_bulk_image_to_image(db_helper, "job-1", items, "a prompt", {"select_model": "Creative"},
+                                                    key_pool=pool, upload_concurrency=3, generate_concurrency=1)
+
+    assert [outcome["status"] for outcome in outcomes] == [bulk_img2img.DONE] * 4
+    # Only the generating item holds a slot - queued uploads hold none
+    assert held == [1, 1, 1, 1]
+    assert state.in_flight == 0
+
+
+def test_items_reserve_quota_before_they_are_submitted(api):
+    used = []
+
+    def on_update(index, status, outcome):
+        if status == bulk_img2img.SUBMITTED:
+            used.append(int(outcome["apiCreditCost"]))
+
+    items = [bulk_img2img.bulk_item(f"{n}.png", data=b"source") for n in range(5)]
+    api.waits.extend([COMPLETE] * 5)
+    outcomes = bulk_img2img.run_bulk_image_to_image(
+        db_helper, "job-1", items, "a prompt", {"select_model": "Creative"}, key_pool=_pool(),
+        upload_concurrency=4, generate_concurrency=4, on_update=on_update,
+        quota=QuotaReservations(lambda: 12 - sum(used)))
+
+    # Two 5-credit items fit into 12 credits; the rest are skipped rather than overrunning
+    assert sum(used) == 10
+    assert sorted(outcome["status"] for outcome in outcomes) == \
+        [bulk_img2img.DONE] * 2 + [bulk_img2img.SKIPPED] * 3
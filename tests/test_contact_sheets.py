@@ -0,0 +1,76 @@
+import io
+
+import pytest
+from PIL import Image
+
+import contact_sheets
+import image_store
+import thumbnails
+from image_store import ImageStore
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    images = ImageStore(str(tmp_path / "images"))
+    thumbs = ImageStore(str(tmp_path / "thumbnails"))
+    monkeypatch.setattr(image_store, "_store", images)
+    monkeypatch.setattr(image_store, "_thumbnail_store", thumbs)
+    return images, thumbs
+
+
+def _thumbnail(thumbs, color):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), color).save(buffer, "WEBP")
+    return thumbs.put(f"thumbnail:{color}", buffer.getvalue())
+
+
+def _entries(thumbs, count):
+    placeholder = thumbnails.make_placeholder(_png_bytes())
+    return [
+        {"id": n, "thumbnail": _thumbnail(thumbs, (n * 20 % 255, 80, 120)) if n % 3 == 0 else None,
+         "placeholder": placeholder if n % 3 == 1 else None, "caption": [f"generation {n}", "a prompt"]}
+        for n in range(count)
+    ]
+
+
+def _png_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), (10, 200, 10)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_sheet_has_one_cell_per_entry(stores):
+    _, thumbs = stores
+    sheet = contact_sheets.compose_sheet(_entries(thumbs, 7), columns=3)
+    cell_width = contact_sheets.CELL_SIZE + 2 * contact_sheets.PADDING
+    cell_height = contact_sheets.CELL_SIZE + contact_sheets.CAPTION_LINES * contact_sheets.LINE_HEIGHT \
+        + 2 * contact_sheets.PADDING
+    assert sheet.size == (3 * cell_width, 3 * cell_height)
+
+
+def test_sheets_are_split_and_served_from_the_store(stores, monkeypatch):
+    _, thumbs = stores
+    monkeypatch.setattr(contact_sheets, "SHEET_COLUMNS", 2)
+    monkeypatch.setattr(contact_sheets, "SHEET_ROWS", 2)
+    entries = _entries(thumbs, 5)
+
+    sheets = contact_sheets.get_contact_sheets(entries, "project=Default")
+    assert len(sheets) == 2
+    assert all(Image.open(io.BytesIO(sheet)).format == "JPEG" for sheet in sheets)
+
+    composed = []
+    monkeypatch.setattr(contact_sheets, "compose_sheet", lambda *args, **kwargs: composed.append(args))
+    assert contact_sheets.get_contact_sheets(entries, "project=Default") == sheets
+    assert composed == []
+
+
+def test_cache_key_changes_with_the_data():
+    entries = [{"id": 1, "thumbnail": "abc", "caption": ["x"]}]
+    key = contact_sheets.sheet_cache_key(entries, "all")
+    assert contact_sheets.sheet_cache_key(entries, "all") == key
+    assert contact_sheets.sheet_cache_key([dict(entries[0], thumbnail="def")], "all") != key
+    assert contact_sheets.sheet_cache_key(entries, "project=Other") != key
+
+
+def test_no_entries_no_sheets(stores):
+    assert contact_sheets.get_contact_sheets([], "all") == []
@@ -0,0 +1,50 @@
+import threading
+from concurrent.futures import Future
+
+from image_fetch import ImageFetcher
+
+
+class _InlineExecutor:
+    """Runs a job before submit() returns, like a download that finishes instantly"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class _FakeFetcher(ImageFetcher):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.downloads = []
+
+    def _download(self, url):
+        self.downloads.append(url)
+        return url.encode()
+
+
+def test_already_finished_download_does_not_deadlock():
+    fetcher = _FakeFetcher()
+    fetcher._executor = _InlineExecutor()
+
+    worker = threading.Thread(target=fetcher.submit, args=("https://cdn.example/a.png",), daemon=True)
+    worker.start()
+    worker.join(timeout=5)
+
+    assert not worker.is_alive()
+    assert fetcher.get("https://cdn.example/a.png") == b"https://cdn.example/a.png"
+    assert fetcher.downloads == ["https://cdn.example/a.png"]
+
+
+def test_cache_is_bounded_and_least_recently_used_goes_first():
+    fetcher = _FakeFetcher(cache_bytes=60)
+    fetcher._executor = _InlineExecutor()
+    urls = [f"https://cdn.example/{name}.png" for name in "abc"]  # 25 bytes each
+
+    for url in urls[:2]:
+        assert fetcher.get(url) == url.encode()
+    fetcher.get(urls[0])
+    fetcher.get(urls[2])
+
+    assert set(fetcher._cache) == {urls[0], urls[2]}
+    assert fetcher._cached_bytes <= 60
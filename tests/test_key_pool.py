@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import key_pool
+from key_pool import KeyPool, NoKeyAvailableError
+
+
+class _MeResponse:
+    def __init__(self, status_code, details=None):
+        self.status_code = status_code
+        self._details = details
+
+    def json(self):
+        return {"user_details": [self._details]}
+
+
+class _FakeClient:
+    """Stands in for LeonardoClient; counts /me calls"""
+
+    def __init__(self, response, delay=0.0):
+        self.response = response
+        self.delay = delay
+        self.me_calls = 0
+        self._lock = threading.Lock()
+
+    def get_me(self):
+        with self._lock:
+            self.me_calls += 1
+        time.sleep(self.delay)
+        return self.response
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def install(response, delay=0.0):
+        client = _FakeClient(response, delay)
+        monkeypatch.setattr(key_pool, "get_client", lambda api_key: client)
+        return client
+    return install
+
+
+def _funded_pool(keys, **kwargs):
+    pool = KeyPool(keys, **kwargs)
+    for state in pool.states:
+        state.credits = 10_000
+        state.credits_fresh = True
+        state.credits_checked = time.monotonic()
+    return pool
+
+
+def test_failed_me_is_not_retried_within_negative_ttl(fake_client):
+    client = fake_client(_MeResponse(500))
+    pool = KeyPool(["key-a"], credits_retry_after=60)
+    for _ in range(5):
+        pool.try_acquire().release()
+    assert client.me_calls == 1
+    assert pool.states[0].credits is None
+
+
+def test_failed_me_is_retried_after_negative_ttl(fake_client):
+    client = fake_client(_MeResponse(500))
+    pool = KeyPool(["key-a"], credits_retry_after=0.05)
+    pool.try_acquire().release()
+    time.sleep(0.06)
+    pool.try_acquire().release()
+    assert client.me_calls == 2
+
+
+def test_successful_me_sets_credits_and_slots(fake_client):
+    client = fake_client(_MeResponse(200, {"apiSubscriptionTokens": 300, "apiPaidTokens": 200, "apiConcurrencySlots": 2}))
+    pool = KeyPool(["key-a"], credits_ttl=60, credits_retry_after=0)
+    lease = pool.try_acquire()
+    lease.charge(20)
+    lease.release()
+    pool.try_acquire().release()
+    state = pool.states[0]
+    assert client.me_calls == 1
+    assert state.credits == 480
+    assert state.max_concurrent == 2
+
+
+def test_concurrent_acquirers_share_one_me_call(fake_client):
+    client = fake_client(_MeResponse(200, {"apiSubscriptionTokens": 1000}), delay=0.2)
+    pool = KeyPool(["key-a"], max_concurrent=8)
+    leases = []
+    threads = [threading.Thread(target=lambda: leases.append(pool.try_acquire())) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.me_calls == 1
+    assert all(lease is not None for lease in leases)
+
+
+def test_empty_pool_fails_at_once():
+    pool = KeyPool([])
+    started = time.monotonic()
+    with pytest.raises(NoKeyAvailableError):
+        pool.acquire(timeout=5)
+    with pytest.raises(NoKeyAvailableError):
+        asyncio.run(pool.acquire_async(timeout=5))
+    assert time.monotonic() - started < 1
+
+
+def test_least_loaded_key_is_leased(fake_client):
+    fake_client(_MeResponse(500))
+    pool = _funded_pool(["key-a", "key-b"])
+    first = pool.try_acquire()
+    second = pool.try_acquire()
+    assert first.key_id != second.key_id
+    first.release()
+    assert pool.try_acquire().key_id == first.key_id
+
+
+def test_failed_key_is_benched(fake_client):
+    fake_client(_MeResponse(500))
+    pool = _funded_pool(["key-a", "key-b"])
+    lease = pool.try_acquire()
+    lease.release(failed=True)
+    for _ in range(3):
+        other = pool.try_acquire()
+        assert other.key_id != lease.key_id
+        other.release()
+
+
+def test_key_without_credits_is_skipped(fake_client):
+    fake_client(_MeResponse(500))
+    pool = _funded_pool(["key-a", "key-b"])
+    pool.states[0].credits = 0
+    assert pool.try_acquire().key_id == pool.states[1].key_id
+
+
+def test_busy_pool_times_out(fake_client):
+    fake_client(_MeResponse(500))
+    pool = _funded_pool(["key-a"], max_concurrent=1)
+    pool.try_acquire()
+    with pytest.raises(NoKeyAvailableError):
+        pool.acquire(timeout=0.1)
+
+
+def test_lease_can_be_pinned_to_a_key(fake_client):
+    fake_client(_MeResponse(500))
+    pool = _funded_pool(["key-a", "key-b"])
+    busy = pool.states[1]
+    busy.in_flight = 3
+    assert pool.try_acquire(busy.key_id).key_id == busy.key_id
+    with pytest.raises(NoKeyAvailableError):
+        pool.acquire(timeout=5, key_id="unknown")
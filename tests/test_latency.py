@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+import app
+import db_helper
+from latency import (completion_duration, estimate_latency, latency_group, latency_size, policy_with_latency,
+                     MIN_SAMPLES)
+from polling import COMPLETE, PollPolicy, wait_for_generation
+
+
+def test_no_estimate_without_enough_history():
+    assert estimate_latency([(0.26, 10.0)] * (MIN_SAMPLES - 1), 0.26) is None
+
+
+def test_estimate_scales_with_megapixels():
+    timings = [(1.0, 10.0), (2.0, 20.0), (3.0, 30.0), (1.0, 10.0), (2.0, 20.0)]
+    estimate = estimate_latency(timings, 4.0)
+    assert estimate.expected == pytest.approx(40.0)
+    assert estimate.low <= estimate.expected <= estimate.high
+    assert estimate.samples == 5
+
+
+def test_policy_waits_for_the_low_end_and_stretches_the_deadline():
+    timings = [(1.0, d) for d in (20.0, 22.0, 24.0, 26.0, 28.0, 90.0)]
+    estimate = estimate_latency(timings, 1.0)
+    policy = policy_with_latency(PollPolicy(deadline=60, initial_delay=1.0), estimate)
+    assert policy.first_delay == pytest.approx(estimate.low)
+    assert policy.deadline >= estimate.high * 2
+
+
+def test_poll_loop_stamps_the_midpoint_of_the_last_two_checks():
+    responses = iter(["PENDING", "PENDING", COMPLETE])
+    checks = []
+
+    def fetch_status():
+        checks.append(time.monotonic())
+        return {"generations_by_pk": {"status": next(responses), "generated_images": []}}
+
+    submitted_at = time.monotonic()
+    status, status_data = wait_for_generation(fetch_status, PollPolicy(deadline=10, initial_delay=0.05, factor=2,
+                                                                       jitter=0))
+
+    assert status == COMPLETE
+    duration = completion_duration(status_data, submitted_at)
+    # Between the last pending check and the completing one - not at the completing check
+    assert checks[1] - submitted_at < duration < checks[2] - submitted_at
+
+
+class _Response:
+    def __init__(self, body):
+        self.status_code = 200
+        self.text = str(body)
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class _Client:
+    api_key = "test-key"
+
+    def __init__(self):
+        self.statuses = ["PENDING", COMPLETE]
+
+    def create_generation(self, payload):
+        return _Response({"sdGenerationJob": {"generationId": "gen-1", "apiCreditCost": 8}})
+
+    def get_generation(self, generation_id):
+        images = [{"url": "https://cdn.example/a.png"}]
+        return _Response({"generations_by_pk": {"status": self.statuses.pop(0), "generated_images": images}})
+
+
+class _Lease:
+    key_id = "key-test"
+    client = _Client()
+
+    def charge(self, apiCreditCost):
+        pass
+
+    def release(self, failed=False):
+        pass
+
+
+class _Pool:
+    def acquire(self):
+        return _Lease()
+
+
+def test_default_poll_mode_records_generation_timings(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_helper, "DB_PATH", str(tmp_path / "test.db"))
+    db_helper.init_db()
+    monkeypatch.setattr(app, "get_key_pool", lambda: _Pool())
+    monkeypatch.setattr(app, "policy_for_model", lambda model_id: PollPolicy(deadline=10, initial_delay=0.05, jitter=0))
+    parameters = {"width": 512, "height": 512}
+
+    status_data, apiCreditCost = app.leonardo_text_to_image("a cat", parameters, username="alice")
+
+    assert status_data["generations_by_pk"]["status"] == COMPLETE
+    payload = app.build_text_to_image_payload("a cat", parameters)
+    timings = db_helper.get_generation_timings(latency_group(payload))
+    assert len(timings) == 1
+    megapixels, duration = timings[0]
+    assert megapixels == pytest.approx(latency_size(payload))
+    assert 0 < duration < 5
@@ -0,0 +1,71 @@
+import json
+import sqlite3
+
+import pytest
+
+import db_helper
+import mirror
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_helper, "DB_PATH", str(tmp_path / "test.db"))
+    db_helper.init_db()
+
+
+def _add_generation(urls, mirror_paths=None):
+    conn = sqlite3.connect(db_helper.DB_PATH)
+    c = conn.cursor()
+    c.execute('''
+    INSERT INTO generations (username, prompt, generation_type, project, parameters, result_url, timestamp,
+                             apiCreditCost, mirror_paths)
+    VALUES ('admin', 'a prompt', 'text_to_image', 'Default', '{}', ?, '2026-01-01T00:00:00', 0, ?)
+    ''', (json.dumps(urls), None if mirror_paths is None else json.dumps(mirror_paths)))
+    conn.commit()
+    conn.close()
+    return c.lastrowid
+
+
+def _mirror_paths(generation_id):
+    conn = sqlite3.connect(db_helper.DB_PATH)
+    row = conn.execute("SELECT mirror_paths FROM generations WHERE id=?", (generation_id,)).fetchone()
+    conn.close()
+    return json.loads(row[0]) if row[0] else None
+
+
+def test_partially_mirrored_generations_are_selected(database):
+    complete = _add_generation(["https://cdn.example/a.png"], ["ab/abc.png"])
+    partial = _add_generation(["https://cdn.example/b.png", "https://cdn.example/c.png"], ["cd/cde.png", None])
+    unmirrored = _add_generation(["https://cdn.example/d.png"])
+
+    pending = {row[0]: row for row in db_helper.get_generations_without_mirrors()}
+
+    assert set(pending) == {partial, unmirrored}
+    assert pending[partial][2] == ["cd/cde.png", None]
+    assert pending[unmirrored][2] is None
+    assert complete not in pending
+
+
+def test_backfill_completes_partial_rows_and_keeps_mirrored_images(database, monkeypatch):
+    copied = []
+    broken = {"https://cdn.example/broken.png"}
+
+    def mirror_image(url):
+        if url in broken:
+            raise OSError("gone")
+        copied.append(url)
+        return "new/" + url.rsplit("/", 1)[1]
+    monkeypatch.setattr(mirror, "mirror_image", mirror_image)
+
+    partial = _add_generation(["https://cdn.example/b.png", "https://cdn.example/c.png"], ["old/b.png", None])
+    stuck = _add_generation(["https://cdn.example/e.png", "https://cdn.example/broken.png"], ["old/e.png", None])
+
+    assert mirror.backfill(db_helper) == 1
+    assert _mirror_paths(partial) == ["old/b.png", "new/c.png"]
+    assert _mirror_paths(stuck) == ["old/e.png", None]
+    # Images that were already mirrored are not copied again
+    assert copied == ["https://cdn.example/c.png"]
+
+    broken.clear()
+    assert mirror.backfill(db_helper) == 1
+    assert _mirror_paths(stuck) == ["old/e.png", "new/broken.png"]
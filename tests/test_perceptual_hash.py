@@ -0,0 +1,72 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import perceptual_hash
+from perceptual_hash import HashIndex, build_index, find_duplicate, find_similar, image_hashes
+
+
+def _image(seed, size=(256, 256), image_format="PNG", quality=95):
+    rng = np.random.default_rng(seed)
+    image = Image.new("RGB", size, tuple(int(c) for c in rng.integers(0, 255, 3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x0, y0 = (int(v) for v in rng.integers(0, size[0] - 40, 2))
+        draw.rectangle((x0, y0, x0 + int(rng.integers(20, 120)), y0 + int(rng.integers(20, 120))),
+                       fill=tuple(int(c) for c in rng.integers(0, 255, 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **({"quality": quality} if image_format == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def _distance(a, b):
+    return sum(bin(int(a[key], 16) ^ int(b[key], 16)).count("1") for key in ("phash", "dhash"))
+
+
+def test_hashes_are_64_bit_hex():
+    hashes = image_hashes(_image(1))
+    assert set(hashes) == {"phash", "dhash"}
+    assert all(len(value) == 16 for value in hashes.values())
+
+
+def test_rescaled_and_recompressed_copy_is_close():
+    original = image_hashes(_image(1))
+    with Image.open(io.BytesIO(_image(1))) as image:
+        buffer = io.BytesIO()
+        image.resize((128, 128)).save(buffer, "JPEG", quality=60)
+    assert _distance(original, image_hashes(buffer.getvalue())) <= perceptual_hash.DUPLICATE_DISTANCE
+    assert _distance(original, image_hashes(_image(2))) > perceptual_hash.DUPLICATE_DISTANCE
+
+
+def test_index_distances_match_bit_counts():
+    hashes = [image_hashes(_image(seed)) for seed in range(5)]
+    index = build_index([(seed, [h]) for seed, h in enumerate(hashes)])
+    assert len(index) == 5
+    assert list(index.distances(hashes[0])) == [_distance(hashes[0], h) for h in hashes]
+
+
+def test_generations_are_indexed_once_and_the_index_grows():
+    index = HashIndex()
+    hashes = {"phash": "f" * 16, "dhash": "0" * 16}
+    for generation_id in range(1500):
+        index.add(generation_id, [hashes])
+    index.add(0, [hashes])
+    assert len(index) == 1500
+
+
+def test_duplicate_excludes_the_generation_itself():
+    original = image_hashes(_image(1))
+    index = build_index([("a", [original]), ("b", [image_hashes(_image(2))])])
+    assert find_duplicate(index, "a", [original]) is None
+
+    index.add("c", [original])
+    assert find_duplicate(index, "a", [original]) == {"generation_id": "c", "image": 0, "distance": 0}
+
+
+def test_find_similar_lists_each_image_once_closest_first():
+    first, second = image_hashes(_image(1)), image_hashes(_image(2))
+    index = build_index([("a", [first, second])])
+    matches = find_similar(index, [first, second, None], max_distance=128)
+    assert sorted(match[1] for match in matches) == [0, 1]
+    assert [match[2] for match in matches] == [0, 0]
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import threading
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+import requests
+
+import leonardo_async
+import leonardo_client
+from leonardo_async import AsyncLeonardoClient
+from leonardo_client import LeonardoClient
+from key_pool import is_key_error
+from rate_limit import CircuitBreaker, CircuitOpenError, TokenBucket, limits_for, parse_retry_after
+
+
+# TokenBucket
+
+def test_bucket_allows_burst_then_spaces_requests():
+    bucket = TokenBucket(rate=10, capacity=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.02)
+
+
+def test_bucket_refills_over_time():
+    bucket = TokenBucket(rate=100, capacity=1)
+    assert bucket.reserve() == 0.0
+    time.sleep(0.05)
+    assert bucket.reserve() == 0.0
+
+
+def test_bucket_pause_holds_every_caller_back():
+    bucket = TokenBucket(rate=100, capacity=10)
+    bucket.pause(0.5)
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+    # A shorter pause never shortens a longer one
+    bucket.pause(0.1)
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+
+
+# CircuitBreaker
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=60)
+    for _ in range(2):
+        breaker.before_request()
+        breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+
+def test_breaker_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_breaker_half_open_allows_one_trial():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    assert breaker.before_request() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    breaker.record_success()
+    assert breaker.before_request() is False
+
+
+def test_breaker_failed_trial_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.before_request() is True
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    time.sleep(0.06)
+    assert breaker.before_request() is True
+
+
+def test_breaker_released_trial_lets_next_request_try():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.before_request() is True
+    breaker.release_trial()
+    assert breaker.before_request() is True
+
+
+# Limits per API key
+
+def test_clients_of_one_key_share_limits_and_keys_are_isolated():
+    first = LeonardoClient("key-one")
+    assert first.breaker is AsyncLeonardoClient(" key-one ").breaker
+    assert first.submit_limiter is limits_for("key-one").submit_limiter
+
+    other = LeonardoClient("key-two")
+    assert other.breaker is not first.breaker
+    assert other.status_limiter is not first.status_limiter
+
+
+def test_async_key_errors_bench_the_key():
+    request_info = aiohttp.RequestInfo(url=None, method="GET", headers={}, real_url=None)
+    assert is_key_error(aiohttp.ClientResponseError(request_info, (), status=401))
+    assert is_key_error(asyncio.TimeoutError())
+    assert not is_key_error(aiohttp.ClientResponseError(request_info, (), status=400))
+
+
+# parse_retry_after
+
+def test_retry_after_seconds():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("-3") == 0.0
+
+
+def test_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert parse_retry_after(format_datetime(when, usegmt=True)) == pytest.approx(30, abs=2)
+
+
+def test_retry_after_missing_or_invalid_uses_default():
+    assert parse_retry_after(None, default=2.5) == 2.5
+    assert parse_retry_after("", default=2.5) == 2.5
+    assert parse_retry_after("soon", default=2.5) == 2.5
+
+
+# Half-open trials through the clients never leave the breaker stuck
+
+class _FakeApi(BaseHTTPRequestHandler):
+    # Responses handed out in order; ("sleep", seconds) stalls past the client timeout
+    script = []
+
+    def do_GET(self):
+        action = self.script.pop(0) if self.script else 200
+        if isinstance(action, tuple):
+            time.sleep(action[1])
+            action = 200
+        body = json.dumps({"ok": True}).encode()
+        self.send_response(action)
+        if action == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients that timed out on purpose leave broken pipes behind
+        pass
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    server = _QuietServer(("127.0.0.1", 0), _FakeApi)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(leonardo_client, "BASE_URL", url)
+    monkeypatch.setattr(leonardo_async, "BASE_URL", url)
+    yield _FakeApi.script
+    _FakeApi.script.clear()
+    server.shutdown()
+    server.server_close()
+
+
+def _half_open_breaker() -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    return breaker
+
+
+def _client(breaker, timeout=5.0) -> LeonardoClient:
+    return LeonardoClient("test-key", timeout=timeout, submit_limiter=TokenBucket(100, 10),
+                          status_limiter=TokenBucket(100, 10), breaker=breaker)
+
+
+def test_rate_limited_trial_closes_breaker(fake_api):
+    fake_api.extend([429, 200])
+    breaker = _half_open_breaker()
+
+    assert _client(breaker).get_generation("gen").status_code == 200
+    assert breaker.before_request() is False
+
+
+def test_timed_out_trial_counts_as_failure(fake_api, monkeypatch):
+    monkeypatch.setattr(leonardo_client.rate_limit, "MAX_RETRIES", 0)
+    fake_api.append(("sleep", 0.5))
+    breaker = _half_open_breaker()
+
+    with pytest.raises(requests.exceptions.Timeout):
+        _client(breaker, timeout=0.1).get_generation("gen")
+    assert breaker.is_open
+    # After the cool-down there is a new trial instead of a breaker stuck open
+    time.sleep(0.06)
+    assert breaker.before_request() is True
+
+
+def test_async_trial_outcomes(fake_api, monkeypatch):
+    monkeypatch.setattr(leonardo_async.rate_limit, "MAX_RETRIES", 0)
+
+    async def main():
+        breaker = _half_open_breaker()
+        async with AsyncLeonardoClient("test-key", timeout=0.1, submit_limiter=TokenBucket(100, 10),
+                                       status_limiter=TokenBucket(100, 10), breaker=breaker) as client:
+            fake_api.append(("sleep", 0.5))
+            with pytest.raises(asyncio.TimeoutError):
+                await client.get_generation("gen")
+            assert breaker.is_open
+
+            await asyncio.sleep(0.06)
+            fake_api.append(429)
+            with pytest.raises(aiohttp.ClientResponseError):
+                await client.get_generation("gen")
+            assert breaker.before_request() is False
+
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import mirror
+import renditions
+
+
+def _png(size=(800, 600)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (30, 90, 200)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_render_image_writes_every_spec(tmp_path):
+    specs = {
+        "square": {"width": 100, "height": 100, "fit": "crop", "format": "JPEG"},
+        "boxed": {"width": 100, "height": 100, "fit": "contain", "format": "PNG"},
+        "print": {"format": "TIFF", "dpi": 300},
+    }
+    written = renditions.render_image(_png(), str(tmp_path), "0", specs)
+
+    assert [path.rsplit("/", 1)[1] for path in written] == ["0_square.jpg", "0_boxed.png", "0_print.tif"]
+    with Image.open(written[0]) as image:
+        assert image.size == (100, 100)
+    with Image.open(written[1]) as image:
+        assert image.size == (100, 75)
+    with Image.open(written[2]) as image:
+        assert image.size == (800, 600)
+        assert tuple(round(v) for v in image.info["dpi"]) == (300, 300)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_config_file_replaces_defaults(tmp_path, monkeypatch):
+    config = tmp_path / "renditions.json"
+    config.write_text(json.dumps({"thumb": {"width": 64, "height": 64, "format": "WEBP"}}), encoding="utf-8")
+    monkeypatch.setattr(renditions, "RENDITIONS_CONFIG", str(config))
+    assert list(renditions.load_renditions()) == ["thumb"]
+    monkeypatch.setattr(renditions, "RENDITIONS_CONFIG", None)
+    assert renditions.load_renditions() is renditions.DEFAULT_RENDITIONS
+
+
+@pytest.fixture
+def thread_pools(tmp_path, monkeypatch):
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+    monkeypatch.setattr(renditions, "MIRROR_DIR", str(tmp_path))
+    with ThreadPoolExecutor(2) as workers, ThreadPoolExecutor(1) as io_executor:
+        monkeypatch.setattr(renditions, "_pools", lambda: (workers, io_executor))
+        yield tmp_path
+
+
+def test_submit_renditions_reads_mirrors_and_skips_missing_images(thread_pools, monkeypatch):
+    (thread_pools / "ab").mkdir()
+    (thread_pools / "ab" / "a.png").write_bytes(_png())
+
+    class _Fetcher:
+        def get(self, url):
+            return None
+    monkeypatch.setattr(renditions, "get_image_fetcher", lambda: _Fetcher())
+
+    specs = {"small": {"width": 50, "height": 50, "format": "JPEG"}}
+    written = renditions.submit_renditions("gen/1", ["https://cdn.example/a.png", "https://cdn.example/b.png"],
+                                           ["ab/a.png", None], specs).result(timeout=30)
+
+    assert len(written) == 1
+    assert renditions.list_renditions("gen/1") == [("0_small.jpg", written[0])]
+    assert renditions.rendition_mime("0_small.jpg") == "image/jpeg"
+    assert renditions.list_renditions("unknown") == []
@@ -0,0 +1,69 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import db_helper
+from db_helper import (attach_inflight_generation, claim_inflight_generation, complete_inflight_generation,
+                       get_inflight_generation, heartbeat_inflight_generation, release_inflight_generation)
+
+KEY = "alice:payload"
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_helper, "DB_PATH", str(tmp_path / "test.db"))
+    db_helper.init_db()
+
+
+def _age(column, seconds):
+    conn = sqlite3.connect(db_helper.DB_PATH)
+    when = (datetime.now() - timedelta(seconds=seconds)).isoformat()
+    conn.execute(f"UPDATE inflight_generations SET {column}=?", (when,))
+    conn.commit()
+    conn.close()
+
+
+def test_live_claim_is_never_taken_over():
+    owner = claim_inflight_generation(KEY, "alice")
+    assert owner
+    assert claim_inflight_generation(KEY, "alice") is None
+
+    # Someone else's token can neither release nor complete the claim
+    release_inflight_generation(KEY, "someone-else")
+    complete_inflight_generation(KEY, "someone-else")
+    assert get_inflight_generation(KEY)["status"] == "PENDING"
+    assert claim_inflight_generation(KEY, "alice") is None
+
+
+def test_stale_claim_is_taken_over_and_old_owner_loses_it():
+    owner = claim_inflight_generation(KEY, "alice")
+    _age("heartbeat_at", db_helper.SINGLE_FLIGHT_STALE_AFTER + 1)
+
+    new_owner = claim_inflight_generation(KEY, "alice")
+    assert new_owner and new_owner != owner
+    assert not heartbeat_inflight_generation(KEY, owner)
+    assert heartbeat_inflight_generation(KEY, new_owner)
+
+
+def test_owner_release_frees_the_request():
+    owner = claim_inflight_generation(KEY, "alice")
+    attach_inflight_generation(KEY, owner, "gen-1", "12", "key-1")
+    assert get_inflight_generation(KEY)["generation_id"] == "gen-1"
+
+    release_inflight_generation(KEY, owner)
+    assert get_inflight_generation(KEY) is None
+
+
+def test_complete_flight_dedupes_then_expires():
+    owner = claim_inflight_generation(KEY, "alice")
+    attach_inflight_generation(KEY, owner, "gen-1", "12")
+    complete_inflight_generation(KEY, owner)
+
+    assert claim_inflight_generation(KEY, "alice") is None
+    # Releasing a finished flight is a no-op, so the grace period holds
+    release_inflight_generation(KEY, owner)
+    assert get_inflight_generation(KEY)["status"] == "COMPLETE"
+
+    _age("completed_at", db_helper.SINGLE_FLIGHT_COMPLETE_TTL + 1)
+    assert claim_inflight_generation(KEY, "alice")
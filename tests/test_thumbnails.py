@@ -0,0 +1,94 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import image_store
+import thumbnails
+from image_store import ImageStore
+
+
+def _png(size=(640, 480), color=(200, 40, 40)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class _Fetcher:
+    def __init__(self, images):
+        self.images = images
+
+    def get_many(self, urls):
+        return {url: self.images.get(url) for url in urls}
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    images = ImageStore(str(tmp_path / "images"), max_bytes=10_000)
+    thumbs = ImageStore(str(tmp_path / "thumbnails"), max_bytes=10_000_000)
+    monkeypatch.setattr(image_store, "_store", images)
+    monkeypatch.setattr(image_store, "_thumbnail_store", thumbs)
+    return images, thumbs
+
+
+def test_thumbnail_is_a_small_webp():
+    data = thumbnails.make_thumbnail(_png((1024, 512)), size=128)
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.format == "WEBP"
+        assert image.size == (128, 64)
+
+
+def test_placeholder_is_a_tiny_webp_data_uri():
+    uri = thumbnails.make_placeholder(_png())
+    assert uri.startswith("data:image/webp;base64,")
+    with Image.open(io.BytesIO(base64.b64decode(uri.split(",", 1)[1]))) as image:
+        assert max(image.size) == thumbnails.PLACEHOLDER_SIZE
+
+
+def test_build_thumbnails_skips_images_that_cannot_be_fetched(stores, monkeypatch):
+    monkeypatch.setattr(thumbnails, "get_image_fetcher",
+                        lambda: _Fetcher({"https://cdn.example/a.png": _png(), "https://cdn.example/c.png": b"junk"}))
+    hashes, placeholders = thumbnails.build_thumbnails(
+        ["https://cdn.example/a.png", "https://cdn.example/b.png", "https://cdn.example/c.png"])
+    assert hashes[0] and hashes[1:] == [None, None]
+    assert placeholders[0] and placeholders[1:] == [None, None]
+    assert thumbnails.load_thumbnail(hashes[0]) is not None
+
+
+def test_full_size_churn_does_not_evict_thumbnails(stores, monkeypatch):
+    images, _ = stores
+    monkeypatch.setattr(thumbnails, "get_image_fetcher", lambda: _Fetcher({"https://cdn.example/a.png": _png()}))
+    (thumbnail_hash,), _ = thumbnails.build_thumbnails(["https://cdn.example/a.png"])
+
+    # Far more full-size bytes than the image store's budget
+    for n in range(20):
+        images.put(f"https://cdn.example/full-{n}.png", bytes([n]) * 2_000)
+
+    assert thumbnails.load_thumbnail(thumbnail_hash) is not None
+
+
+def test_thumbnails_from_the_shared_store_still_load(stores):
+    images, _ = stores
+    legacy_hash = images.put(thumbnails.thumbnail_key("https://cdn.example/a.png"), b"old thumbnail")
+    assert thumbnails.load_thumbnail(legacy_hash) == b"old thumbnail"
+    assert thumbnails.load_thumbnail(None) is None
+
+
+def test_backfill_keeps_unreadable_generations_for_later(stores, monkeypatch):
+    monkeypatch.setattr(thumbnails, "get_image_fetcher", lambda: _Fetcher({"https://cdn.example/a.png": _png()}))
+
+    class _Db:
+        def __init__(self):
+            self.rows = {1: ["https://cdn.example/a.png"], 2: ["https://cdn.example/missing.png"]}
+            self.saved = {}
+
+        def get_generations_without_thumbnails(self, limit):
+            return [(gid, urls) for gid, urls in self.rows.items() if gid not in self.saved][:limit]
+
+        def set_generation_thumbnails(self, generation_id, hashes, placeholders):
+            self.saved[generation_id] = hashes
+
+    db = _Db()
+    assert thumbnails.backfill(db, batch_size=1) == 1
+    assert list(db.saved) == [1]
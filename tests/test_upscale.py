@@ -0,0 +1,48 @@
+import io
+
+import pytest
+from PIL import Image
+
+import upscale
+from batch import QuotaReservations
+
+
+def _png(width, height, orientation=None):
+    buffer = io.BytesIO()
+    image = Image.new("RGB", (width, height), "gray")
+    if orientation is None:
+        image.save(buffer, "PNG")
+    else:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image.save(buffer, "JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("width, height, long_side", [(800, 600, 2048), (600, 1200, 4096), (3000, 500, 3072)])
+def test_tile_count_matches_the_tiles_cut(width, height, long_side):
+    source = _png(width, height)
+    _, boxes, _ = upscale.split_tiles(source, long_side)
+    assert upscale.tile_count(source, long_side) == len(boxes)
+
+
+def test_tile_count_follows_exif_rotation():
+    source = _png(3000, 500, orientation=6)
+    _, boxes, _ = upscale.split_tiles(source, 3072)
+    assert upscale.tile_count(source, 3072) == len(boxes)
+
+
+def test_tiles_reserve_quota_and_skipped_tiles_are_not_retried(monkeypatch):
+    rounds = []
+
+    def run_bulk(db, job_id, items, prompt, parameters, quota=None, **kwargs):
+        rounds.append(quota)
+        return [{"status": upscale.bulk_img2img.SKIPPED} for _ in items]
+    monkeypatch.setattr(upscale.bulk_img2img, "run_bulk_image_to_image", run_bulk)
+
+    quota = QuotaReservations(lambda: 0)
+    result = upscale.run_upscale(None, _png(800, 600), "a prompt", long_side=2048, quota=quota)
+
+    assert rounds == [quota]
+    assert result["path"] is None
+    assert len(result["failed"]) == len(result["tiles"])
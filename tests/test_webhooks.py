@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from latency import completion_duration
+from polling import COMPLETE, PollPolicy
+from webhooks import CallbackRegistry, WebhookReceiver, send_test_callback, wait_for_callback
+
+TOKEN = "test-token"
+
+
+@pytest.fixture
+def receiver():
+    receiver = WebhookReceiver(host="127.0.0.1", port=0, token=TOKEN).start()
+    yield receiver
+    receiver.stop()
+
+
+def test_callback_resolves_waiting_generation(receiver):
+    future = receiver.registry.expect("gen-1")
+
+    response = send_test_callback(receiver.url, "gen-1", ["https://cdn.example/a.png"], token=TOKEN)
+
+    assert response.status_code == 200
+    status_data = future.result(timeout=5)
+    generation = status_data["generations_by_pk"]
+    assert generation["status"] == COMPLETE
+    assert [image["url"] for image in generation["generated_images"]] == ["https://cdn.example/a.png"]
+
+
+def test_callback_without_valid_token_is_rejected(receiver):
+    future = receiver.registry.expect("gen-2")
+
+    assert send_test_callback(receiver.url, "gen-2", ["https://evil.example/x.png"], token=None).status_code == 401
+    assert send_test_callback(receiver.url, "gen-2", ["https://evil.example/x.png"], token="wrong").status_code == 401
+    assert not future.done()
+
+
+def test_early_callback_is_parked_until_expected(receiver):
+    assert send_test_callback(receiver.url, "gen-3", ["https://cdn.example/b.png"], token=TOKEN).status_code == 200
+
+    future = receiver.registry.expect("gen-3")
+    assert future.done()
+    assert future.result()["generations_by_pk"]["id"] == "gen-3"
+
+
+def test_wait_for_callback_round_trip(receiver):
+    threading.Timer(0.2, send_test_callback, args=(receiver.url, "gen-4", ["https://cdn.example/c.png"]),
+                    kwargs={"token": TOKEN}).start()
+
+    status, status_data = wait_for_callback(receiver.registry, "gen-4", lambda: None, PollPolicy(deadline=10),
+                                            fallback_interval=60)
+
+    assert status == COMPLETE
+    assert status_data["generations_by_pk"]["generated_images"][0]["url"] == "https://cdn.example/c.png"
+    assert receiver.registry.pending_ids() == []
+
+
+def test_public_bind_requires_token():
+    with pytest.raises(ValueError):
+        WebhookReceiver(host="0.0.0.0", port=0, token=None)
+
+
+def test_delivered_result_is_stamped_for_the_latency_model():
+    registry = CallbackRegistry()
+    future = registry.expect("gen-5")
+    submitted_at = time.monotonic()
+    time.sleep(0.05)
+    registry.deliver("gen-5", {"generations_by_pk": {"id": "gen-5", "status": COMPLETE}})
+
+    assert completion_duration(future.result(timeout=1), submitted_at) == pytest.approx(0.05, abs=0.04)
+    # A raw status payload that nobody stamped has no completion time
+    assert completion_duration({"generations_by_pk": {"status": COMPLETE}}, submitted_at) is None
+
+
+def test_registry_deliver_reports_unmatched():
+    registry = CallbackRegistry()
+    assert registry.deliver("nobody", {"generations_by_pk": {"id": "nobody"}}) is False
+    future = registry.expect("somebody")
+    assert registry.deliver("somebody", {"generations_by_pk": {"id": "somebody"}}) is True
+    assert future.result(timeout=1)["generations_by_pk"]["id"] == "somebody"
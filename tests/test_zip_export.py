@@ -0,0 +1,76 @@
+import csv
+import io
+import json
+import os
+import zipfile
+from concurrent.futures import Future
+
+import mirror
+import zip_export
+
+
+class _Fetcher:
+    def __init__(self, images):
+        self.images = images
+        self.requested = []
+
+    def submit(self, url):
+        self.requested.append(url)
+        future = Future()
+        if url in self.images:
+            future.set_result(self.images[url])
+        else:
+            future.set_exception(OSError("not found"))
+        return future
+
+    def get(self, url):
+        self.requested.append(url)
+        return self.images.get(url)
+
+
+def _generation(generation_id, urls, **extra):
+    return dict({"id": generation_id, "project": "My Project", "username": "admin", "generation_type": "text_to_image",
+                 "prompt": "a prompt", "parameters": {"width": 512}, "timestamp": "2026-01-01T00:00:00",
+                 "apiCreditCost": 5, "image_urls": urls}, **extra)
+
+
+def test_export_writes_images_and_manifests(tmp_path, monkeypatch):
+    monkeypatch.setattr(mirror, "MIRROR_DIR", str(tmp_path))
+    (tmp_path / "ab").mkdir()
+    (tmp_path / "ab" / "m.png").write_bytes(b"mirrored")
+    fetcher = _Fetcher({"https://cdn.example/a.png": b"a", "https://cdn.example/b.jpg": b"b"})
+    generations = [
+        _generation(1, ["https://cdn.example/a.png", "https://cdn.example/b.jpg"]),
+        _generation(2, ["https://cdn.example/m.png", "https://cdn.example/gone.png"], mirror_paths=["ab/m.png", None]),
+    ]
+    progress = []
+    target = io.BytesIO()
+
+    counts = zip_export.export_generations_zip(generations, target, fetcher=fetcher, window=1,
+                                               on_progress=lambda done, total: progress.append((done, total)))
+
+    assert counts == {"images": 3, "missing": 1}
+    assert progress[-1] == (4, 4)
+    # The mirrored image never goes to the fetcher
+    assert "https://cdn.example/m.png" not in fetcher.requested
+    with zipfile.ZipFile(target) as archive:
+        assert archive.read("My_Project/1_1.jpg") == b"b"
+        assert archive.read("My_Project/2_0.png") == b"mirrored"
+        assert archive.getinfo("My_Project/1_0.png").compress_type == zipfile.ZIP_STORED
+        manifest = json.loads(archive.read("manifest.json"))
+        rows = list(csv.DictReader(io.StringIO(archive.read("manifest.csv").decode("utf-8"))))
+    assert "image_urls" not in manifest[1] and "mirror_paths" not in manifest[1]
+    assert manifest[1]["files"][1] == {"file": None, "url": "https://cdn.example/gone.png"}
+    assert [row["file"] for row in rows] == ["My_Project/1_0.png", "My_Project/1_1.jpg", "My_Project/2_0.png", ""]
+
+
+def test_temp_file_export_can_be_loaded_and_removed():
+    path, counts = zip_export.export_to_temp_file([_generation(1, ["https://cdn.example/a.png"])],
+                                                  fetcher=_Fetcher({"https://cdn.example/a.png": b"a"}))
+    try:
+        assert counts == {"images": 1, "missing": 0}
+        assert zip_export.file_loader(path)()[:2] == b"PK"
+    finally:
+        zip_export.remove_export(path)
+    assert not os.path.exists(path)
+    zip_export.remove_export(path)
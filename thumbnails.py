@@ -0,0 +1,159 @@
+import argparse
+import base64
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from image_fetch import get_image_fetcher
+from image_store import get_image_store, get_thumbnail_store
+
+logger = logging.getLogger(__name__)
+
+# Gallery thumbnails: longest side in pixels and WebP quality
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+# Placeholder shown while a thumbnail loads: an 8 px WebP, blown up and blurry
+PLACEHOLDER_SIZE = 8
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+
+def make_thumbnail(data: bytes, size: int = THUMBNAIL_SIZE, quality: int = THUMBNAIL_QUALITY) -> bytes:
+    """Small WebP version of an image, longest side ``size`` pixels"""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), Image.LANCZOS)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=quality, method=4)
+        return buffer.getvalue()
+
+
+def make_placeholder(data: bytes, size: int = PLACEHOLDER_SIZE) -> str:
+    """
+    Placeholder: an 8 px WebP image as a data URI (~100-200 bytes)
+
+    Stored inline with the generation, so the gallery can paint the colour
+    layout of a row without any image request.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((size, size), Image.BILINEAR)
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=50)
+    return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def thumbnail_key(url: str) -> str:
+    """Image store key of a result URL's thumbnail"""
+    return f"thumbnail:{url}"
+
+
+def build_thumbnails(image_urls: List[str]) -> Tuple[List[Optional[str]], List[Optional[str]]]:
+    """
+    Create and store the thumbnail and placeholder of every result image
+
+    Returns:
+        Tuple[List, List]: (thumbnail content hashes in the image store,
+        placeholder data URIs), None where an image could not be processed
+    """
+    store = get_thumbnail_store()
+    images = get_image_fetcher().get_many(image_urls)
+
+    thumbnails, placeholders = [], []
+    for url in image_urls:
+        data = images.get(url)
+        try:
+            if data is None:
+                raise ValueError("image could not be fetched")
+            thumbnails.append(store.put(thumbnail_key(url), make_thumbnail(data)))
+            placeholders.append(make_placeholder(data))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not create thumbnail for {url}: {e}")
+            thumbnails.append(None)
+            placeholders.append(None)
+    return thumbnails, placeholders
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def submit_thumbnails(image_urls: List[str], on_done: Callable[[List[Optional[str]], List[Optional[str]]], None]):
+    """
+    Build thumbnails in the background and hand them to ``on_done(thumbnails, placeholders)``
+
+    Used by log_generation so logging never waits on image processing.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+
+    def run():
+        try:
+            on_done(*build_thumbnails(image_urls))
+        except Exception as e:
+            logger.error(f"Thumbnail job failed: {e}")
+
+    if image_urls:
+        _executor.submit(run)
+
+
+def load_thumbnail(thumbnail_hash: Optional[str]) -> Optional[bytes]:
+    """Bytes of a stored thumbnail, or None if it is unknown or was evicted"""
+    if not thumbnail_hash:
+        return None
+    data = get_thumbnail_store().get_by_hash(thumbnail_hash)
+    if data is None:
+        # Thumbnails made before they had their own store
+        data = get_image_store().get_by_hash(thumbnail_hash)
+    return data
+
+
+def backfill(db, batch_size: int = 100) -> int:
+    """
+    Create thumbnails for logged generations that have none
+
+    Args:
+        db: db_helper or db_helper_mongo
+        batch_size (int): Generations processed per round
+
+    Returns:
+        int: Number of generations updated
+    """
+    updated = 0
+    failed = set()
+    while True:
+        pending = [(gid, urls) for gid, urls in db.get_generations_without_thumbnails(batch_size + len(failed))
+                   if gid not in failed][:batch_size]
+        if not pending:
+            return updated
+        for generation_id, image_urls in pending:
+            thumbnails, placeholders = build_thumbnails(image_urls)
+            if image_urls and not any(thumbnails):
+                # Keep it for a later run, but do not retry it in this one
+                failed.add(generation_id)
+                continue
+            db.set_generation_thumbnails(generation_id, thumbnails, placeholders)
+            updated += 1
+        logger.info(f"Thumbnails backfilled for {updated} generations")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create gallery thumbnails for existing generations")
+    parser.add_argument("--mongo", action="store_true", help="use the MongoDB database instead of SQLite")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.mongo:
+        import db_helper_mongo as db
+    else:
+        import db_helper as db
+    db.init_db()
+    print(f"Backfilled {backfill(db, args.batch_size)} generations")
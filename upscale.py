@@ -0,0 +1,250 @@
+import hashlib
+import io
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import bulk_img2img
+from batch import QuotaReservations
+from image_store import get_image_store
+from key_pool import KeyPool
+from leonardo_client import IMG2IMG_HEIGHT, IMG2IMG_WIDTH
+from mirror import MIRROR_DIR
+
+logger = logging.getLogger(__name__)
+
+# Pixels shared by neighbouring tiles; the seams are feather-blended across them
+UPSCALE_OVERLAP = int(os.getenv("UPSCALE_OVERLAP", "128"))
+# In Leonardo's API a higher init_strength keeps more of the init image, so a
+# high value here is the "low denoise" an upscale needs: add detail, keep the layout
+UPSCALE_INIT_STRENGTH = float(os.getenv("UPSCALE_INIT_STRENGTH", "0.8"))
+# Extra rounds for tiles that failed; finished tiles are never generated again
+UPSCALE_RETRIES = int(os.getenv("UPSCALE_RETRIES", "2"))
+
+Box = Tuple[int, int, int, int]
+
+
+def tile_positions(length: int, tile: int, overlap: int) -> List[int]:
+    """Start offsets of tiles covering ``length`` pixels with at least ``overlap`` shared between neighbours"""
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / (tile - overlap))
+    step = (length - tile) / (count - 1)
+    return [round(i * step) for i in range(count)]
+
+
+def plan_tiles(width: int, height: int, tile_width: int = IMG2IMG_WIDTH, tile_height: int = IMG2IMG_HEIGHT,
+               overlap: int = UPSCALE_OVERLAP) -> List[Box]:
+    """Tile boxes (left, top, right, bottom) covering a width x height image, row by row"""
+    return [
+        (left, top, left + tile_width, top + tile_height)
+        for top in tile_positions(height, tile_height, overlap)
+        for left in tile_positions(width, tile_width, overlap)
+    ]
+
+
+def target_size(width: int, height: int, long_side: int, tile_width: int = IMG2IMG_WIDTH,
+                tile_height: int = IMG2IMG_HEIGHT) -> Tuple[int, int]:
+    """Upscaled size with the given long side, never smaller than one tile in either direction"""
+    scale = max(long_side / max(width, height), tile_width / width, tile_height / height)
+    return round(width * scale), round(height * scale)
+
+
+def tile_count(source: bytes, long_side: int, overlap: int = UPSCALE_OVERLAP) -> int:
+    """Number of tiles run_upscale cuts a source into, from the image header alone"""
+    with Image.open(io.BytesIO(source)) as image:
+        width, height = image.size
+        # EXIF orientations 5-8 are turned by 90 degrees - tiles are cut from the upright image
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return len(plan_tiles(*target_size(width, height, long_side), overlap=overlap))
+
+
+def feather_mask(box: Box, size: Tuple[int, int], overlap: int) -> np.ndarray:
+    """
+    Blend weights of one tile: 1 inside, ramping down towards edges shared with another tile
+
+    Edges on the border of the image keep full weight, so every pixel has a
+    non-zero total weight.
+    """
+    left, top, right, bottom = box
+    width, height = size
+
+    def ramp(tile_length: int, ramp_start: bool, ramp_end: bool) -> np.ndarray:
+        weights = np.ones(tile_length, dtype=np.float32)
+        length = min(overlap, tile_length // 2)
+        if length > 0:
+            # Never exactly 0, so a pixel covered only by ramps still has weight
+            rising = np.linspace(1.0 / (length + 1), 1.0, length, dtype=np.float32)
+            if ramp_start:
+                weights[:length] = rising
+            if ramp_end:
+                weights[-length:] = rising[::-1]
+        return weights
+
+    horizontal = ramp(right - left, left > 0, right < width)
+    vertical = ramp(bottom - top, top > 0, bottom < height)
+    return np.outer(vertical, horizontal)[:, :, None]
+
+
+def stitch(tiles: List[Tuple[Box, Image.Image]], size: Tuple[int, int], overlap: int = UPSCALE_OVERLAP) -> Image.Image:
+    """Place generated tiles on the canvas, feather-blending the overlaps"""
+    width, height = size
+    canvas = np.zeros((height, width, 3), dtype=np.float32)
+    total = np.zeros((height, width, 1), dtype=np.float32)
+    for box, tile in tiles:
+        left, top, right, bottom = box
+        if tile.size != (right - left, bottom - top):
+            tile = tile.resize((right - left, bottom - top), Image.LANCZOS)
+        mask = feather_mask(box, size, overlap)
+        canvas[top:bottom, left:right] += np.asarray(tile.convert("RGB"), dtype=np.float32) * mask
+        total[top:bottom, left:right] += mask
+    blended = canvas / np.maximum(total, 1e-6)
+    return Image.fromarray(np.clip(blended + 0.5, 0, 255).astype(np.uint8))
+
+
+def split_tiles(source: bytes, long_side: int, overlap: int = UPSCALE_OVERLAP) -> Tuple[Tuple[int, int], List[Box], List[bytes]]:
+    """
+    Resize a source image to the target size and cut it into overlapping tiles
+
+    Returns:
+        Tuple: (target size, tile boxes, PNG bytes of every tile)
+    """
+    with Image.open(io.BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        size = target_size(image.width, image.height, long_side)
+        base = image.resize(size, Image.LANCZOS)
+
+    boxes = plan_tiles(size[0], size[1], overlap=overlap)
+    tiles = []
+    for box in boxes:
+        buffer = io.BytesIO()
+        base.crop(box).save(buffer, "PNG")
+        tiles.append(buffer.getvalue())
+    return size, boxes, tiles
+
+
+def _tile_image(outcome: Dict[str, Any]) -> Optional[Image.Image]:
+    """Decoded result of a finished tile - fresh bytes, else the image store / CDN"""
+    data = outcome.get("data")
+    if data is None and outcome.get("result_url"):
+        try:
+            data = get_image_store().fetch(outcome["result_url"])
+        except Exception as e:
+            logger.warning(f"Could not load upscale tile {outcome['result_url']}: {e}")
+            return None
+    if data is None:
+        return None
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def upscale_path(job_id: str) -> str:
+    """Where the stitched result of an upscale job is written"""
+    return os.path.join(MIRROR_DIR, "upscales", f"{job_id}.png")
+
+
+def upscale_url(path: str) -> str:
+    """URL a stitched result is logged and stored under - it never had a CDN link"""
+    return Path(path).resolve().as_uri()
+
+
+def run_upscale(db, source: bytes, prompt: str, long_side: int = 4096, parameters: Optional[Dict[str, Any]] = None,
+                key_pool: Optional[KeyPool] = None, concurrency: int = bulk_img2img.GENERATE_CONCURRENCY,
+                on_update: Optional[Callable] = None, before_submit: Optional[Callable[[int], bool]] = None,
+                retries: int = UPSCALE_RETRIES, scope: str = "",
+                quota: Optional[QuotaReservations] = None) -> Dict[str, Any]:
+    """
+    Tiled upscale: split, generate every tile as img2img, stitch
+
+    The source is resized to ``long_side`` and cut into overlapping tiles of
+    the img2img size. Tiles go through the bulk image-to-image pipeline
+    (bulk_img2img), so they run concurrently within the key pool's limits,
+    each tile reserves its cost against ``quota`` before it is submitted,
+    and their progress is stored per tile: failed tiles are retried up to
+    ``retries`` more times, and running the same job again only generates
+    the tiles still missing.
+    Finished tiles are stitched with feathered overlaps.
+
+    Args:
+        db: db_helper or db_helper_mongo
+        source (bytes): Source image
+        prompt (str): Description of the image, sent with every tile
+        long_side (int): Long side of the result in pixels
+        parameters (Dict): Generation parameters; init_strength defaults to UPSCALE_INIT_STRENGTH
+        key_pool (KeyPool): API keys, defaults to get_key_pool()
+        concurrency (int): Tiles generated at once
+        on_update: Called as on_update(tile_index, status, outcome), as for
+            bulk_img2img.run_bulk_image_to_image
+        before_submit: Called as before_submit(tile_index); return False to skip a tile
+        retries (int): Extra rounds for failed tiles
+        scope (str): Keeps jobs of different users apart
+        quota (QuotaReservations): Daily credits to reserve tiles against;
+            tiles that cannot fit are skipped and left for a later run
+
+    Returns:
+        Dict: {"job_id", "path" (stitched PNG, None unless every tile finished),
+        "mirror_path" (the PNG relative to MIRROR_DIR), "url" (upscale_url of the
+        PNG), "size", "tiles" (per-tile outcomes), "failed" (tile indexes)}
+    """
+    parameters = {"init_strength": UPSCALE_INIT_STRENGTH, **(parameters or {})}
+    size, boxes, tile_bytes = split_tiles(source, long_side)
+    source_hash = hashlib.sha256(source).hexdigest()[:16]
+    job_id = bulk_img2img.bulk_job_id(prompt, {**parameters, "long_side": long_side},
+                                      scope=f"{scope}:upscale:{source_hash}")
+    items = [bulk_img2img.bulk_item(f"tile_{index:03d}.png", data=data) for index, data in enumerate(tile_bytes)]
+    on_update = on_update or (lambda *args: None)
+
+    outcomes: List[Dict[str, Any]] = [{"status": bulk_img2img.QUEUED} for _ in items]
+    pending = list(range(len(items)))
+    for attempt in range(retries + 1):
+        if attempt:
+            logger.info(f"Upscale {job_id}: retrying {len(pending)} failed tiles")
+
+        def subset_update(index, status, outcome, pending=pending):
+            on_update(pending[index], status, outcome)
+
+        def subset_before_submit(index, pending=pending):
+            return before_submit is None or before_submit(pending[index])
+
+        results = bulk_img2img.run_bulk_image_to_image(
+            db, job_id, [items[i] for i in pending], prompt, parameters, key_pool=key_pool,
+            generate_concurrency=concurrency, on_update=subset_update, before_submit=subset_before_submit,
+            quota=quota)
+        for index, outcome in zip(pending, results):
+            outcomes[index] = outcome
+        # Skipped tiles (quota) are not retried - only real failures are
+        pending = [i for i in pending if outcomes[i]["status"] == bulk_img2img.FAILED]
+        if not pending:
+            break
+
+    missing = [i for i, outcome in enumerate(outcomes) if outcome["status"] != bulk_img2img.DONE]
+    path = mirror_path = url = None
+    if not missing:
+        tiles = []
+        for index, box in enumerate(boxes):
+            image = _tile_image(outcomes[index])
+            if image is None:
+                missing.append(index)
+            else:
+                tiles.append((box, image))
+        if not missing:
+            buffer = io.BytesIO()
+            stitch(tiles, size).save(buffer, "PNG")
+            path = upscale_path(job_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(buffer.getvalue())
+            mirror_path = os.path.relpath(path, MIRROR_DIR)
+            url = upscale_url(path)
+            # Thumbnails and perceptual hashes of the logged result read it from the store
+            get_image_store().put(url, buffer.getvalue())
+
+    return {"job_id": job_id, "path": path, "mirror_path": mirror_path, "url": url, "size": size, "tiles": outcomes,
+            "failed": missing}
@@ -0,0 +1,385 @@
+import asyncio
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from polling import CANCELLED, COMPLETE, FAILED, TIMEOUT, ERROR, PollPolicy, generation_status, stamp_completion
+
+logger = logging.getLogger(__name__)
+
+# Receiver settings. Leonardo posts to the "Webhook Callback URL" configured
+# for the API key in the Leonardo dashboard; route that public URL to this
+# host/port/path (e.g. through the reverse proxy in front of Streamlit).
+# Loopback only by default - the proxy is what the public reaches
+WEBHOOK_HOST = os.getenv("LEONARDO_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("LEONARDO_WEBHOOK_PORT", "8502"))
+WEBHOOK_PATH = os.getenv("LEONARDO_WEBHOOK_PATH", "/leonardo/webhook")
+# "Webhook Callback API Key" - Leonardo sends it as a bearer token. Required
+# to listen on anything but loopback: a callback decides which image URLs get
+# logged and fetched
+WEBHOOK_TOKEN = os.getenv("LEONARDO_WEBHOOK_TOKEN")
+
+# While waiting for a callback, still check the status endpoint this often in
+# case the callback got lost
+FALLBACK_POLL_INTERVAL = float(os.getenv("LEONARDO_WEBHOOK_FALLBACK_POLL", "30"))
+
+# Callbacks that arrive before anyone waits for them are kept this long
+EARLY_CALLBACK_TTL = 600
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_callback(body: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, Any]]:
+    """
+    Convert a Leonardo webhook body into (generation_id, status payload)
+
+    The status payload has the same shape as GET /generations/{id}, so
+    callers can treat a callback exactly like a completed poll.
+    """
+    generation = (body.get("data") or {}).get("object") or {}
+    generation_id = generation.get("id") or body.get("generationId")
+
+    status = generation.get("status")
+    if not status:
+        status = COMPLETE if body.get("type") == "image_generation.complete" else FAILED
+
+    images = generation.get("images") or generation.get("generated_images") or []
+    status_data = {
+        "generations_by_pk": {
+            "id": generation_id,
+            "status": status,
+            "generated_images": images,
+        }
+    }
+    return generation_id, status_data
+
+
+class CallbackRegistry:
+    """
+    Pending generation IDs mapped to futures resolved by incoming callbacks.
+
+    Callbacks for IDs nobody is waiting on yet (fast models can finish before
+    the submit response is processed) are parked and handed over when the
+    waiter registers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Future] = {}
+        self._early: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+    def expect(self, generation_id: str) -> Future:
+        """Register interest in a generation and return its future"""
+        with self._lock:
+            future = self._pending.get(generation_id)
+            if future is None:
+                future = Future()
+                self._pending[generation_id] = future
+            early = self._early.pop(generation_id, None)
+        if early is not None and not future.done():
+            future.set_result(early[1])
+        return future
+
+    def deliver(self, generation_id: str, status_data: Dict[str, Any]) -> bool:
+        """
+        Resolve the waiter of a generation; returns False if nobody was waiting
+
+        The payload is stamped with ``completed_at`` (time.monotonic()) - the
+        arrival time the latency model records.
+        """
+        now = time.monotonic()
+        status_data.setdefault("completed_at", now)
+        with self._lock:
+            future = self._pending.get(generation_id)
+            if future is None:
+                self._early = {k: v for k, v in self._early.items() if now - v[0] < EARLY_CALLBACK_TTL}
+                self._early[generation_id] = (now, status_data)
+                return False
+        if not future.done():
+            future.set_result(status_data)
+        return True
+
+    def discard(self, generation_id: str):
+        with self._lock:
+            self._pending.pop(generation_id, None)
+
+    def pending_ids(self) -> List[str]:
+        """Generation IDs somebody is currently waiting on"""
+        with self._lock:
+            return [generation_id for generation_id, future in self._pending.items() if not future.done()]
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        receiver = self.server.receiver
+        if self.path.split("?")[0].rstrip("/") != receiver.path.rstrip("/"):
+            self._reply(404, {"error": "not found"})
+            return
+
+        if receiver.token and not hmac.compare_digest(self.headers.get("Authorization", ""),
+                                                      f"Bearer {receiver.token}"):
+            self._reply(401, {"error": "unauthorized"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, json.JSONDecodeError):
+            self._reply(400, {"error": "invalid json"})
+            return
+
+        generation_id, status_data = parse_callback(body)
+        if not generation_id:
+            self._reply(400, {"error": "missing generation id"})
+            return
+
+        matched = receiver.registry.deliver(generation_id, status_data)
+        logger.info(f"Webhook for generation {generation_id} ({'matched' if matched else 'parked'})")
+        self._reply(200, {"ok": True})
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WebhookReceiver:
+    """
+    Small threaded HTTP server that feeds Leonardo callbacks into a CallbackRegistry
+
+    Raises ValueError when asked to listen on a non-loopback address
+    without a token.
+    """
+
+    def __init__(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 token: Optional[str] = WEBHOOK_TOKEN, registry: Optional[CallbackRegistry] = None):
+        if not token and not _is_loopback(host):
+            raise ValueError(f"Refusing to receive webhooks on {host} without LEONARDO_WEBHOOK_TOKEN")
+        self.path = path
+        self.token = token
+        self.registry = registry or CallbackRegistry()
+        self.server = ThreadingHTTPServer((host, port), _CallbackHandler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        if host == "0.0.0.0":
+            host = "127.0.0.1"
+        return f"http://{host}:{port}{self.path}"
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.server.serve_forever, name="leonardo-webhooks", daemon=True)
+            self._thread.start()
+            logger.info(f"Webhook receiver listening on {self.url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread = None
+
+
+_receiver: Optional[WebhookReceiver] = None
+_receiver_lock = threading.Lock()
+
+
+def get_receiver() -> Optional[WebhookReceiver]:
+    """
+    Return the process-wide receiver, starting it on first use
+
+    Returns None if the port cannot be bound or the receiver is not safely
+    configured, in which case callers fall back to polling.
+    """
+    global _receiver
+    with _receiver_lock:
+        if _receiver is None:
+            try:
+                _receiver = WebhookReceiver().start()
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not start webhook receiver: {e}")
+                return None
+        return _receiver
+
+
+def _with_images(callback_data: Dict[str, Any], fetched: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """The fetched payload of a callback that came without image details, stamped with the callback's arrival"""
+    if fetched is None:
+        return callback_data
+    if "completed_at" in callback_data:
+        fetched["completed_at"] = callback_data["completed_at"]
+    return fetched
+
+
+def _polled_to_end(status_data: Dict[str, Any], pending_at: float) -> bool:
+    """Whether a fallback poll found the job finished; a completion is stamped for the latency model"""
+    status = generation_status(status_data)
+    if status == COMPLETE:
+        stamp_completion(status_data, pending_at, time.monotonic())
+    return status in (COMPLETE, FAILED)
+
+
+def wait_for_callback(registry: CallbackRegistry, generation_id: str,
+                      fetch_status: Callable[[], Optional[Dict[str, Any]]], policy: PollPolicy,
+                      cancel_event: Optional[threading.Event] = None,
+                      on_progress: Optional[Callable[[float, int], None]] = None,
+                      fallback_interval: float = FALLBACK_POLL_INTERVAL) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """
+    Wait for a generation's webhook, with sparse status polls as a fallback
+
+    Same contract as polling.wait_for_generation.
+    """
+    future = registry.expect(generation_id)
+    start = time.monotonic()
+    # Last time a fallback poll still saw the job pending - the lower bound of its completion
+    pending_at = start
+    next_poll = start + fallback_interval
+    status_data = None
+    attempt = 0
+
+    try:
+        while True:
+            elapsed = time.monotonic() - start
+            if elapsed >= policy.deadline:
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                return CANCELLED, status_data
+
+            try:
+                status_data = future.result(timeout=min(1.0, policy.deadline - elapsed))
+                if generation_status(status_data) == COMPLETE and not status_data["generations_by_pk"]["generated_images"]:
+                    # Callback without image details - one GET fills them in, keeping the callback's time
+                    status_data = _with_images(status_data, fetch_status())
+                return generation_status(status_data), status_data
+            except FutureTimeout:
+                pass
+
+            if time.monotonic() >= next_poll:
+                attempt += 1
+                next_poll = time.monotonic() + fallback_interval
+                status_data = fetch_status()
+                if status_data is None:
+                    return ERROR, None
+                if _polled_to_end(status_data, pending_at):
+                    return generation_status(status_data), status_data
+                pending_at = time.monotonic()
+
+            if on_progress:
+                on_progress(time.monotonic() - start, attempt)
+
+        # Deadline reached without a callback - one last look before giving up
+        status_data = fetch_status()
+        if status_data is None:
+            return ERROR, None
+        return (generation_status(status_data) if _polled_to_end(status_data, pending_at) else TIMEOUT), status_data
+    finally:
+        registry.discard(generation_id)
+
+
+async def wait_for_callback_async(registry: CallbackRegistry, generation_id: str, fetch_status,
+                                  policy: PollPolicy, cancel_event: Optional[asyncio.Event] = None,
+                                  on_progress: Optional[Callable[[float, int], None]] = None,
+                                  fallback_interval: float = FALLBACK_POLL_INTERVAL) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """asyncio version of wait_for_callback; ``fetch_status`` is a coroutine function"""
+    callback = asyncio.wrap_future(registry.expect(generation_id))
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    pending_at = time.monotonic()
+    next_poll = start + fallback_interval
+    status_data = None
+    attempt = 0
+
+    try:
+        while True:
+            elapsed = loop.time() - start
+            if elapsed >= policy.deadline:
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                return CANCELLED, status_data
+
+            try:
+                status_data = await asyncio.wait_for(asyncio.shield(callback),
+                                                     timeout=min(1.0, policy.deadline - elapsed))
+                if generation_status(status_data) == COMPLETE and not status_data["generations_by_pk"]["generated_images"]:
+                    status_data = _with_images(status_data, await fetch_status())
+                return generation_status(status_data), status_data
+            except asyncio.TimeoutError:
+                pass
+
+            if loop.time() >= next_poll:
+                attempt += 1
+                next_poll = loop.time() + fallback_interval
+                status_data = await fetch_status()
+                if status_data is None:
+                    return ERROR, None
+                if _polled_to_end(status_data, pending_at):
+                    return generation_status(status_data), status_data
+                pending_at = time.monotonic()
+
+            if on_progress:
+                on_progress(loop.time() - start, attempt)
+
+        status_data = await fetch_status()
+        if status_data is None:
+            return ERROR, None
+        return (generation_status(status_data) if _polled_to_end(status_data, pending_at) else TIMEOUT), status_data
+    finally:
+        registry.discard(generation_id)
+
+
+def send_test_callback(url: str, generation_id: str, image_urls=None, status: str = COMPLETE,
+                       token: Optional[str] = WEBHOOK_TOKEN) -> requests.Response:
+    """
+    Fake Leonardo sender - post a callback shaped like Leonardo's to a receiver
+
+    Useful for exercising the receiver locally without a public URL.
+    """
+    body = {
+        "type": "image_generation.complete",
+        "object": "generation",
+        "timestamp": time.time(),
+        "api_version": "v1",
+        "data": {
+            "object": {
+                "id": generation_id,
+                "status": status,
+                "images": [{"id": f"{generation_id}-{i}", "url": u} for i, u in enumerate(image_urls or [])],
+            }
+        },
+    }
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    return requests.post(url, json=body, headers=headers, timeout=10)
+
+
+if __name__ == "__main__":
+    # Round trip through a local receiver with the fake sender
+    receiver = WebhookReceiver(host="127.0.0.1", port=0, token=None).start()
+    threading.Timer(1.0, send_test_callback, args=(receiver.url, "test-generation", ["https://example.com/a.png"]),
+                    kwargs={"token": None}).start()
+    print(wait_for_callback(receiver.registry, "test-generation", lambda: None, PollPolicy(deadline=10)))
+    receiver.stop()
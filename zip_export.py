@@ -0,0 +1,183 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import zipfile
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from image_fetch import ImageFetcher, FETCH_TIMEOUT, get_image_fetcher
+from mirror import read_mirror
+
+logger = logging.getLogger(__name__)
+
+# Images fetched ahead of the one being written - bounds memory use of an export
+EXPORT_WINDOW = int(os.getenv("ZIP_EXPORT_WINDOW", "16"))
+
+MANIFEST_FIELDS = ["file", "generation_id", "project", "username", "generation_type", "prompt", "timestamp",
+                   "apiCreditCost", "url", "parameters"]
+
+
+def _safe_name(value: Any) -> str:
+    """Folder/file name part that is safe on every OS"""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", str(value)).strip("._") or "untitled"
+
+
+def _zip_info(name: str, compress_type: int = zipfile.ZIP_STORED) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    return info
+
+
+def _extension(url: str) -> str:
+    extension = os.path.splitext(urlparse(url).path)[1].lower()
+    return extension if extension in (".png", ".jpg", ".jpeg", ".webp") else ".png"
+
+
+def export_generations_zip(generations: List[Dict[str, Any]], target, fetcher: Optional[ImageFetcher] = None,
+                           window: int = EXPORT_WINDOW,
+                           on_progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, int]:
+    """
+    Write the result images of many generations into a ZIP, with a manifest
+
+    Mirrored images are read from the local mirror; the others are fetched
+    concurrently through the shared image fetcher (and so the disk image
+    store), at most ``window`` ahead of the writer, and each one
+    is written into the archive as soon as it is its turn. Only that window is
+    ever held in memory, however many images there are. Images are stored
+    uncompressed (they already are compressed); manifest.json (per generation)
+    and manifest.csv (per image) are added at the end.
+
+    Args:
+        generations (List[Dict]): Dicts with "id", "project", "username",
+            "generation_type", "prompt", "parameters", "timestamp",
+            "apiCreditCost", "image_urls" and optionally "mirror_paths"
+        target: Path or writable binary file object for the archive
+        fetcher (ImageFetcher): Defaults to get_image_fetcher()
+        window (int): Images fetched ahead of the writer
+        on_progress: Called as on_progress(images_done, images_total)
+
+    Returns:
+        Dict[str, int]: {"images": written, "missing": could not be fetched}
+    """
+    fetcher = fetcher or get_image_fetcher()
+    images = [
+        (generation, index, url)
+        for generation in generations
+        for index, url in enumerate(generation.get("image_urls") or [])
+        if url
+    ]
+
+    def mirrored(generation, index):
+        mirror_paths = generation.get("mirror_paths") or []
+        return mirror_paths[index] if index < len(mirror_paths) else None
+    manifest = [dict(generation, files=[]) for generation in generations]
+    manifest_by_id = {id(generation): entry for generation, entry in zip(generations, manifest)}
+    csv_rows = []
+    written = missing = 0
+
+    with zipfile.ZipFile(target, "w") as archive:
+        pending = deque()
+        upcoming = iter(images)
+
+        def fill():
+            while len(pending) < max(window, 1):
+                image = next(upcoming, None)
+                if image is None:
+                    return
+                # Mirrored images are read when written; only the rest go to the fetcher
+                pending.append((image, None if mirrored(image[0], image[1]) else fetcher.submit(image[2])))
+
+        fill()
+        while pending:
+            (generation, index, url), future = pending.popleft()
+            try:
+                data = read_mirror(mirrored(generation, index)) if future is None else future.result(timeout=FETCH_TIMEOUT)
+                if data is None:
+                    # Mirror file gone - fall back to the CDN
+                    data = fetcher.get(url)
+            except Exception as e:
+                logger.warning(f"ZIP export could not fetch {url}: {e}")
+                data = None
+            fill()
+
+            file_name = None
+            if data is not None:
+                file_name = (f"{_safe_name(generation.get('project'))}/"
+                             f"{_safe_name(generation.get('id'))}_{index}{_extension(url)}")
+                with archive.open(_zip_info(file_name), "w") as entry:
+                    entry.write(data)
+                written += 1
+            else:
+                missing += 1
+            del data
+
+            manifest_by_id[id(generation)]["files"].append({"file": file_name, "url": url})
+            csv_rows.append({
+                "file": file_name or "",
+                "generation_id": generation.get("id"),
+                "project": generation.get("project"),
+                "username": generation.get("username"),
+                "generation_type": generation.get("generation_type"),
+                "prompt": generation.get("prompt"),
+                "timestamp": generation.get("timestamp"),
+                "apiCreditCost": generation.get("apiCreditCost"),
+                "url": url,
+                "parameters": json.dumps(generation.get("parameters"), default=str),
+            })
+            if on_progress is not None:
+                on_progress(written + missing, len(images))
+
+        for entry in manifest:
+            entry.pop("image_urls", None)
+            entry.pop("mirror_paths", None)
+        archive.writestr(_zip_info("manifest.json", zipfile.ZIP_DEFLATED), json.dumps(manifest, indent=2, default=str))
+        with archive.open(_zip_info("manifest.csv", zipfile.ZIP_DEFLATED), "w") as entry:
+            text = io.TextIOWrapper(entry, encoding="utf-8", newline="")
+            writer = csv.DictWriter(text, fieldnames=MANIFEST_FIELDS)
+            writer.writeheader()
+            writer.writerows(csv_rows)
+            text.flush()
+            text.detach()
+
+    return {"images": written, "missing": missing}
+
+
+def export_to_temp_file(generations: List[Dict[str, Any]], **kwargs) -> Tuple[str, Dict[str, int]]:
+    """
+    Export into a new temporary .zip file on disk
+
+    Returns:
+        Tuple[str, Dict[str, int]]: (path - delete it with remove_export when
+        done, counts from export_generations_zip)
+    """
+    fd, path = tempfile.mkstemp(prefix="kalki_export_", suffix=".zip")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            counts = export_generations_zip(generations, f, **kwargs)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, counts
+
+
+def file_loader(path: str) -> Callable[[], bytes]:
+    """Zero-argument callable reading a finished export, for st.download_button"""
+    def load() -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+    return load
+
+
+def remove_export(path: Optional[str]):
+    """Delete an export file if it is still there"""
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass